@@ -1,10 +1,24 @@
-from flask import Flask
-
 def create_app():
+    # Flask and the routes are imported here rather than at module level, so
+    # scripts and daemons that only use app.services don't load the web stack
+    from flask import Flask
+
     app = Flask(__name__)
     app.config['SECRET_KEY'] = 'dev'
 
+    # Importing the services has no side effects; the directories they write to are created here
+    from .services import config_service
+    config_service.init_dirs()
+
     from . import routes
     app.register_blueprint(routes.bp)
 
+    # Start (or attach to) the shared interface counter sampler; whichever
+    # worker samples also feeds the persistent history store
+    from .services import job_service, stats_service, tsdb
+    tsdb.start_recording()
+    stats_service.ensure_sampler()
+    # An apply interrupted by the exit of the worker running it continues here
+    job_service.resume_orphans()
+
     return app
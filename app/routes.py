@@ -1,41 +1,288 @@
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash
-from app.services.network_service import get_network_interfaces
-from app.services.config_service import load_config, save_config
-import subprocess
-import os
+from flask import Blueprint, Response, g, render_template, request, jsonify, redirect, url_for, flash, stream_with_context
+from app.services.network_service import get_network_interfaces, detect_new_cards
+from app.services.config_service import load_config, save_config, config_cache_stats, config_revision, list_revisions, config_at, diff_revisions, rollback_config, assign_lb_slots, plan_pppoe_instances, parse_blocked_host, get_firewall_interfaces, plan_tuning, parse_cpus, plan_conntrack
+from app.services.stats_service import get_all_rates, get_interface_stats, INTERVAL as STATS_INTERVAL
+from app.services import conntrack_service, dhcp_service, green, lease_service, metrics_service, pppoe_sessions, qos_service, subscriber_service, tsdb, tuning_service
+from app.services.job_service import submit_apply, confirm_apply, get_job, read_log, is_finished, resume_orphans
+import csv
+import ipaddress
+import json
+import time
 
 bp = Blueprint('main', __name__)
 
+@bp.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+@bp.after_request
+def _record_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        metrics_service.observe_request(request.endpoint, request.method, response.status_code, time.perf_counter() - started)
+    return response
+
+@bp.route('/metrics')
+def metrics():
+    rendered = metrics_service.render()
+    if rendered is None:
+        return Response('prometheus_client is not installed\n', status=503, mimetype='text/plain')
+    body, content_type = rendered
+    return Response(body, content_type=content_type)
+
+# Seconds an apply with "roll back unless confirmed" waits for the confirmation
+CONFIRM_TIMEOUT = 120
+
 @bp.route('/apply_config', methods=['POST'])
 def apply_config():
     try:
-        # Path to the apply script
-        script_path = os.path.join(os.getcwd(), 'scripts', 'apply_configs.sh')
-        
-        # Ensure script is executable
-        subprocess.run(['chmod', '+x', script_path], check=True)
-        
-        # Run the script
-        result = subprocess.run([script_path], capture_output=True, text=True, check=True)
-        
-        flash(f'Configuration applied successfully: {result.stdout}', 'success')
-    except subprocess.CalledProcessError as e:
-        flash(f'Error applying configuration: {e.stderr}', 'error')
+        # Runs in the background; the page follows progress through the job stream
+        job_id = submit_apply(force=request.form.get('force') == 'on',
+                              confirm_timeout=CONFIRM_TIMEOUT if request.form.get('confirm') == 'on' else None)
+        flash(f'Applying configuration in the background (job {job_id}).', 'success')
+        return redirect(url_for('main.dashboard', job=job_id))
+    except ValueError as e:
+        flash(f'Not applied: {e}', 'error')
     except Exception as e:
         flash(f'An unexpected error occurred: {str(e)}', 'error')
         
     return redirect(url_for('main.dashboard'))
 
+@bp.route('/api/apply', methods=['POST'])
+def api_apply():
+    data = request.get_json(silent=True) or {}
+    force = bool(data.get('force')) or request.form.get('force') == 'on'
+    confirm_timeout = data.get('confirm_timeout', request.form.get('confirm_timeout'))
+    if confirm_timeout is not None:
+        try:
+            confirm_timeout = int(confirm_timeout)
+            if not 10 <= confirm_timeout <= 3600:
+                raise ValueError
+        except (TypeError, ValueError):
+            return jsonify({'error': 'confirm_timeout must be 10 to 3600 seconds'}), 400
+    try:
+        job_id = submit_apply(force=force, confirm_timeout=confirm_timeout)
+    except ValueError as e:
+        # Confirm mode with nothing applied before: there is nothing to roll back to
+        return jsonify({'error': str(e)}), 409
+    return jsonify({
+        'job_id': job_id,
+        'status_url': url_for('main.api_apply_status', job_id=job_id),
+        'stream_url': url_for('main.api_apply_stream', job_id=job_id),
+        'confirm_url': url_for('main.api_apply_confirm', job_id=job_id)
+    }), 202
+
+@bp.route('/api/apply/<job_id>/confirm', methods=['POST'])
+def api_apply_confirm(job_id):
+    job = confirm_apply(job_id)
+    if job is None:
+        return jsonify({'error': 'Job is not waiting for confirmation'}), 409
+    return jsonify(job)
+
+@bp.route('/api/apply/<job_id>')
+def api_apply_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.get('orphaned'):
+        resume_orphans()
+    return jsonify(job)
+
+# A sync worker is busy for as long as it streams, and gunicorn kills it once
+# a request runs past its timeout (30 s). Streams therefore end after this
+# many seconds and EventSource reconnects; gevent workers keep them open.
+STREAM_SECONDS = 20
+
+def _stream_deadline():
+    return None if green.active() else time.monotonic() + STREAM_SECONDS
+
+@bp.route('/api/apply/<job_id>/stream')
+def api_apply_stream(job_id):
+    if get_job(job_id) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    # A reconnecting EventSource sends the id of the last event it got: the log offset
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        offset = request.headers.get('Last-Event-ID', 0, type=int)
+
+    def events(offset):
+        deadline = _stream_deadline()
+        last_sent = time.monotonic()
+        last_state = None
+        yield 'retry: 1000\n\n'
+        while True:
+            # Read the state before the log so no lines written before "finished" are missed
+            job = get_job(job_id)
+            if job and job.get('orphaned'):
+                resume_orphans()
+            entries, offset = read_log(job_id, offset)
+            for i, entry in enumerate(entries):
+                event_id = f'id: {offset}\n' if i == len(entries) - 1 else ''
+                yield f"event: {entry['stream']}\n{event_id}data: {json.dumps(entry)}\n\n"
+                last_sent = time.monotonic()
+            if job and job['state'] != last_state:
+                last_state = job['state']
+                if last_state == 'awaiting_confirmation':
+                    yield f"event: awaiting\ndata: {json.dumps(job)}\n\n"
+            if job is None or is_finished(job):
+                yield f"event: done\ndata: {json.dumps(job)}\n\n"
+                return
+            if deadline is not None and time.monotonic() > deadline:
+                # The browser reconnects and continues from the last id
+                return
+            if time.monotonic() - last_sent > 15:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(0.25)
+
+    return Response(stream_with_context(events(offset)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/api/config/cache')
+def config_cache():
+    return jsonify(config_cache_stats())
+
+# The history page lists this many revisions; the API pages through the rest
+HISTORY_PER_PAGE = 100
+
+@bp.route('/config/history')
+def config_history():
+    try:
+        revisions = list_revisions(limit=HISTORY_PER_PAGE)
+        for rev in revisions:
+            rev['saved'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(rev['time']))
+    except LookupError as e:
+        flash(str(e), 'error')
+        revisions = []
+    return render_template('config_history.html', revisions=revisions, current=config_revision())
+
+@bp.route('/config/history/<int:revision>/rollback', methods=['POST'])
+def config_history_rollback(revision):
+    try:
+        new_revision, changed = rollback_config(revision)
+    except KeyError:
+        flash(f'Revision {revision} is no longer kept', 'error')
+        return redirect(url_for('main.config_history'))
+    except LookupError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('main.config_history'))
+    flash(f'Restored revision {revision} as revision {new_revision}. Apply to activate it.', 'success')
+    return redirect(url_for('main.config_history'))
+
+@bp.route('/api/config/revisions')
+def api_config_revisions():
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    try:
+        return jsonify({'current': config_revision(), 'revisions': list_revisions(offset, limit)})
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 501
+
+@bp.route('/api/config/revisions/<int:revision>')
+def api_config_revision(revision):
+    try:
+        return jsonify(config_at(revision))
+    except KeyError:
+        return jsonify({'error': 'Unknown revision'}), 404
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 501
+
+@bp.route('/api/config/revisions/<int:revision>/diff')
+def api_config_revision_diff(revision):
+    target = request.args.get('to')
+    try:
+        return jsonify(diff_revisions(revision, int(target) if target else None))
+    except ValueError:
+        return jsonify({'error': 'to must be a revision number'}), 400
+    except KeyError:
+        return jsonify({'error': 'Unknown revision'}), 404
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 501
+
+@bp.route('/api/config/revisions/<int:revision>/rollback', methods=['POST'])
+def api_config_revision_rollback(revision):
+    try:
+        new_revision, changed = rollback_config(revision)
+    except KeyError:
+        return jsonify({'error': 'Unknown revision'}), 404
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 501
+    return jsonify({'revision': new_revision, 'restored': revision, 'changed': changed})
+
+@bp.route('/api/interfaces/events')
+def interface_events():
+    # Long-poll for hotplug events; stay below the gunicorn worker timeout
+    since = request.args.get('since', 0, type=int)
+    timeout = min(request.args.get('timeout', 0, type=float), 25)
+    return jsonify(detect_new_cards(since, timeout))
+
+@bp.route('/api/interfaces/<name>/stats')
+def interface_stats(name):
+    stats = get_interface_stats(name, history=request.args.get('history', 60, type=int))
+    if stats is None:
+        return jsonify({'error': 'Unknown interface'}), 404
+    return jsonify(stats)
+
+def _rates_stream(name=None):
+    def events():
+        deadline = _stream_deadline()
+        yield 'retry: 1000\n\n'
+        while True:
+            rates = get_all_rates()
+            if name is not None:
+                rates = {name: rates[name]} if name in rates else {}
+            yield f"event: rates\ndata: {json.dumps(rates)}\n\n"
+            if deadline is not None and time.monotonic() > deadline:
+                # Rates carry no state; the browser reconnects and simply continues
+                return
+            time.sleep(STATS_INTERVAL)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/api/interfaces/stats/stream')
+def interface_stats_stream_all():
+    return _rates_stream()
+
+@bp.route('/api/interfaces/<name>/stats/stream')
+def interface_stats_stream(name):
+    return _rates_stream(name)
+
+@bp.route('/api/history')
+def history_series():
+    return jsonify(tsdb.list_series())
+
+@bp.route('/api/history/<series>')
+def history(series):
+    try:
+        result = tsdb.fetch_range(
+            series,
+            start=request.args.get('start', type=float),
+            end=request.args.get('end', type=float),
+            period=request.args.get('range', 'day')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if result is None:
+        return jsonify({'error': 'Unknown series'}), 404
+    return jsonify(result)
+
 @bp.route('/')
 def dashboard():
     interfaces = get_network_interfaces()
-    return render_template('dashboard.html', interfaces=interfaces)
+    pppoe_counts = pppoe_sessions.get_store().counts()
+    # Counters only; the per-protocol breakdown is on the conntrack page
+    conntrack = conntrack_service.read_status(load_config().get('conntrack', {}), breakdown=False)
+    return render_template('dashboard.html', interfaces=interfaces, pppoe_counts=pppoe_counts, conntrack=conntrack)
 
 @bp.route('/network/config', methods=['GET', 'POST'])
 def network_config():
     if request.method == 'POST':
         # Logic to save network config
-        config = load_config()
+        config = load_config(mutable=True)
         network_settings = {}
         
         # Iterate through form data to build network settings
@@ -110,12 +357,28 @@ def loadbalance():
                 'weight': int(weight),
                 'enabled': enabled
             }
+            # Keep the routing table / connmark slot an interface already has
+            if lb_settings.get(iface['name'], {}).get('slot'):
+                new_lb_settings[iface['name']]['slot'] = lb_settings[iface['name']]['slot']
+        assign_lb_slots(new_lb_settings)
         
+        config = load_config(mutable=True)
         config['loadbalance'] = new_lb_settings
         save_config(config)
         return redirect(url_for('main.loadbalance'))
 
-    return render_template('loadbalancing.html', wan_interfaces=wan_interfaces)
+    # wan_health is the probe daemon (asyncio); only its state file is needed here
+    from app.services import wan_health
+    health = wan_health.read_state()
+    for iface in wan_interfaces:
+        iface['health'] = health['wans'].get(iface['name'])
+
+    return render_template('loadbalancing.html', wan_interfaces=wan_interfaces, health_updated=health['updated'])
+
+@bp.route('/api/loadbalance/health')
+def api_loadbalance_health():
+    from app.services import wan_health
+    return jsonify(wan_health.read_state())
 
 @bp.route('/dhcp', methods=['GET', 'POST'])
 def dhcp():
@@ -135,7 +398,9 @@ def dhcp():
                 'dhcp_enabled': if_settings.get('enabled', False),
                 'range_start': if_settings.get('start', ''),
                 'range_end': if_settings.get('end', ''),
-                'lease_time': if_settings.get('lease', 86400)
+                'lease_time': if_settings.get('lease', 86400),
+                'dns': if_settings.get('dns', ''),
+                'domain': if_settings.get('domain', '')
             })
     
     # Add Bridge Interface (br0) if there are LAN interfaces
@@ -147,7 +412,9 @@ def dhcp():
             'dhcp_enabled': br_settings.get('enabled', False),
             'range_start': br_settings.get('start', ''),
             'range_end': br_settings.get('end', ''),
-            'lease_time': br_settings.get('lease', 86400)
+            'lease_time': br_settings.get('lease', 86400),
+            'dns': br_settings.get('dns', ''),
+            'domain': br_settings.get('domain', '')
         })
             
     if request.method == 'POST':
@@ -157,14 +424,117 @@ def dhcp():
                 'enabled': request.form.get(f'enable_{iface["name"]}') == 'on',
                 'start': request.form.get(f'start_{iface["name"]}'),
                 'end': request.form.get(f'end_{iface["name"]}'),
-                'lease': request.form.get(f'lease_{iface["name"]}')
+                'lease': request.form.get(f'lease_{iface["name"]}'),
+                'dns': request.form.get(f'dns_{iface["name"]}', '').strip(),
+                'domain': request.form.get(f'domain_{iface["name"]}', '').strip()
             }
         
+        config = load_config(mutable=True)
         config['dhcp'] = new_dhcp_settings
+        _scopes, errors = dhcp_service.build_scopes(config)
+        if errors:
+            for error in errors:
+                flash(f'Not saved: {error}', 'error')
+            return redirect(url_for('main.dhcp'))
         save_config(config)
         return redirect(url_for('main.dhcp'))
 
-    return render_template('dhcp.html', lan_interfaces=lan_interfaces)
+    reservations = config.get('dhcp_reservations', [])
+    query = request.args.get('q', '').strip().lower()
+    if query:
+        reservations = [r for r in reservations if query in r['mac'] or query in r['ip'] or query in r.get('hostname', '').lower()]
+    leases = lease_service.get_index().query(search=query or None, limit=RESERVATIONS_PER_PAGE)
+    return render_template('dhcp.html', lan_interfaces=lan_interfaces,
+                           reservations=reservations[:RESERVATIONS_PER_PAGE],
+                           reservation_count=len(config.get('dhcp_reservations', [])),
+                           matching_count=len(reservations), query=query, leases=leases)
+
+# The DHCP page lists at most this many reservations and leases; use the search box or the API for the rest
+RESERVATIONS_PER_PAGE = 200
+
+def _add_reservation(mac, ip, hostname, plan=''):
+    """
+    Validates and stores one reservation. Returns (entry, error).
+    """
+    config = load_config(mutable=True)
+    store, _errors = dhcp_service.load_reservations(config, strict=False)
+    try:
+        _check_plan(plan)
+        entry = store.add(mac, ip, hostname, plan=plan)
+    except ValueError as e:
+        return None, str(e)
+    config['dhcp_reservations'] = store.entries()
+    save_config(config)
+    return entry, None
+
+def _remove_reservation(mac):
+    config = load_config(mutable=True)
+    store, _errors = dhcp_service.load_reservations(config, strict=False)
+    try:
+        entry = store.remove(mac)
+    except ValueError:
+        return None
+    if entry is not None:
+        config['dhcp_reservations'] = store.entries()
+        save_config(config)
+    return entry
+
+@bp.route('/dhcp/reservations', methods=['POST'])
+def dhcp_reservation_add():
+    entry, error = _add_reservation(request.form.get('mac'), request.form.get('ip'), request.form.get('hostname'),
+                                    request.form.get('plan', '').strip())
+    if error:
+        flash(f'Reservation not added: {error}', 'error')
+    else:
+        flash(f'Reserved {entry["ip"]} for {entry["mac"]}.', 'success')
+    return redirect(url_for('main.dhcp'))
+
+@bp.route('/dhcp/reservations/<mac>/delete', methods=['POST'])
+def dhcp_reservation_delete(mac):
+    if _remove_reservation(mac) is None:
+        flash(f'No reservation for {mac}.', 'error')
+    return redirect(url_for('main.dhcp'))
+
+@bp.route('/api/dhcp/reservations', methods=['GET', 'POST'])
+def api_dhcp_reservations():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        entry, error = _add_reservation(data.get('mac'), data.get('ip'), data.get('hostname'), data.get('plan') or '')
+        if error:
+            return jsonify({'error': error}), 400
+        return jsonify(entry), 201
+    return jsonify(load_config().get('dhcp_reservations', []))
+
+@bp.route('/api/dhcp/leases')
+def api_dhcp_leases():
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', lease_service.DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    return jsonify(lease_service.get_index().query(
+        mac=request.args.get('mac'),
+        ip=request.args.get('ip'),
+        hostname=request.args.get('hostname'),
+        search=request.args.get('q'),
+        state=request.args.get('state', 'active'),
+        offset=offset,
+        limit=limit
+    ))
+
+@bp.route('/api/dhcp/leases/<key>')
+def api_dhcp_lease(key):
+    lease = lease_service.get_index().lookup(key)
+    if lease is None:
+        return jsonify({'error': 'No lease for this client'}), 404
+    return jsonify(lease)
+
+@bp.route('/api/dhcp/reservations/<mac>', methods=['DELETE'])
+def api_dhcp_reservation_delete(mac):
+    entry = _remove_reservation(mac)
+    if entry is None:
+        return jsonify({'error': 'Reservation not found'}), 404
+    return jsonify(entry)
 
 @bp.route('/pppoe', methods=['GET', 'POST'])
 def pppoe():
@@ -185,7 +555,11 @@ def pppoe():
                 'local_ip': if_settings.get('local_ip', ''),
                 'remote_start': if_settings.get('remote_start', ''),
                 'remote_end': if_settings.get('remote_end', ''),
-                'dns': if_settings.get('dns', '8.8.8.8, 8.8.4.4')
+                'dns': if_settings.get('dns', '8.8.8.8, 8.8.4.4'),
+                'kernel_mode': if_settings.get('kernel_mode', True),
+                'instances': if_settings.get('instances', 1),
+                'max_sessions': if_settings.get('max_sessions', ''),
+                'cpus': if_settings.get('cpus', '')
             })
 
     # Add Bridge Interface (br0) if there are LAN interfaces
@@ -197,7 +571,11 @@ def pppoe():
             'local_ip': br_settings.get('local_ip', ''),
             'remote_start': br_settings.get('remote_start', ''),
             'remote_end': br_settings.get('remote_end', ''),
-            'dns': br_settings.get('dns', '8.8.8.8, 8.8.4.4')
+            'dns': br_settings.get('dns', '8.8.8.8, 8.8.4.4'),
+            'kernel_mode': br_settings.get('kernel_mode', True),
+            'instances': br_settings.get('instances', 1),
+            'max_sessions': br_settings.get('max_sessions', ''),
+            'cpus': br_settings.get('cpus', '')
         })
             
     if request.method == 'POST':
@@ -208,11 +586,437 @@ def pppoe():
                 'local_ip': request.form.get(f'local_ip_{iface["name"]}'),
                 'remote_start': request.form.get(f'remote_start_{iface["name"]}'),
                 'remote_end': request.form.get(f'remote_end_{iface["name"]}'),
-                'dns': request.form.get(f'dns_{iface["name"]}')
+                'dns': request.form.get(f'dns_{iface["name"]}'),
+                'kernel_mode': request.form.get(f'kernel_mode_{iface["name"]}') == 'on',
+                'instances': request.form.get(f'instances_{iface["name"]}') or 1,
+                'max_sessions': request.form.get(f'max_sessions_{iface["name"]}', '').strip(),
+                'cpus': request.form.get(f'cpus_{iface["name"]}', '').strip()
             }
+
+        errors = []
+        for name, settings in new_pppoe_settings.items():
+            if settings['enabled']:
+                try:
+                    plan_pppoe_instances(settings)
+                except ValueError as e:
+                    errors.append(f'{name}: {e}')
+        if errors:
+            for error in errors:
+                flash(f'Not saved: {error}', 'error')
+            return redirect(url_for('main.pppoe'))
         
+        config = load_config(mutable=True)
         config['pppoe'] = new_pppoe_settings
         save_config(config)
         return redirect(url_for('main.pppoe'))
 
-    return render_template('pppoe.html', lan_interfaces=lan_interfaces)
+    query = request.args.get('q', '').strip()
+    sessions = pppoe_sessions.get_store().query(search=query or None, limit=SESSIONS_PER_PAGE)
+    return render_template('pppoe.html', lan_interfaces=lan_interfaces, sessions=sessions, query=query)
+
+# The PPPoE page lists at most this many sessions; use the search box or the API for the rest
+SESSIONS_PER_PAGE = 200
+
+@bp.route('/api/pppoe/sessions')
+def api_pppoe_sessions():
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', pppoe_sessions.DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    return jsonify(pppoe_sessions.get_store().query(
+        search=request.args.get('q'),
+        username=request.args.get('username'),
+        ip=request.args.get('ip'),
+        sort=request.args.get('sort', 'started'),
+        offset=offset,
+        limit=limit
+    ))
+
+@bp.route('/api/pppoe/sessions/summary')
+def api_pppoe_sessions_summary():
+    return jsonify(pppoe_sessions.get_store().counts())
+
+def _check_plan(plan):
+    # Single accounts must name an existing plan; bulk imports are checked when QoS is generated
+    plan = str(plan or '').strip()
+    if plan and plan not in load_config().get('qos_plans', {}):
+        raise ValueError(f'Unknown bandwidth plan: {plan}')
+
+# The subscriber page lists at most this many accounts; use the search box or the API for the rest
+SUBSCRIBERS_PER_PAGE = 200
+
+@bp.route('/pppoe/subscribers', methods=['GET', 'POST'])
+def pppoe_subscribers():
+    if request.method == 'POST':
+        try:
+            _check_plan(request.form.get('plan'))
+            subscriber_service.save_subscriber(request.form)
+        except ValueError as e:
+            flash(f'Subscriber not saved: {e}', 'error')
+        return redirect(url_for('main.pppoe_subscribers', q=request.args.get('q', '')))
+
+    query = request.args.get('q', '').strip()
+    plan = request.args.get('plan')
+    subscribers = subscriber_service.list_subscribers(search=query or None, plan=plan, limit=SUBSCRIBERS_PER_PAGE)
+    edit = subscriber_service.get_subscriber(request.args.get('edit', '')) if request.args.get('edit') else None
+    return render_template('pppoe_subscribers.html', subscribers=subscribers, query=query, edit=edit)
+
+@bp.route('/pppoe/subscribers/<username>/delete', methods=['POST'])
+def pppoe_subscriber_delete(username):
+    if not subscriber_service.delete_subscriber(username):
+        flash(f'No subscriber named {username}.', 'error')
+    return redirect(url_for('main.pppoe_subscribers'))
+
+@bp.route('/pppoe/subscribers/import', methods=['POST'])
+def pppoe_subscribers_import():
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        flash('Choose a CSV or JSON file to import.', 'error')
+        return redirect(url_for('main.pppoe_subscribers'))
+    try:
+        entries = subscriber_service.parse_import(upload.read(), upload.filename)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        flash(f'Import failed: cannot read {upload.filename}: {e}', 'error')
+        return redirect(url_for('main.pppoe_subscribers'))
+    result = subscriber_service.import_subscribers(entries, replace=request.form.get('replace') == 'on')
+    for error in result['errors'][:20]:
+        flash(f'Import failed: {error}', 'error')
+    if result['errors']:
+        if len(result['errors']) > 20:
+            flash(f'... and {len(result["errors"]) - 20} more errors. Nothing was imported.', 'error')
+    else:
+        flash(f'Imported {result["imported"]} subscribers.', 'success')
+    return redirect(url_for('main.pppoe_subscribers'))
+
+@bp.route('/api/pppoe/subscribers', methods=['GET', 'POST'])
+def api_pppoe_subscribers():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            _check_plan(data.get('plan'))
+            subscriber = subscriber_service.save_subscriber(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(subscriber), 201
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', subscriber_service.DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    if request.args.get('ip'):
+        subscriber = subscriber_service.find_by_ip(request.args['ip'])
+        return jsonify({'total': int(bool(subscriber)), 'offset': 0, 'limit': limit,
+                        'subscribers': [subscriber] if subscriber else []})
+    return jsonify(subscriber_service.list_subscribers(
+        search=request.args.get('q'),
+        plan=request.args.get('plan'),
+        offset=offset,
+        limit=limit
+    ))
+
+@bp.route('/api/pppoe/subscribers/import', methods=['POST'])
+def api_pppoe_subscribers_import():
+    upload = request.files.get('file')
+    if upload is not None:
+        data, filename = upload.read(), upload.filename
+    else:
+        data, filename = request.get_data(), '.json' if request.is_json else '.csv'
+    try:
+        entries = subscriber_service.parse_import(data, filename)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'imported': 0, 'errors': [f'Cannot read import: {e}']}), 400
+    result = subscriber_service.import_subscribers(entries, replace=request.args.get('replace') == '1')
+    return jsonify(result), 400 if result['errors'] else 200
+
+@bp.route('/api/pppoe/subscribers/<username>', methods=['GET', 'DELETE'])
+def api_pppoe_subscriber(username):
+    if request.method == 'DELETE':
+        if not subscriber_service.delete_subscriber(username):
+            return jsonify({'error': 'Subscriber not found'}), 404
+        return jsonify({'deleted': username})
+    subscriber = subscriber_service.get_subscriber(username)
+    if subscriber is None:
+        return jsonify({'error': 'Subscriber not found'}), 404
+    return jsonify(subscriber)
+
+@bp.route('/qos', methods=['GET', 'POST'])
+def qos():
+    config = load_config()
+    network_settings = config.get('network', {})
+    qos_settings = config.get('qos', {})
+
+    # Egress of WAN ports shapes uploads; of br0 and LAN ports (PPPoE may run on those), downloads
+    interfaces = []
+    names = [name for name, settings in network_settings.items() if settings.get('role') in ('lan', 'wan')]
+    if any(settings.get('role') == 'lan' for settings in network_settings.values()):
+        names.insert(0, 'br0')
+    for name in names:
+        interfaces.append({
+            'name': name,
+            'role': network_settings.get(name, {}).get('role', 'lan'),
+            'rate_kbit': qos_settings.get('interfaces', {}).get(name, {}).get('rate_kbit', '')
+        })
+
+    if request.method == 'POST':
+        new_interfaces = {}
+        for iface in interfaces:
+            rate = request.form.get(f'rate_{iface["name"]}', '').strip()
+            if not rate:
+                continue
+            if not rate.isdigit():
+                flash(f'Not saved: {iface["name"]}: link rate must be a whole number of kbit/s', 'error')
+                return redirect(url_for('main.qos'))
+            new_interfaces[iface['name']] = {'rate_kbit': int(rate)}
+
+        config = load_config(mutable=True)
+        config['qos'] = {'enabled': request.form.get('enabled') == 'on', 'interfaces': new_interfaces}
+        save_config(config)
+        return redirect(url_for('main.qos'))
+
+    subscribers = subscriber_service.get_index()
+    plans = []
+    for name, settings in sorted(config.get('qos_plans', {}).items()):
+        reservations = sum(1 for r in config.get('dhcp_reservations', []) if r.get('plan') == name)
+        plans.append(dict(settings, name=name, clients=len(subscribers.by_plan.get(name, ())) + reservations))
+    return render_template('qos.html', enabled=qos_settings.get('enabled', False), interfaces=interfaces, plans=plans)
+
+def _save_plan(name, settings):
+    """
+    Validates and stores one bandwidth plan. Returns (plan, error).
+    """
+    try:
+        plan = qos_service.validate_plan(name, settings)
+    except ValueError as e:
+        return None, str(e)
+    config = load_config(mutable=True)
+    config.setdefault('qos_plans', {})[plan['name']] = {'down_kbit': plan['down_kbit'], 'up_kbit': plan['up_kbit']}
+    save_config(config)
+    return plan, None
+
+def _delete_plan(name):
+    """
+    Removes a plan nobody uses. Returns an error message or None.
+    """
+    config = load_config(mutable=True)
+    if name not in config.get('qos_plans', {}):
+        return 'Plan not found'
+    in_use = len(subscriber_service.get_index().by_plan.get(name, ()))
+    in_use += sum(1 for r in config.get('dhcp_reservations', []) if r.get('plan') == name)
+    if in_use:
+        return f'Plan {name} is used by {in_use} clients'
+    del config['qos_plans'][name]
+    save_config(config)
+    return None
+
+@bp.route('/qos/plans', methods=['POST'])
+def qos_plan_save():
+    _plan, error = _save_plan(request.form.get('name'), request.form)
+    if error:
+        flash(f'Plan not saved: {error}', 'error')
+    return redirect(url_for('main.qos'))
+
+@bp.route('/qos/plans/<name>/delete', methods=['POST'])
+def qos_plan_delete(name):
+    error = _delete_plan(name)
+    if error:
+        flash(f'Plan not deleted: {error}', 'error')
+    return redirect(url_for('main.qos'))
+
+@bp.route('/api/qos/plans', methods=['GET', 'POST'])
+def api_qos_plans():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        plan, error = _save_plan(data.get('name'), data)
+        if error:
+            return jsonify({'error': error}), 400
+        return jsonify(plan), 201
+    return jsonify(load_config().get('qos_plans', {}))
+
+@bp.route('/api/qos/plans/<name>', methods=['DELETE'])
+def api_qos_plan_delete(name):
+    error = _delete_plan(name)
+    if error:
+        return jsonify({'error': error}), 404 if error == 'Plan not found' else 409
+    return jsonify({'deleted': name})
+
+@bp.route('/firewall', methods=['GET', 'POST'])
+def firewall():
+    config = load_config()
+    settings = config.get('firewall', {})
+
+    if request.method == 'POST':
+        blocked = []
+        for line in request.form.get('blocked', '').splitlines():
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                blocked.append(parse_blocked_host(line))
+            except ValueError:
+                flash(f'Not saved: invalid blocked host {line}', 'error')
+                return redirect(url_for('main.firewall'))
+
+        config = load_config(mutable=True)
+        config['firewall'] = {
+            'enabled': request.form.get('enabled') == 'on',
+            'flow_offload': request.form.get('flow_offload') == 'on',
+            'hw_offload': request.form.get('hw_offload') == 'on',
+            'blocked': sorted(set(blocked), key=lambda a: ipaddress.ip_network(a))
+        }
+        save_config(config)
+        return redirect(url_for('main.firewall'))
+
+    wans, lans = get_firewall_interfaces(config)
+    return render_template('firewall.html', settings=settings, wans=wans, lans=lans,
+                           flow_offload=settings.get('flow_offload', True))
+
+def _update_blocked(address, add):
+    """
+    Adds or removes one blocked host. Returns (address, error).
+    """
+    try:
+        address = parse_blocked_host(address)
+    except ValueError:
+        return None, f'Invalid address: {address}'
+    config = load_config(mutable=True)
+    settings = config.setdefault('firewall', {})
+    blocked = settings.get('blocked', [])
+    if add and address not in blocked:
+        blocked.append(address)
+    elif not add:
+        if address not in blocked:
+            return None, 'Address is not blocked'
+        blocked.remove(address)
+    settings['blocked'] = sorted(blocked, key=lambda a: ipaddress.ip_network(a))
+    save_config(config)
+    return address, None
+
+@bp.route('/api/firewall')
+def api_firewall():
+    return jsonify(load_config().get('firewall', {}))
+
+@bp.route('/api/firewall/blocked', methods=['POST'])
+def api_firewall_block():
+    address, error = _update_blocked((request.get_json(silent=True) or {}).get('address'), True)
+    if error:
+        return jsonify({'error': error}), 400
+    return jsonify({'blocked': address}), 201
+
+@bp.route('/api/firewall/blocked/<path:address>', methods=['DELETE'])
+def api_firewall_unblock(address):
+    address, error = _update_blocked(address, False)
+    if error:
+        return jsonify({'error': error}), 404
+    return jsonify({'unblocked': address})
+
+@bp.route('/tuning', methods=['GET', 'POST'])
+def tuning():
+    config = load_config()
+    settings = config.get('tuning', {})
+    # Live hardware: what the proposal below is computed for, and what Save stores
+    hardware = tuning_service.read_hardware(get_network_interfaces())
+
+    if request.method == 'POST':
+        cpus = request.form.get('cpus', '').strip()
+        try:
+            if any(c >= hardware['cpus'] for c in parse_cpus(cpus)):
+                raise ValueError
+        except ValueError:
+            flash(f'Not saved: CPU list must look like 0-3,6 and use CPUs 0-{hardware["cpus"] - 1}', 'error')
+            return redirect(url_for('main.tuning'))
+
+        interfaces = {}
+        for name in hardware['nics']:
+            nic = {'offloads': {}}
+            for key in ('rx_ring', 'tx_ring'):
+                value = request.form.get(f'{key}_{name}', '').strip().lower()
+                if value and value != 'max' and not value.isdigit():
+                    flash(f'Not saved: {name}: ring size must be a number or "max"', 'error')
+                    return redirect(url_for('main.tuning'))
+                nic[key] = value
+            for offload in tuning_service.OFFLOADS:
+                value = request.form.get(f'{offload}_{name}', '')
+                if value in ('on', 'off'):
+                    nic['offloads'][offload] = value
+            interfaces[name] = nic
+
+        config = load_config(mutable=True)
+        config['tuning'] = {
+            'enabled': request.form.get('enabled') == 'on',
+            'irq_affinity': request.form.get('irq_affinity') == 'on',
+            'rps': request.form.get('rps') == 'on',
+            'xps': request.form.get('xps') == 'on',
+            'cpus': cpus,
+            'interfaces': interfaces,
+            'hardware': hardware
+        }
+        save_config(config)
+        return redirect(url_for('main.tuning'))
+
+    proposed = plan_tuning(dict({'irq_affinity': True, 'rps': True, 'xps': True}, **settings), hardware)
+    current = tuning_service.read_current(hardware)
+    saved = settings.get('hardware')
+    return render_template('tuning.html', settings=settings, hardware=hardware, current=current, proposed=proposed,
+                           hardware_changed=bool(saved) and saved != hardware, offloads=tuning_service.OFFLOADS)
+
+@bp.route('/api/tuning')
+def api_tuning():
+    config = load_config()
+    hardware = tuning_service.read_hardware(get_network_interfaces())
+    return jsonify({
+        'hardware': hardware,
+        'current': tuning_service.read_current(hardware),
+        'proposed': plan_tuning(config.get('tuning', {}), hardware)
+    })
+
+def _conntrack_number(name, low, high):
+    value = request.form.get(name, '').strip()
+    if not value:
+        return None
+    if not value.isdigit() or not low <= int(value) <= high:
+        raise ValueError(f'{name.replace("_", " ")} must be a number from {low} to {high}')
+    return int(value)
+
+@bp.route('/conntrack', methods=['GET', 'POST'])
+def conntrack():
+    config = load_config()
+    settings = config.get('conntrack', {})
+
+    if request.method == 'POST':
+        import psutil
+        try:
+            new_settings = {
+                'auto_size': request.form.get('auto_size') == 'on',
+                'per_subscriber': _conntrack_number('per_subscriber', 1, 100000),
+                'max': _conntrack_number('max', 1024, 2 ** 31 - 1),
+                'hashsize': _conntrack_number('hashsize', 1024, 2 ** 28),
+                'warn_percent': _conntrack_number('warn_percent', 1, 100) or conntrack_service.WARN_PERCENT,
+                'critical_percent': _conntrack_number('critical_percent', 1, 100) or conntrack_service.CRITICAL_PERCENT,
+                # RAM the size is planned for, like the NIC tuning hardware snapshot
+                'memory_bytes': green.blocking(psutil.virtual_memory).total
+            }
+        except ValueError as e:
+            flash(f'Not saved: {e}', 'error')
+            return redirect(url_for('main.conntrack'))
+        if new_settings['warn_percent'] > new_settings['critical_percent']:
+            flash('Not saved: the warning threshold must not be above the critical one', 'error')
+            return redirect(url_for('main.conntrack'))
+
+        config = load_config(mutable=True)
+        config['conntrack'] = new_settings
+        save_config(config)
+        return redirect(url_for('main.conntrack'))
+
+    status = conntrack_service.read_status(settings)
+    return render_template('conntrack.html', settings=settings, status=status, plan=plan_conntrack(config),
+                           subscribers=len(config.get('pppoe_subscribers', {})),
+                           per_subscriber_default=conntrack_service.ENTRIES_PER_SUBSCRIBER,
+                           warn_default=conntrack_service.WARN_PERCENT, critical_default=conntrack_service.CRITICAL_PERCENT)
+
+@bp.route('/api/conntrack')
+def api_conntrack():
+    config = load_config()
+    status = conntrack_service.read_status(config.get('conntrack', {}))
+    status['plan'] = plan_conntrack(config)
+    return jsonify(status)
@@ -0,0 +1,379 @@
+import filecmp
+import json
+import os
+import selectors
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from app.services import config_service, metrics_service
+
+# Prefix for all installed paths (lets the engine run against a scratch tree)
+INSTALL_ROOT = '/'
+# Directory for scripts owned by this app
+APP_ETC_DIR = '/etc/ubuntu-router'
+# Seconds an activation command may run before it is killed and the subsystem fails
+COMMAND_TIMEOUT = 300
+# Artifacts installed whose activation has not succeeded yet (in GENERATED_DIR).
+# The installed copy already matches, so without this a failed apply would never be retried.
+PENDING_STATE_FILE = '.apply-pending.json'
+
+def _is_active(service):
+    result = subprocess.run(['systemctl', 'is-active', '--quiet', service])
+    return result.returncode == 0
+
+def _netplan_actions(changed, dependency_applied):
+    return [['netplan', 'apply']]
+
+def _dhcp_actions(changed, dependency_applied):
+    # isc-dhcp-server has no reload; it only reads dhcpd.conf on start
+    return [['systemctl', 'restart', 'isc-dhcp-server']]
+
+def _pppoe_actions(changed, dependency_applied):
+    # pppd reads the options file and runs the session hooks for every new
+    # session, so changes to those need no restart and subscribers stay connected.
+    if 'start_pppoe.sh' in changed or dependency_applied:
+        return [['bash', installed_path(os.path.join(APP_ETC_DIR, 'start_pppoe.sh'))]]
+    return []
+
+def _hostapd_actions(changed, dependency_applied):
+    generated = os.path.join(config_service.GENERATED_DIR, 'hostapd.conf')
+    if not os.path.exists(generated) or os.path.getsize(generated) == 0:
+        # No AP configured
+        return [['systemctl', 'stop', 'hostapd'], ['systemctl', 'disable', 'hostapd']]
+    if _is_active('hostapd'):
+        if dependency_applied:
+            # br0 was recreated, hostapd has to re-attach the AP to it
+            return [['systemctl', 'restart', 'hostapd']]
+        # hostapd re-reads its config on SIGHUP without dropping the bridge
+        return [['systemctl', 'reload', 'hostapd']]
+    return [['systemctl', 'unmask', 'hostapd'], ['systemctl', 'enable', 'hostapd'], ['systemctl', 'start', 'hostapd']]
+
+def _loadbalance_actions(changed, dependency_applied):
+    return [['bash', installed_path(os.path.join(APP_ETC_DIR, 'setup_loadbalance.sh'))]]
+
+def _firewall_actions(changed, dependency_applied):
+    return [['bash', installed_path(os.path.join(APP_ETC_DIR, 'setup_firewall.sh'))]]
+
+def _tuning_actions(changed, dependency_applied):
+    return [['bash', installed_path(os.path.join(APP_ETC_DIR, 'setup_tuning.sh'))]]
+
+def _conntrack_actions(changed, dependency_applied):
+    return [['bash', installed_path(os.path.join(APP_ETC_DIR, 'setup_conntrack.sh'))]]
+
+def _qos_actions(changed, dependency_applied):
+    # The hooks are picked up by the next PPPoE login; everything else goes
+    # through setup_qos.sh, which only sends the classes that changed.
+    if set(changed) <= {'qos-ip-up', 'qos-ip-down'} and not dependency_applied:
+        return []
+    return [['bash', installed_path(os.path.join(APP_ETC_DIR, 'setup_qos.sh'))]]
+
+# Applied in this order. 'files' maps generated artifacts to their installed path and mode;
+# 'actions' returns the commands activating a change; 'after' lists subsystems whose
+# activation also requires re-activating this one (e.g. netplan apply recreates br0,
+# which dhcpd and pppoe-server are bound to).
+SUBSYSTEMS = [
+    {
+        'name': 'netplan',
+        'files': [('01-netcfg.yaml', '/etc/netplan/01-netcfg.yaml', 0o600)],
+        'actions': _netplan_actions,
+        'after': [],
+    },
+    {
+        'name': 'dhcp',
+        'files': [
+            ('dhcpd.conf', '/etc/dhcp/dhcpd.conf', 0o644),
+            ('isc-dhcp-server', '/etc/default/isc-dhcp-server', 0o644),
+        ],
+        'actions': _dhcp_actions,
+        'after': ['netplan'],
+    },
+    {
+        'name': 'pppoe',
+        'files': [
+            ('pppoe-server-options', '/etc/ppp/pppoe-server-options', 0o644),
+            ('start_pppoe.sh', os.path.join(APP_ETC_DIR, 'start_pppoe.sh'), 0o755),
+            ('pppoe-ip-up', '/etc/ppp/ip-up.d/ubuntu-router-sessions', 0o755),
+            ('pppoe-ip-down', '/etc/ppp/ip-down.d/ubuntu-router-sessions', 0o755),
+        ],
+        'actions': _pppoe_actions,
+        'after': ['netplan'],
+    },
+    {
+        'name': 'hostapd',
+        'files': [('hostapd.conf', '/etc/hostapd/hostapd.conf', 0o644)],
+        'actions': _hostapd_actions,
+        'after': ['netplan'],
+    },
+    {
+        'name': 'loadbalance',
+        'files': [
+            ('loadbalance.nft', os.path.join(APP_ETC_DIR, 'loadbalance.nft'), 0o644),
+            ('setup_loadbalance.sh', os.path.join(APP_ETC_DIR, 'setup_loadbalance.sh'), 0o755)
+        ],
+        'actions': _loadbalance_actions,
+        'after': ['netplan'],
+    },
+    {
+        'name': 'firewall',
+        'files': [
+            ('firewall.nft', os.path.join(APP_ETC_DIR, 'firewall.nft'), 0o644),
+            ('setup_firewall.sh', os.path.join(APP_ETC_DIR, 'setup_firewall.sh'), 0o755)
+        ],
+        # netplan apply can bring up devices the flowtable was loaded without
+        'actions': _firewall_actions,
+        'after': ['netplan'],
+    },
+    {
+        'name': 'qos',
+        'files': [
+            ('qos-classes.tc', os.path.join(APP_ETC_DIR, 'qos-classes.tc'), 0o644),
+            ('qos.nft', os.path.join(APP_ETC_DIR, 'qos.nft'), 0o644),
+            ('qos-sessions', os.path.join(APP_ETC_DIR, 'qos-sessions'), 0o644),
+            ('setup_qos.sh', os.path.join(APP_ETC_DIR, 'setup_qos.sh'), 0o755),
+            ('qos-ip-up', '/etc/ppp/ip-up.d/ubuntu-router-qos', 0o755),
+            ('qos-ip-down', '/etc/ppp/ip-down.d/ubuntu-router-qos', 0o755),
+        ],
+        'actions': _qos_actions,
+        'after': ['netplan'],
+    },
+    {
+        'name': 'tuning',
+        'files': [('setup_tuning.sh', os.path.join(APP_ETC_DIR, 'setup_tuning.sh'), 0o755)],
+        'actions': _tuning_actions,
+        'after': [],
+    },
+    {
+        'name': 'conntrack',
+        'files': [
+            ('conntrack-sysctl.conf', '/etc/sysctl.d/90-ubuntu-router-conntrack.conf', 0o644),
+            ('conntrack-modprobe.conf', '/etc/modprobe.d/ubuntu-router-conntrack.conf', 0o644),
+            ('conntrack-modules.conf', '/etc/modules-load.d/ubuntu-router-conntrack.conf', 0o644),
+            ('setup_conntrack.sh', os.path.join(APP_ETC_DIR, 'setup_conntrack.sh'), 0o755)
+        ],
+        'actions': _conntrack_actions,
+        'after': [],
+    },
+]
+# The built-in list, for code that swaps SUBSYSTEMS out (tests, the benchmark fakes)
+DEFAULT_SUBSYSTEMS = tuple(SUBSYSTEMS)
+
+def installed_path(path):
+    return os.path.join(INSTALL_ROOT, path.lstrip('/'))
+
+def _files_differ(generated, installed):
+    if not os.path.exists(installed):
+        return True
+    try:
+        return not filecmp.cmp(generated, installed, shallow=False)
+    except OSError:
+        return True
+
+def _install_file(generated, installed, mode):
+    """
+    Copies a generated artifact into place atomically (temp file + rename).
+    """
+    target_dir = os.path.dirname(installed)
+    os.makedirs(target_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=target_dir, prefix='.ubuntu-router-')
+    try:
+        with os.fdopen(fd, 'wb') as dst, open(generated, 'rb') as src:
+            shutil.copyfileobj(src, dst)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, installed)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def _load_pending():
+    try:
+        with open(os.path.join(config_service.GENERATED_DIR, PENDING_STATE_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_pending(pending):
+    path = os.path.join(config_service.GENERATED_DIR, PENDING_STATE_FILE)
+    if not pending:
+        if os.path.exists(path):
+            os.unlink(path)
+        return
+    with open(path + '.tmp', 'w') as f:
+        json.dump(pending, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def _command(cmd):
+    # The service normally runs as root; fall back to non-interactive sudo otherwise
+    if hasattr(os, 'geteuid') and os.geteuid() != 0:
+        return ['sudo', '-n'] + cmd
+    return cmd
+
+def _run(cmd, log=None):
+    """
+    Runs one activation command and returns its result record.
+    If log is given, it is called as log(stream, line) for every output line as it arrives.
+    A command still running after COMMAND_TIMEOUT seconds is killed.
+    """
+    started = time.monotonic()
+    deadline = started + COMMAND_TIMEOUT
+    output = {'stdout': [], 'stderr': []}
+    try:
+        proc = subprocess.Popen(_command(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        if log:
+            log('stderr', str(e))
+        return {
+            'cmd': ' '.join(cmd),
+            'returncode': 127,
+            'stdout': '',
+            'stderr': str(e),
+            'duration': round(time.monotonic() - started, 3),
+        }
+
+    # Read both pipes unbuffered and hand out complete lines in arrival order
+    partial = {'stdout': b'', 'stderr': b''}
+    with selectors.DefaultSelector() as selector:
+        selector.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+        selector.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # Daemons started by the command may keep the pipes open; stop reading them as well
+                proc.kill()
+                line = f'Timed out after {COMMAND_TIMEOUT} s'
+                output['stderr'].append(line + '\n')
+                if log:
+                    log('stderr', line)
+                break
+            for key, _events in selector.select(remaining):
+                stream = key.data
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    lines = [partial[stream]] if partial[stream] else []
+                    partial[stream] = b''
+                else:
+                    lines = (partial[stream] + chunk).split(b'\n')
+                    partial[stream] = lines.pop()
+                for raw in lines:
+                    line = raw.decode('utf-8', 'replace')
+                    output[stream].append(line + '\n')
+                    if log:
+                        log(stream, line)
+    proc.stdout.close()
+    proc.stderr.close()
+    returncode = proc.wait()
+
+    return {
+        'cmd': ' '.join(cmd),
+        'returncode': returncode,
+        'stdout': ''.join(output['stdout']),
+        'stderr': ''.join(output['stderr']),
+        'duration': round(time.monotonic() - started, 3),
+    }
+
+def plan_changes(force=False):
+    """
+    Compares the generated artifacts with the installed files.
+    Returns {subsystem name: [changed artifact names]} for every subsystem.
+    Artifacts of a subsystem whose last activation failed count as changed.
+    """
+    plan = {}
+    pending = _load_pending()
+    for subsystem in SUBSYSTEMS:
+        changed = []
+        retry = pending.get(subsystem['name'], [])
+        for name, target, _mode in subsystem['files']:
+            generated = os.path.join(config_service.GENERATED_DIR, name)
+            if not os.path.exists(generated):
+                continue
+            if force or name in retry or _files_differ(generated, installed_path(target)):
+                changed.append(name)
+        plan[subsystem['name']] = changed
+    return plan
+
+def apply_changes(force=False, log=None):
+    """
+    Installs the changed artifacts and reloads/restarts only the affected subsystems.
+    log(stream, line), if given, receives progress and command output as it happens.
+    Returns a per-subsystem report:
+    [{'name', 'status': 'unchanged'|'applied'|'failed', 'files', 'actions', 'duration'}]
+    """
+    config_service.reconcile_installed()
+    plan = plan_changes(force=force)
+    pending = _load_pending()
+    applied = set()
+    report = []
+    if log:
+        # Entries the generators left out are not installed either; say so with every apply
+        for message in config_service.generator_warnings():
+            log('stderr', f'[generate] {message}')
+
+    for subsystem in SUBSYSTEMS:
+        name = subsystem['name']
+        changed = plan[name]
+        dependency_applied = any(dep in applied for dep in subsystem['after'])
+        entry = {'name': name, 'status': 'unchanged', 'files': changed, 'actions': [], 'duration': 0.0}
+        report.append(entry)
+        if not changed and not dependency_applied:
+            continue
+
+        started = time.monotonic()
+        if log:
+            log('info', f"[{name}] changed: {', '.join(changed) or 'dependency applied'}")
+        # Recorded before anything is installed, so a failure (or a crash) is retried by the next apply
+        # (all of its files when only a dependency was applied)
+        pending[name] = sorted(set(pending.get(name, [])) | set(changed or [f[0] for f in subsystem['files']]))
+        _save_pending(pending)
+        try:
+            for artifact, target, mode in subsystem['files']:
+                if artifact in changed:
+                    _install_file(os.path.join(config_service.GENERATED_DIR, artifact), installed_path(target), mode)
+
+            commands = subsystem['actions'](changed, dependency_applied)
+
+            entry['status'] = 'applied'
+            for cmd in commands:
+                if log:
+                    log('info', f"[{name}] $ {' '.join(cmd)}")
+                result = _run(cmd, log)
+                entry['actions'].append(result)
+                if result['returncode'] != 0:
+                    entry['status'] = 'failed'
+                    break
+        except OSError as e:
+            entry['status'] = 'failed'
+            entry['error'] = str(e)
+            if log:
+                log('stderr', f"[{name}] {e}")
+
+        entry['duration'] = round(time.monotonic() - started, 3)
+        metrics_service.observe_apply(entry)
+        if entry['status'] == 'applied':
+            applied.add(name)
+            pending.pop(name, None)
+            _save_pending(pending)
+
+    return report
+
+def summarize(report):
+    """
+    One-line human readable summary of an apply report.
+    """
+    parts = []
+    for entry in report:
+        if entry['status'] == 'unchanged':
+            continue
+        actions = ', '.join(a['cmd'] for a in entry['actions']) or 'files only'
+        parts.append(f"{entry['name']} {entry['status']} ({actions}; {entry['duration']:.1f}s)")
+    return '; '.join(parts) if parts else 'Nothing changed.'
+
+if __name__ == '__main__':
+    def _print_line(stream, line):
+        print(line, file=sys.stderr if stream == 'stderr' else sys.stdout, flush=True)
+
+    report = apply_changes(force='--force' in sys.argv, log=_print_line)
+    print(summarize(report))
+    sys.exit(1 if any(entry['status'] == 'failed' for entry in report) else 0)
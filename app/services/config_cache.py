@@ -0,0 +1,175 @@
+import threading
+
+
+def _readonly(self, *args, **kwargs):
+    raise TypeError("Cached config is read-only. Use load_config(mutable=True) to get an editable copy.")
+
+
+class FrozenDict(dict):
+    """
+    Read-only dict handed out by the config cache.
+    It is still a real dict, so Jinja templates, json.dump and isinstance checks keep working.
+    """
+    __slots__ = ()
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    __ior__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class FrozenList(list):
+    """
+    Read-only list counterpart of FrozenDict.
+    """
+    __slots__ = ()
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    __iadd__ = _readonly
+    __imul__ = _readonly
+    append = _readonly
+    extend = _readonly
+    insert = _readonly
+    pop = _readonly
+    remove = _readonly
+    clear = _readonly
+    sort = _readonly
+    reverse = _readonly
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def freeze(value):
+    """
+    Recursively converts dicts/lists into their read-only counterparts.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """
+    Recursively converts a (possibly frozen) config into plain, editable dicts/lists.
+    """
+    if isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [thaw(v) for v in value]
+    return value
+
+
+class EditableConfig(dict):
+    """
+    Editable copy handed out by load_config(mutable=True). Remembers the config
+    and revision it was copied from, so save_config() can write only what was
+    edited and leave concurrent saves of other sections alone.
+    """
+
+    def __init__(self, base, revision):
+        super().__init__(thaw(base))
+        self.base = base
+        self.revision = revision
+
+
+class ConfigCache:
+    """
+    Keeps the parsed settings in memory and reloads them only when the store
+    changed. Every gunicorn worker has its own cache, but since the key is the
+    store's change token (the revision, or the JSON file's inode, size and mtime)
+    a save from any worker is noticed by all others on their next request.
+    """
+
+    _NOT_LOADED = object()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backend = None
+        self._key = self._NOT_LOADED
+        self._value = FrozenDict()
+        self._revision = 0
+        self.hits = 0
+        self.misses = 0
+        # Optional callback(hit) for metrics
+        self.observer = None
+
+    def get(self, backend):
+        """
+        Returns (read-only config, revision) from backend (a config_store
+        backend), reading the store only on a miss.
+        """
+        key = backend.key()
+        with self._lock:
+            hit = backend is self._backend and key == self._key
+            if hit:
+                self.hits += 1
+                value, revision = self._value, self._revision
+            else:
+                self.misses += 1
+        if self.observer:
+            self.observer(hit)
+        if hit:
+            return value, revision
+
+        value, revision = backend.read()
+        frozen = freeze(value)
+        with self._lock:
+            self._backend = backend
+            self._key = key
+            self._value = frozen
+            self._revision = revision
+        return frozen, revision
+
+    def store(self, backend, config, revision):
+        """
+        Primes the cache with a config that was just written to backend as
+        revision. The key comes from that write, not from the store as it is
+        now: another worker may have saved since, and its key must not end up
+        next to this config.
+        """
+        frozen = freeze(config)
+        key = backend.key_at(revision)
+        if key is None:
+            return frozen
+        with self._lock:
+            self._backend = backend
+            self._key = key
+            self._value = frozen
+            self._revision = revision
+        return frozen
+
+    def invalidate(self):
+        with self._lock:
+            self._key = self._NOT_LOADED
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits / total) if total else 0.0,
+            }
@@ -1,34 +1,458 @@
+import contextlib
+import filecmp
+import hashlib
+import inspect
+import ipaddress
 import json
 import os
+import re
+import tempfile
+import threading
+import time
+from app.services import config_store, conntrack_service, dhcp_service, green, json_patch, metrics_service, pppoe_sessions, qos_service, template_service, tuning_service, yaml_emitter
+from app.services.config_cache import ConfigCache, EditableConfig, thaw
+
+try:
+    import fcntl
+except ImportError:  # Windows dev environment: single process only
+    fcntl = None
 
 CONFIG_FILE = 'config/settings.json'
+# 'sqlite' or 'json' (the whole config in CONFIG_FILE, as before)
+CONFIG_BACKEND = os.environ.get('UBUNTU_ROUTER_CONFIG_BACKEND', 'sqlite')
+# SQLite database; None puts it next to CONFIG_FILE. CONFIG_FILE is imported into it on first start.
+CONFIG_DB = None
 GENERATED_DIR = 'generated'
 
-# Ensure directories exist
-os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
-os.makedirs(GENERATED_DIR, exist_ok=True)
+# Parsed settings, shared by all requests handled by this worker process
+_config_cache = ConfigCache()
+_config_cache.observer = metrics_service.observe_config_cache
+_stores = {}
 
-def load_config():
-    if not os.path.exists(CONFIG_FILE):
-        return {}
+def init_dirs():
+    """
+    Creates the settings and generated directories (create_app calls this;
+    importing the module has no side effects).
+    """
+    os.makedirs(os.path.dirname(CONFIG_FILE) or '.', exist_ok=True)
+    os.makedirs(GENERATED_DIR, exist_ok=True)
+
+def get_store():
+    """
+    The config_store backend selected by CONFIG_BACKEND for the current paths.
+    """
+    if CONFIG_BACKEND == 'json':
+        spec = ('json', CONFIG_FILE)
+    else:
+        spec = ('sqlite', CONFIG_DB or os.path.splitext(CONFIG_FILE)[0] + '.db', CONFIG_FILE)
+    store = _stores.get(spec)
+    if store is None:
+        if spec[0] == 'json':
+            store = config_store.JsonStore(CONFIG_FILE)
+        else:
+            store = config_store.SqliteStore(spec[1], import_path=CONFIG_FILE)
+        _stores[spec] = store
+    return store
+
+def load_config(mutable=False):
+    """
+    Returns the stored settings.
+    By default this is a read-only view of the cached config; pass mutable=True
+    to get a private copy that can be edited and handed to save_config().
+    """
+    config, revision = _config_cache.get(get_store())
+    if mutable:
+        return EditableConfig(config, revision)
+    return config
+
+def config_revision():
+    """
+    Revision number of the stored settings; every save increments it.
+    """
+    return _config_cache.get(get_store())[1]
+
+def config_cache_stats():
+    """
+    Returns hit/miss counters of this worker's config cache.
+    """
+    return _config_cache.stats()
+
+def save_config(config):
+    """
+    Stores the settings and regenerates the artifacts affected by the change.
+    A config from load_config(mutable=True) writes only the sections and
+    collection items edited since it was loaded, so a concurrent save of
+    another page is kept; a plain dict replaces the whole config.
+    Returns the names of the files in GENERATED_DIR whose content changed.
+    """
+    store = get_store()
+    base = getattr(config, 'base', None)
+    with _generation_lock():
+        if base is None:
+            revision = _replace_config(store, config)
+            merged = True
+        else:
+            sections, items, order = config_store.diff(base, config)
+            if not sections and not items:
+                return _regenerate_locked(store)
+            revision = store.update(sections, items, order)
+            # Nobody else saved since this copy was loaded: the store now holds exactly config
+            merged = revision == config.revision + 1
+
+        if merged:
+            frozen = _config_cache.store(store, config, revision)
+            if base is not None:
+                # Further edits of the same copy are diffed against what is stored now
+                config.base, config.revision = frozen, revision
+        return _regenerate_locked(store)
+
+def _replace_config(store, config):
+    # The whole config as one new revision: sections missing from config are deleted
+    current, _revision = _config_cache.get(store)
+    sections = {name: config_store.DELETED for name in current if name not in config}
+    sections.update(config)
+    return store.update(sections)
+
+def save_config_section(name, value):
+    """
+    Replaces one top-level section in a single transaction, leaving the rest of
+    the stored config untouched, and regenerates what depends on it.
+    Returns the names of the files in GENERATED_DIR whose content changed.
+    """
+    store = get_store()
+    with _generation_lock():
+        store.update({name: value})
+        return _regenerate_locked(store)
+
+@contextlib.contextmanager
+def _generation_lock():
+    """
+    Serializes config writes and regeneration across worker processes; the
+    artifacts and the generator state in GENERATED_DIR are shared, and the
+    files updated in place have to follow the writes in the same order.
+    """
+    # Scripts save without create_app(), so the directory may not exist yet
+    os.makedirs(GENERATED_DIR, exist_ok=True)
+    with open(os.path.join(GENERATED_DIR, '.generate.lock'), 'a') as f:
+        if fcntl:
+            green.blocking(fcntl.flock, f, fcntl.LOCK_EX)
+        yield
+
+def _regenerate_locked(store):
+    # The latest revision is read under the lock, so when two workers save at
+    # once the one generating last also generates from the newest config
+    config, revision = _config_cache.get(store)
+    changed = regenerate(config)
+    _record_artifacts(store, revision)
+    _reconcile_installed(config)
+    return changed
+
+def _reconcile_installed(config):
+    # chap-secrets is edited in place rather than installed by apply (pppd
+    # reads it on every login, and hand-written lines in it are kept). It is
+    # not a generator output either: a rollback restores the generator state,
+    # which would skip it. So it follows every write here instead.
+    from app.services import subscriber_service
+    subscriber_service.reconcile(config)
+
+def reconcile_installed():
+    """
+    Brings the files updated in place (chap-secrets) in line with the stored
+    config. Apply calls this first, so an update that a crash or an error cut
+    off after its config was saved is caught up.
+    """
+    store = get_store()
+    with _generation_lock():
+        _reconcile_installed(_config_cache.get(store)[0])
+
+def _history_store():
+    store = get_store()
+    if not store.keeps_history:
+        raise LookupError('Revision history needs the sqlite config backend')
+    return store
+
+def list_revisions(offset=0, limit=50):
+    """
+    Saved revisions, newest first (see SqliteStore.revisions).
+    """
+    return _history_store().revisions(offset, limit)
+
+def config_at(revision):
+    """
+    The config as saved in revision. Raises KeyError if it is not kept.
+    """
+    return _history_store().config_at(revision)
+
+def diff_revisions(old, new=None):
+    """
+    JSON patch from revision old to revision new (default: the current config).
+    """
+    store = _history_store()
+    target = store.config_at(new) if new is not None else thaw(load_config())
+    return json_patch.make_patch(store.config_at(old), target)
+
+def _artifact_names():
+    names = [GENERATOR_STATE_FILE, GENERATOR_WARNINGS_FILE]
+    for gen in GENERATORS:
+        names.extend(gen['outputs'] + gen['state'])
+    return names
+
+def _record_artifacts(store, revision):
+    # Content-addressed, so unchanged files cost one index row per revision
+    if not store.keeps_history or not revision:
+        return
+    files = {}
+    for name in _artifact_names():
+        try:
+            with open(os.path.join(GENERATED_DIR, name), 'rb') as f:
+                files[name] = f.read()
+        except OSError:
+            continue
+    store.record_artifacts(revision, files)
+
+def rollback_config(revision):
+    """
+    Restores the config of an earlier revision, saved as a new revision, and
+    the generated files recorded with it. Artifacts that revision did not have
+    are removed; the bookkeeping files (dot files) stay. The generator state
+    is restored too, so regeneration only runs generators whose code changed
+    since, and chap-secrets gets the accounts of that revision back. All of it
+    happens under the generation lock, so a concurrent save cannot regenerate
+    in between.
+    Returns (new revision, names of the artifacts that changed).
+    Raises KeyError if the revision is not kept.
+    """
+    store = _history_store()
+    target = store.config_at(revision)
+    _recorded, manifest = store.artifacts_at(revision)
+    with _generation_lock():
+        restored = _restore_artifacts(store, manifest)
+        new_revision = _replace_config(store, target)
+        _config_cache.store(store, target, new_revision)
+        changed = _regenerate_locked(store)
+    return new_revision, sorted(set(restored) | set(changed))
+
+def _restore_artifacts(store, manifest):
+    # Returns the names of the artifacts that were rewritten or removed
+    changed = []
+    for name, digest in manifest.items():
+        content = store.blob(digest)
+        path = os.path.join(GENERATED_DIR, name)
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == content:
+                    continue
+        except OSError:
+            pass
+        if content is None:
+            continue
+        tmp_path = path + '.rollback'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+        if not name.startswith('.'):  # generator state, not an artifact
+            changed.append(name)
+    if not manifest:
+        # Nothing was recorded with that revision: keep what is there
+        return changed
+
+    # Generator outputs the revision did not have (a generator added since)
+    # would otherwise be installed with the old config. The warnings describe
+    # the outputs and go with them. Generator state files (class ids, input
+    # hashes) and apply's bookkeeping stay, as does anything that is not ours.
+    removable = [name for gen in GENERATORS for name in gen['outputs']] + [GENERATOR_WARNINGS_FILE]
+    for name in removable:
+        path = os.path.join(GENERATED_DIR, name)
+        if name in manifest or not os.path.isfile(path):
+            continue
+        os.unlink(path)
+        if not name.startswith('.'):
+            changed.append(name)
+    return changed
+
+# Artifact generators, registered with the config sections they read and the files they write
+GENERATORS = []
+# Input hashes of the last run of each generator, kept next to the artifacts
+GENERATOR_STATE_FILE = '.inputs.json'
+# Entries each generator skipped on its last run (see warn()); they stay there
+# until the generator runs again, so every apply can still show them
+GENERATOR_WARNINGS_FILE = '.warnings.json'
+_collecting = threading.local()
+
+def generator(sections, outputs, state=(), templates=()):
+    """
+    Registers an artifact generator.
+    sections: top-level config keys the generator reads.
+    outputs: file names (in GENERATED_DIR) the generator writes.
+    state: files in GENERATED_DIR the generator keeps between runs (not installed).
+    templates: template_service templates it renders; editing one reruns the generator.
+    """
+    def register(func):
+        GENERATORS.append({'func': func, 'sections': tuple(sections), 'outputs': tuple(outputs), 'state': tuple(state),
+                           'templates': tuple(templates)})
+        return func
+    return register
+
+def warn(message):
+    """
+    Reports a problem a generator worked around (typically an invalid entry it
+    left out) instead of failing. Collected by regenerate() for the apply log.
+    """
+    messages = getattr(_collecting, 'messages', None)
+    if messages is not None:
+        messages.append(message)
+
+def generator_warnings():
+    """
+    Warnings of the last run of every generator, in generator order.
+    """
+    warnings = _load_json(GENERATOR_WARNINGS_FILE)
+    return [message for gen in GENERATORS for message in warnings.get(gen['func'].__name__, [])]
+
+def section_hash(config, section):
+    """
+    Content hash of one config section (key order does not matter).
+    """
+    data = json.dumps(config.get(section), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def _source_hash(path):
+    if path not in _source_hashes:
+        with open(path, 'rb') as f:
+            _source_hashes[path] = hashlib.sha256(f.read()).hexdigest()
+    return _source_hashes[path]
+
+_source_hashes = {}
+_code_fingerprints = {}
+
+def _code_modules(func, modules, seen):
+    # Modules of this app the function uses, through module-level helpers of its own module too
+    if func in seen:
+        return
+    seen.add(func)
+    codes = [func.__code__]
+    while codes:
+        code = codes.pop()
+        codes.extend(c for c in code.co_consts if hasattr(c, 'co_code'))
+        for name in code.co_names:
+            value = func.__globals__.get(name)
+            if inspect.ismodule(value) and value.__name__.startswith('app.') and getattr(value, '__file__', None):
+                modules.add(value.__file__)
+            elif inspect.isfunction(value) and value.__module__ == func.__module__:
+                _code_modules(value, modules, seen)
+
+def _code_fingerprint(func):
+    # Changing a generator's code must invalidate its previous output as well:
+    # the source of its module (helpers included) and of the services it calls,
+    # so an upgrade that only touches a helper still regenerates
+    if func not in _code_fingerprints:
+        modules = {func.__code__.co_filename}
+        _code_modules(func, modules, set())
+        _code_fingerprints[func] = hashlib.sha256(
+            ''.join(_source_hash(path) for path in sorted(modules)).encode('utf-8')).hexdigest()
+    return _code_fingerprints[func]
+
+def _load_json(name):
+    # Generator bookkeeping in GENERATED_DIR ({generator: ...}); missing or corrupt counts as empty
     try:
-        with open(CONFIG_FILE, 'r') as f:
+        with open(os.path.join(GENERATED_DIR, name), 'r') as f:
             return json.load(f)
-    except:
+    except (OSError, ValueError):
         return {}
 
-def save_config(config):
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=4)
-    
-    # Auto-generate system configs on save
-    generate_netplan_config(config)
-    generate_dhcp_config(config)
-    generate_dhcp_default_config(config)
-    generate_pppoe_config(config)
-    generate_loadbalance_script(config)
-    generate_hostapd_config(config)
+def _save_json(name, data):
+    path = os.path.join(GENERATED_DIR, name)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def regenerate(config, force=False):
+    """
+    Runs only the generators whose input sections changed since their last run
+    (or whose output files are missing). Returns the list of artifact file names
+    whose content actually changed.
+    """
+    hashes = {}
+    state = _load_json(GENERATOR_STATE_FILE)
+    new_state = dict(state)
+    warnings = _load_json(GENERATOR_WARNINGS_FILE)
+    new_warnings = dict(warnings)
+    changed = []
 
+    for gen in GENERATORS:
+        func = gen['func']
+        for section in gen['sections']:
+            if section not in hashes:
+                hashes[section] = section_hash(config, section)
+        input_hash = hashlib.sha256(
+            (_code_fingerprint(func) + ''.join(template_service.fingerprint(t) for t in gen['templates'])
+             + ''.join(hashes[s] for s in gen['sections'])).encode('utf-8')
+        ).hexdigest()
+
+        outputs_exist = all(os.path.exists(os.path.join(GENERATED_DIR, name)) for name in gen['outputs'])
+        if not force and outputs_exist and state.get(func.__name__) == input_hash:
+            continue
+
+        started = time.perf_counter()
+        _collecting.messages = []
+        try:
+            changed.extend(func(config) or [])
+        finally:
+            messages, _collecting.messages = _collecting.messages, None
+        metrics_service.observe_generator(func.__name__, time.perf_counter() - started)
+        new_state[func.__name__] = input_hash
+        new_warnings.pop(func.__name__, None)
+        if messages:
+            new_warnings[func.__name__] = messages
+
+    # Written even when empty, so every revision's artifacts record it
+    if new_warnings != warnings or not os.path.exists(os.path.join(GENERATED_DIR, GENERATOR_WARNINGS_FILE)):
+        _save_json(GENERATOR_WARNINGS_FILE, new_warnings)
+    if new_state != state:
+        _save_json(GENERATOR_STATE_FILE, new_state)
+    return changed
+
+def _write_generated(filename, content):
+    """
+    Writes a generated artifact. If the file already has exactly this content it is
+    left untouched (keeping its mtime). Returns True if the file changed.
+    """
+    path = os.path.join(GENERATED_DIR, filename)
+    try:
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    with open(path, 'w') as f:
+        f.write(content)
+    return True
+
+def _write_generated_stream(filename, chunks):
+    """
+    Like _write_generated, for large artifacts produced piece by piece: chunks
+    are written straight to a temp file, which only replaces the artifact if
+    the content differs. Returns True if the file changed.
+    """
+    path = os.path.join(GENERATED_DIR, filename)
+    fd, tmp_path = tempfile.mkstemp(dir=GENERATED_DIR, prefix=f'.{filename}.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(chunks)
+        if os.path.exists(path) and filecmp.cmp(tmp_path, path, shallow=False):
+            os.unlink(tmp_path)
+            return False
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
+@generator(sections=['network'], outputs=['01-netcfg.yaml'])
 def generate_netplan_config(config):
     """
     Generates a Netplan YAML configuration based on the stored settings.
@@ -158,67 +582,43 @@ def generate_netplan_config(config):
          if not has_bridge:
             del netplan['network']['bridges']
     
-    # Write to file
-    with open(os.path.join(GENERATED_DIR, '01-netcfg.yaml'), 'w') as f:
-        f.write("# This file is generated by Ubuntu Router UI\n")
-        f.write(json.dumps(netplan, indent=2))
+    # Canonical YAML, so the same settings always give the same file
+    lines = yaml_emitter.dump(netplan, header='# This file is generated by Ubuntu Router UI\n')
+    return ['01-netcfg.yaml'] if _write_generated_stream('01-netcfg.yaml', lines) else []
 
+@generator(sections=['network'], outputs=['hostapd.conf'], templates=['hostapd.conf.j2'])
 def generate_hostapd_config(config):
     """
     Generates hostapd.conf for WiFi AP mode
     """
-    network = config.get('network', {})
-    content = ""
-    
-    for iface, settings in network.items():
-        # Only for LAN role with SSID set (implies AP mode)
+    access_points = []
+    for iface, settings in config.get('network', {}).items():
+        # Only for LAN role with SSID set (implies AP mode); WPA2 if a psk is set, else open
         if settings.get('role') == 'lan' and settings.get('ssid'):
-            content += f"interface={iface}\n"
-            content += f"bridge=br0\n"
-            content += f"driver=nl80211\n"
-            content += f"ssid={settings.get('ssid')}\n"
-            content += f"hw_mode=g\n"
-            content += f"channel={settings.get('channel', '6')}\n"
-            
-            # Check security type (default to WPA2 if psk is present, else Open)
-            psk = settings.get('psk')
-            if psk:
-                content += f"wpa=2\n"
-                content += f"wpa_passphrase={psk}\n"
-                content += f"wpa_key_mgmt=WPA-PSK\n"
-                content += f"rsn_pairwise=CCMP\n"
-            else:
-                # Open security
-                content += f"# Open Security (No WPA/WPA2)\n"
-            
-            content += "\n"
-            
-    with open(os.path.join(GENERATED_DIR, 'hostapd.conf'), 'w') as f:
-        f.write(content)
+            access_points.append({
+                'iface': iface,
+                'ssid': settings.get('ssid'),
+                'channel': settings.get('channel', '6'),
+                'psk': settings.get('psk')
+            })
+
+    content = template_service.render('hostapd.conf.j2', access_points=access_points)
+    return ['hostapd.conf'] if _write_generated('hostapd.conf', content) else []
 
+@generator(sections=['dhcp', 'network', 'dhcp_reservations'], outputs=['dhcpd.conf'], templates=['dhcpd.conf.j2'])
 def generate_dhcp_config(config):
     """
-    Generates ISC DHCP Server config
+    Generates ISC DHCP Server config: one subnet per enabled scope (derived
+    from the serving interface's address) followed by its static reservations.
     """
-    dhcp_settings = config.get('dhcp', {})
-    content = "default-lease-time 600;\nmax-lease-time 7200;\nauthoritative;\n\n"
-    
-    for iface, settings in dhcp_settings.items():
-        if settings.get('enabled'):
-            start = settings.get('start')
-            end = settings.get('end')
-            # Simplified subnet calculation (assuming /24)
-            if start:
-                subnet = start.rsplit('.', 1)[0] + '.0'
-                content += f"subnet {subnet} netmask 255.255.255.0 {{\n"
-                content += f"  range {start} {end};\n"
-                content += f"  option routers {subnet.rsplit('.', 1)[0] + '.1'};\n" # Guessing router IP
-                content += f"  option domain-name-servers 8.8.8.8, 8.8.4.4;\n"
-                content += f"}}\n\n"
-
-    with open(os.path.join(GENERATED_DIR, 'dhcpd.conf'), 'w') as f:
-        f.write(content)
+    scopes, errors = dhcp_service.build_scopes(config)
+    store, reservation_errors = dhcp_service.load_reservations(config, scopes)
+    for error in errors + reservation_errors:
+        warn(f"DHCP: skipped {error}")
+
+    return ['dhcpd.conf'] if _write_generated_stream('dhcpd.conf', dhcp_service.render_dhcpd_conf(scopes, store)) else []
 
+@generator(sections=['dhcp', 'network'], outputs=['isc-dhcp-server'], templates=['isc-dhcp-server.j2'])
 def generate_dhcp_default_config(config):
     """
     Generates /etc/default/isc-dhcp-server file to specify interfaces
@@ -246,87 +646,528 @@ def generate_dhcp_default_config(config):
             else:
                 interfaces.append(iface)
             
-    iface_str = " ".join(interfaces)
-    content = f'INTERFACESv4="{iface_str}"\n'
-    content += 'INTERFACESv6=""\n'
-    
-    with open(os.path.join(GENERATED_DIR, 'isc-dhcp-server'), 'w') as f:
-        f.write(content)
+    content = template_service.render('isc-dhcp-server.j2', interfaces=interfaces)
+    return ['isc-dhcp-server'] if _write_generated('isc-dhcp-server', content) else []
+
+# rp-pppoe's own default for -N
+PPPOE_DEFAULT_SESSIONS = 64
+PPPOE_MAX_INSTANCES = 16
+
+def parse_cpus(value):
+    """
+    '0-3,6' -> [0, 1, 2, 3, 6]. Empty means: spread over all CPUs at runtime.
+    """
+    cpus = []
+    for part in str(value or '').replace(' ', '').split(','):
+        if not part:
+            continue
+        low, _, high = part.partition('-')
+        cpus.extend(range(int(low), int(high or low) + 1))
+    return cpus
+
+def plan_pppoe_instances(settings):
+    """
+    Splits one interface's remote address pool (remote_start..remote_end) into
+    contiguous chunks, one per pppoe-server instance. Returns a list of dicts with
+    index, remote_start, sessions (-N) and cpu (None = pick at runtime).
+    The optional max_sessions caps the interface total. Raises ValueError.
+    """
+    local_ip = ipaddress.IPv4Address(str(settings.get('local_ip') or '').strip())
+    start = ipaddress.IPv4Address(str(settings.get('remote_start') or '').strip())
+    instances = max(1, min(int(settings.get('instances') or 1), PPPOE_MAX_INSTANCES))
+    max_sessions = int(settings.get('max_sessions') or 0)
+    cpus = parse_cpus(settings.get('cpus'))
+
+    if settings.get('remote_end'):
+        end = ipaddress.IPv4Address(str(settings['remote_end']).strip())
+        if end < start:
+            raise ValueError(f'remote end {end} is before remote start {start}')
+        if start <= local_ip <= end:
+            raise ValueError(f'local IP {local_ip} is inside the remote pool')
+        pool = int(end) - int(start) + 1
+    else:
+        # No end given: what pppoe-server did before, sized by the session limit
+        pool = max_sessions or PPPOE_DEFAULT_SESSIONS * instances
+    total = min(pool, max_sessions) if max_sessions else pool
+    if total < instances:
+        raise ValueError(f'{total} sessions cannot be split over {instances} instances')
+
+    plan = []
+    offset = 0
+    for index in range(instances):
+        # Each instance owns a disjoint slice of the pool; its -N stays inside it
+        size = pool // instances + (1 if index < pool % instances else 0)
+        sessions = total // instances + (1 if index < total % instances else 0)
+        plan.append({
+            'index': index,
+            'remote_start': str(start + offset),
+            'sessions': min(sessions, size),
+            'cpu': cpus[index % len(cpus)] if cpus else None
+        })
+        offset += size
+    return plan
 
+@generator(sections=['pppoe'], outputs=['pppoe-server-options', 'start_pppoe.sh', 'pppoe-ip-up', 'pppoe-ip-down'],
+           templates=['pppoe-server-options.j2', 'start_pppoe.sh.j2'])
 def generate_pppoe_config(config):
     """
     Generates PPPoE Server config (rp-pppoe) and startup script
     """
     pppoe_settings = config.get('pppoe', {})
-    
-    # 1. Generate options file
-    options_content = "# PPPoE Server Configuration\n"
-    options_content += "require-chap\n"
-    options_content += "lcp-echo-interval 10\n"
-    options_content += "lcp-echo-failure 2\n"
-    
-    # Use the first DNS found (limitation of global options file)
-    dns_set = False
-    for iface, settings in pppoe_settings.items():
-        if settings.get('enabled') and not dns_set:
-             options_content += f"ms-dns {settings.get('dns', '8.8.8.8')}\n"
-             dns_set = True
-             
-    with open(os.path.join(GENERATED_DIR, 'pppoe-server-options'), 'w') as f:
-        f.write(options_content)
-
-    # 2. Generate Startup Script
-    script_content = "#!/bin/bash\n# Start PPPoE Servers\n\n"
-    script_content += "killall pppoe-server 2>/dev/null\n\n"
-    
+    changed = []
+
+    # 1. Options file, shared by all servers
+    dns = next((settings.get('dns', '8.8.8.8') for settings in pppoe_settings.values() if settings.get('enabled')), None)
+    options = template_service.render('pppoe-server-options.j2', ipparam=pppoe_sessions.IPPARAM, dns=dns)
+    if _write_generated('pppoe-server-options', options):
+        changed.append('pppoe-server-options')
+
+    # 2. Startup script: the pppoe-server instances of every enabled interface
+    servers = []
     for iface, settings in pppoe_settings.items():
         if settings.get('enabled'):
-            local_ip = settings.get('local_ip')
-            remote_start = settings.get('remote_start')
-            # Assuming remote_end isn't strictly used by pppoe-server cli, it uses -N for count. 
-            # But usually we just pass -R remote_start. 
-            # pppoe-server -I <iface> -L <local> -R <remote_start> -O /etc/ppp/pppoe-server-options
-            
-            script_content += f"echo 'Starting PPPoE on {iface}...'\n"
-            script_content += f"pppoe-server -I {iface} -L {local_ip} -R {remote_start} -O /etc/ppp/pppoe-server-options\n"
-            
-    with open(os.path.join(GENERATED_DIR, 'start_pppoe.sh'), 'w') as f:
-        f.write(script_content)
+            try:
+                instances = plan_pppoe_instances(settings)
+            except ValueError as e:
+                warn(f"PPPoE: skipped {iface}: {e}")
+                continue
+            servers.append({
+                'iface': iface,
+                'local_ip': settings.get('local_ip'),
+                'kernel_mode': settings.get('kernel_mode', True),
+                'instances': instances
+            })
 
-def generate_loadbalance_script(config):
+    script = template_service.render('start_pppoe.sh.j2', servers=servers)
+    if _write_generated('start_pppoe.sh', script):
+        changed.append('start_pppoe.sh')
+
+    # 3. Session hooks, run by pppd for every subscriber login/logout
+    for kind in ('up', 'down'):
+        if _write_generated(f'pppoe-ip-{kind}', pppoe_sessions.hook_script(kind)):
+            changed.append(f'pppoe-ip-{kind}')
+    return changed
+
+# Policy routing layout for load balancing. Each WAN gets a slot: its own routing
+# table, a connmark value and two rule priorities. Slots stay fixed per interface
+# (stored in the loadbalance settings) so marks of existing connections stay valid.
+LB_MAX_WANS = 16
+LB_TABLE_BASE = 100
+LB_MARK_BASE = 0x100
+LB_FWMARK_PRIORITY = 9000
+LB_SOURCE_PRIORITY = 10000
+LB_NFT_TABLE = 'ubr_lb'
+_IFACE_RE = re.compile(r'^[A-Za-z0-9_.:@-]{1,15}$')
+
+def assign_lb_slots(lb_settings):
     """
-    Generates a shell script to configure routing for load balancing
+    Gives every load-balanced interface a stable slot (1..LB_MAX_WANS), keeping
+    the slots already stored and handing the lowest free one to new interfaces.
+    Updates lb_settings in place.
     """
+    used = {s.get('slot') for s in lb_settings.values() if s.get('slot')}
+    for iface in sorted(lb_settings):
+        settings = lb_settings[iface]
+        if settings.get('slot'):
+            continue
+        free = next((n for n in range(1, LB_MAX_WANS + 1) if n not in used), None)
+        if free is None:
+            continue
+        settings['slot'] = free
+        used.add(free)
+    return lb_settings
+
+def get_lb_wans(config):
+    """
+    Returns the enabled load-balanced WANs as dicts with
+    name, slot, table, mark and weight, ordered by slot.
+    """
+    network = config.get('network', {})
     lb_settings = config.get('loadbalance', {})
-    
-    # Check if load balancing is actually configured
-    has_lb = False
-    for iface, settings in lb_settings.items():
-        if settings.get('enabled'):
-            has_lb = True
-            break
-            
-    content = "#!/bin/bash\n# Load Balancing Setup\n\n"
-    
-    if has_lb:
-        # Only flush if we are actually configuring LB
-        # content += "ip rule flush\n" # Too dangerous for default
-        content += "# Note: ip rule flush disabled for safety. \n"
-        content += "# ip route flush cache\n\n"
-        
-        # This is a very simplified example of policy routing
-        for iface, settings in lb_settings.items():
-            if settings.get('enabled'):
-                weight = settings.get('weight')
-                content += f"# Interface {iface} weight {weight}\n"
-                # In reality:
-                # 1. Create routing tables
-                # 2. Add default routes to tables
-                # 3. Add ip rules
-                # 4. Add nexthop weights to default route
+    slots = assign_lb_slots({k: dict(v) for k, v in lb_settings.items()})
+
+    wans = []
+    for iface in sorted(lb_settings, key=lambda i: slots[i].get('slot') or LB_MAX_WANS + 1):
+        settings = lb_settings[iface]
+        slot = slots[iface].get('slot')
+        if not settings.get('enabled') or not slot or not _IFACE_RE.match(iface):
+            continue
+        if network.get(iface, {}).get('role') != 'wan':
+            continue
+        wans.append({
+            'name': iface,
+            'slot': slot,
+            'table': LB_TABLE_BASE + slot,
+            'mark': LB_MARK_BASE + slot,
+            'weight': max(1, min(int(settings.get('weight') or 1), 256))
+        })
+    return wans
+
+def _loadbalance_nft(wans):
+    lines = [
+        '# Generated by Ubuntu Router UI: connmark based flow stickiness for load balancing',
+        f'table ip {LB_NFT_TABLE} {{}}',
+        f'delete table ip {LB_NFT_TABLE}',
+    ]
+    if not wans:
+        return '\n'.join(lines) + '\n'
+
+    lines.append(f'table ip {LB_NFT_TABLE} {{')
+    lines.append('    chain prerouting {')
+    lines.append('        type filter hook prerouting priority mangle; policy accept;')
+    lines.append('        # Connections opened from the internet answer through the WAN they came in on')
+    for wan in wans:
+        lines.append(f'        iifname "{wan["name"]}" ct state new ct mark set {wan["mark"]:#x}')
+    lines.append('        # Every later packet of a connection follows the WAN it started on')
+    lines.append('        ct mark != 0 meta mark set ct mark')
+    lines.append('    }')
+    lines.append('    chain output {')
+    lines.append('        type route hook output priority mangle; policy accept;')
+    lines.append('        ct mark != 0 meta mark set ct mark')
+    lines.append('    }')
+    lines.append('    chain postrouting {')
+    lines.append('        type filter hook postrouting priority mangle; policy accept;')
+    lines.append('        # Remember which WAN the multipath route picked for a new connection')
+    for wan in wans:
+        lines.append(f'        ct mark 0 oifname "{wan["name"]}" ct mark set {wan["mark"]:#x}')
+    lines.append('    }')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+def _loadbalance_script(wans):
+    lines = [
+        '#!/bin/bash',
+        '# Load Balancing Setup (generated by Ubuntu Router UI)',
+        '# Builds every route and rule into one ip -batch transaction and loads the',
+        '# connmark rules with one nft -f, so traffic is never left half routed.',
+        '',
+        'DIR="$(cd "$(dirname "$0")" && pwd)"',
+        'BATCH="$(mktemp)"',
+        'trap \'rm -f "$BATCH"\' EXIT',
+        '',
+        'wan_gateway() {',
+        '    # $1 iface, $2 table. Current per-WAN route first, then the one networkd',
+        '    # installed in main, then the DHCP lease itself',
+        '    local gw',
+        '    gw=$(ip -4 route show table "$2" default 2>/dev/null | awk \'/via/ {print $3; exit}\')',
+        '    [ -n "$gw" ] || gw=$(ip -4 route show default dev "$1" 2>/dev/null | awk \'/via/ {print $3; exit}\')',
+        '    if [ -z "$gw" ] && [ -r "/sys/class/net/$1/ifindex" ]; then',
+        '        gw=$(sed -n \'s/^ROUTER=\\([0-9.]*\\).*/\\1/p\' "/run/systemd/netif/leases/$(cat "/sys/class/net/$1/ifindex")" 2>/dev/null)',
+        '    fi',
+        '    echo "$gw"',
+        '}',
+        '',
+        '# Remove the rules and routes of every slot (including WANs removed since the',
+        '# last run). Only entries that exist are listed so the batch runs without errors.',
+        f"ip -4 rule show | awk -F: '($1 > {LB_FWMARK_PRIORITY} && $1 <= {LB_FWMARK_PRIORITY + LB_MAX_WANS}) || "
+        f"($1 > {LB_SOURCE_PRIORITY} && $1 <= {LB_SOURCE_PRIORITY + LB_MAX_WANS}) {{print \"rule del priority \" $1}}' > \"$BATCH\"",
+        f'for TABLE in $(seq {LB_TABLE_BASE + 1} {LB_TABLE_BASE + LB_MAX_WANS}); do',
+        '    if [ -n "$(ip -4 route show table $TABLE 2>/dev/null)" ]; then',
+        '        echo "route flush table $TABLE" >> "$BATCH"',
+        '    fi',
+        'done',
+        '',
+    ]
+
+    if not wans:
+        lines.append('# No load balancing configured.')
+        lines.append("echo 'No load balancing rules to apply.'")
+        lines.append('nft -f "$DIR/loadbalance.nft" || exit 1')
+        lines.append('[ -s "$BATCH" ] && ip -batch "$BATCH"')
+        lines.append('exit 0')
+        return '\n'.join(lines) + '\n'
+
+    lines.append('# Spread flows by L4 hash and accept replies arriving on any WAN')
+    lines.append('sysctl -qw net.ipv4.fib_multipath_hash_policy=1')
+    lines.append('NEXTHOPS=""')
+    for wan in wans:
+        n = wan['slot']
+        name = wan['name']
+        lines.append('')
+        lines.append(f'# {name}: table {wan["table"]}, mark {wan["mark"]:#x}, weight {wan["weight"]}')
+        lines.append(f'sysctl -qw net.ipv4.conf.{name.replace(".", "/")}.rp_filter=2')
+        lines.append(f'GW_{n}=$(wan_gateway {name} {wan["table"]})')
+        lines.append(f"SRC_{n}=$(ip -4 -o addr show dev {name} 2>/dev/null | awk '{{split($4, a, \"/\"); print a[1]; exit}}')")
+        lines.append(f"NET_{n}=$(ip -4 route show dev {name} scope link proto kernel 2>/dev/null | awk '{{print $1; exit}}')")
+        lines.append(f'if [ -n "$GW_{n}" ] && [ -n "$SRC_{n}" ]; then')
+        lines.append('    cat >> "$BATCH" <<EOF')
+        lines.append(f'route replace ${{NET_{n}:-$GW_{n}}} dev {name} src $SRC_{n} table {wan["table"]}')
+        lines.append(f'route replace default via $GW_{n} dev {name} table {wan["table"]}')
+        lines.append(f'rule add fwmark {wan["mark"]:#x} table {wan["table"]} priority {LB_FWMARK_PRIORITY + n}')
+        lines.append(f'rule add from $SRC_{n} table {wan["table"]} priority {LB_SOURCE_PRIORITY + n}')
+        lines.append('EOF')
+        lines.append(f'    NEXTHOPS="$NEXTHOPS nexthop via $GW_{n} dev {name} weight {wan["weight"]}"')
+        lines.append('else')
+        lines.append(f"    echo 'Skipping {name}: no gateway or address yet' >&2")
+        lines.append('fi')
+
+    lines.append('')
+    lines.append('if [ -n "$NEXTHOPS" ]; then')
+    lines.append('    echo "route replace default scope global$NEXTHOPS" >> "$BATCH"')
+    lines.append('fi')
+    lines.append('echo "route flush cache" >> "$BATCH"')
+    lines.append('')
+    lines.append('nft -f "$DIR/loadbalance.nft" || exit 1')
+    lines.append('ip -batch "$BATCH" || exit 1')
+    lines.append("echo 'Load balancing rules applied.'")
+    return '\n'.join(lines) + '\n'
+
+@generator(sections=['loadbalance', 'network'], outputs=['setup_loadbalance.sh', 'loadbalance.nft'])
+def generate_loadbalance_script(config):
+    """
+    Generates the policy routing for weighted multi-WAN load balancing:
+    a routing table and source/fwmark rules per WAN, a weighted multipath
+    default route and connmark rules that keep each connection on its WAN.
+    """
+    wans = get_lb_wans(config)
+    changed = []
+    if _write_generated('loadbalance.nft', _loadbalance_nft(wans)):
+        changed.append('loadbalance.nft')
+    if _write_generated('setup_loadbalance.sh', _loadbalance_script(wans)):
+        changed.append('setup_loadbalance.sh')
+    return changed
+
+@generator(sections=['qos', 'qos_plans', 'pppoe_subscribers', 'dhcp_reservations', 'network'],
+           outputs=['qos.nft', 'qos-classes.tc', 'qos-sessions', 'setup_qos.sh', 'qos-ip-up', 'qos-ip-down'],
+           state=[qos_service.CLASSES_STATE_FILE])
+def generate_qos_config(config):
+    """
+    Generates the per-client shaping: HTB trees for every shaped interface,
+    the nftables maps that put clients into their class, and the PPPoE hooks
+    that add sessions to those maps.
+    """
+    enabled = config.get('qos', {}).get('enabled', False)
+    plans, errors = qos_service.load_plans(config)
+    clients, client_errors = qos_service.qos_clients(config, plans) if enabled else ([], [])
+    interfaces = qos_service.shaped_interfaces(config) if enabled else []
+    for error in errors + client_errors:
+        warn(f'QoS: skipped {error}')
+
+    class_ids = {}
+    if enabled:
+        try:
+            class_ids = qos_service.assign_class_ids(clients, qos_service.load_class_ids(GENERATED_DIR))
+            qos_service.save_class_ids(GENERATED_DIR, class_ids)
+        except ValueError as e:
+            warn(f'QoS disabled: {e}')
+            enabled, clients, interfaces = False, [], []
+
+    changed = []
+    if _write_generated_stream('qos-classes.tc', qos_service.render_tc_batch(interfaces, clients, class_ids, plans)):
+        changed.append('qos-classes.tc')
+    if _write_generated('qos.nft', qos_service.render_nft(enabled, clients, class_ids)):
+        changed.append('qos.nft')
+    if _write_generated_stream('qos-sessions', qos_service.render_session_classes(clients, class_ids)):
+        changed.append('qos-sessions')
+    if _write_generated('setup_qos.sh', qos_service.setup_script()):
+        changed.append('setup_qos.sh')
+    for kind in ('up', 'down'):
+        if _write_generated(f'qos-ip-{kind}', qos_service.hook_script(kind)):
+            changed.append(f'qos-ip-{kind}')
+    return changed
+
+# NAT and forwarding firewall. The whole ruleset lives in its own table and is
+# replaced in one nft transaction, so there is never a moment without rules.
+FW_NFT_TABLE = 'ubr_fw'
+FW_FLOWTABLE = 'fastpath'
+
+def parse_blocked_host(address):
+    """
+    Normalizes a blocked host entry (IPv4 address or network) or raises ValueError.
+    """
+    address = str(address or '').strip()
+    if '/' in address:
+        network = ipaddress.IPv4Network(address, strict=False)
+        return str(network.network_address) if network.prefixlen == 32 else str(network)
+    return str(ipaddress.IPv4Address(address))
+
+def get_firewall_interfaces(config):
+    """
+    Returns (wans, lans): interface names by role. br0 stands for all LAN
+    ports, which netplan puts into the bridge.
+    """
+    network = config.get('network', {})
+    wans = sorted(i for i, s in network.items() if s.get('role') == 'wan' and _IFACE_RE.match(i))
+    lan_ports = sorted(i for i, s in network.items() if s.get('role') == 'lan' and _IFACE_RE.match(i))
+    lans = ['br0'] + lan_ports if lan_ports else []
+    return wans, lans
+
+def _firewall_nft(config):
+    settings = config.get('firewall', {})
+    lines = [
+        '# Generated by Ubuntu Router UI: NAT and forwarding firewall',
+        f'table inet {FW_NFT_TABLE} {{}}',
+        f'delete table inet {FW_NFT_TABLE}',
+    ]
+    wans, lans = get_firewall_interfaces(config)
+    if not settings.get('enabled') or not wans:
+        return '\n'.join(lines) + '\n'
+
+    blocked = []
+    for address in settings.get('blocked', []):
+        try:
+            blocked.append(parse_blocked_host(address))
+        except ValueError:
+            warn(f'Firewall: skipped blocked host {address}')
+    offload = settings.get('flow_offload', True)
+    internal = [f'iifname "{i}"' for i in lans] + ['iifname "ppp*"']
+
+    # setup_firewall.sh fills in the flowtable devices that exist at load time,
+    # and drops the lines tagged '# offload' if there are none
+    lines.append(f'define FLOWTABLE_DEVICES = {{ {", ".join(wans + lans)} }}')
+    lines.append(f'table inet {FW_NFT_TABLE} {{')
+    lines.append('    set blocked_hosts {')
+    lines.append('        type ipv4_addr; flags interval; auto-merge;')
+    if blocked:
+        lines.append(f'        elements = {{ {", ".join(blocked)} }}')
+    lines.append('    }')
+    if offload:
+        lines.append(f'    flowtable {FW_FLOWTABLE} {{  # offload')
+        lines.append('        hook ingress priority filter; devices = $FLOWTABLE_DEVICES;  # offload')
+        if settings.get('hw_offload'):
+            lines.append('        flags offload;  # offload')
+        lines.append('    }  # offload')
+    lines.append('    chain input {')
+    lines.append('        type filter hook input priority filter; policy accept;')
+    lines.append('        ip saddr @blocked_hosts drop')
+    lines.append('    }')
+    lines.append('    chain forward {')
+    lines.append('        type filter hook forward priority filter; policy drop;')
+    lines.append('        ip saddr @blocked_hosts drop')
+    lines.append('        ip daddr @blocked_hosts drop')
+    if offload:
+        # Established flows skip the whole stack from here on. Clients the QoS
+        # maps put into an HTB class (meta priority set) stay on the slow path,
+        # since offloaded packets would bypass that classification.
+        lines.append(f'        meta l4proto {{ tcp, udp }} ct state established meta priority none flow add @{FW_FLOWTABLE}  # offload')
+    lines.append('        ct state established,related accept')
+    lines.append('        ct state invalid drop')
+    lines.append('        # PPPoE and the WAN links have a smaller MTU than the LAN')
+    lines.append('        tcp flags syn tcp option maxseg size set rt mtu')
+    # LAN and PPPoE clients may go out and reach each other; from a WAN only replies get in
+    for match in internal:
+        lines.append(f'        {match} accept')
+    lines.append('    }')
+    lines.append('    chain postrouting {')
+    lines.append('        type nat hook postrouting priority srcnat; policy accept;')
+    for wan in wans:
+        lines.append(f'        oifname "{wan}" masquerade')
+    lines.append('    }')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+def _firewall_script():
+    lines = [
+        '#!/bin/bash',
+        '# Firewall Setup (generated by Ubuntu Router UI)',
+        '# Loads the NAT/forwarding ruleset in a single nft transaction.',
+        '',
+        'DIR="$(cd "$(dirname "$0")" && pwd)"',
+        'RULES="$DIR/firewall.nft"',
+        '',
+        'sysctl -qw net.ipv4.ip_forward=1',
+        '',
+        '# A flowtable cannot name a device that does not exist (yet), so keep only the present ones',
+        'DEVICES=""',
+        "for DEV in $(sed -n 's/^define FLOWTABLE_DEVICES = { \\(.*\\) }$/\\1/p' \"$RULES\" | tr -d ','); do",
+        '    [ -e "/sys/class/net/$DEV" ] && DEVICES="${DEVICES:+$DEVICES, }$DEV"',
+        'done',
+        'if [ -n "$DEVICES" ]; then',
+        '    sed "s/^define FLOWTABLE_DEVICES = .*/define FLOWTABLE_DEVICES = { $DEVICES }/" "$RULES" | nft -f - || exit 1',
+        'else',
+        "    grep -v -e '# offload$' -e '^define FLOWTABLE_DEVICES' \"$RULES\" | nft -f - || exit 1",
+        'fi',
+        "echo 'Firewall rules applied.'",
+    ]
+    return '\n'.join(lines) + '\n'
+
+@generator(sections=['firewall', 'network'], outputs=['firewall.nft', 'setup_firewall.sh'])
+def generate_firewall_config(config):
+    """
+    Generates the nftables NAT/forwarding ruleset: masquerade on every WAN,
+    forwarding from LAN and PPPoE clients, a flowtable fast path for
+    established flows and the blocked hosts set.
+    """
+    changed = []
+    if _write_generated('firewall.nft', _firewall_nft(config)):
+        changed.append('firewall.nft')
+    if _write_generated('setup_firewall.sh', _firewall_script()):
+        changed.append('setup_firewall.sh')
+    return changed
+
+def plan_tuning(settings, hardware):
+    """
+    Proposed NIC layout (see tuning_service.plan_layout) for the tuning settings
+    and a hardware snapshot. The optional cpus setting ('2-7') limits the CPUs used.
+    """
+    cpus = parse_cpus(settings.get('cpus')) or list(range(hardware['cpus']))
+    return tuning_service.plan_layout(hardware, cpus, settings)
+
+@generator(sections=['tuning'], outputs=['setup_tuning.sh'])
+def generate_tuning_script(config):
+    """
+    Generates the NIC tuning script: IRQ affinity, RPS/XPS masks, ring sizes
+    and offloads, laid out for the hardware snapshot saved with the settings.
+    """
+    settings = config.get('tuning', {})
+    hardware = settings.get('hardware') or {'cpus': 1, 'nics': {}}
+    layout = plan_tuning(settings, hardware)
+    if _write_generated('setup_tuning.sh', tuning_service.render_script(layout, settings)):
+        return ['setup_tuning.sh']
+    return []
+
+def plan_conntrack(config):
+    """
+    Conntrack table size (see conntrack_service.plan_size) for the settings,
+    the RAM recorded when they were saved and the PPPoE subscriber count.
+    """
+    settings = config.get('conntrack', {})
+    memory = settings.get('memory_bytes')
+    if not memory:
+        import psutil
+        memory = green.blocking(psutil.virtual_memory).total
+    return conntrack_service.plan_size(settings, memory, len(config.get('pppoe_subscribers', {})))
+
+def _conntrack_script():
+    lines = [
+        '#!/bin/bash',
+        '# Conntrack Table Sizing (generated by Ubuntu Router UI)',
+        '# The files in sysctl.d and modprobe.d size the table at boot; this resizes the running one.',
+        '',
+        'modprobe nf_conntrack',
+        "HASHSIZE=$(sed -n 's/^options nf_conntrack hashsize=//p' /etc/modprobe.d/ubuntu-router-conntrack.conf 2>/dev/null)",
+        'if [ -n "$HASHSIZE" ]; then',
+        '    # Rehashes the live table; existing connections are kept',
+        '    echo "$HASHSIZE" > /sys/module/nf_conntrack/parameters/hashsize',
+        'fi',
+        'sysctl -q -p /etc/sysctl.d/90-ubuntu-router-conntrack.conf',
+        "echo 'Conntrack table sized.'",
+    ]
+    return '\n'.join(lines) + '\n'
+
+@generator(sections=['conntrack', 'pppoe_subscribers'],
+           outputs=['conntrack-sysctl.conf', 'conntrack-modprobe.conf', 'conntrack-modules.conf', 'setup_conntrack.sh'])
+def generate_conntrack_config(config):
+    """
+    Generates the conntrack sizing: nf_conntrack_max in sysctl.d and hashsize as
+    a module option, with nf_conntrack loaded early so the sysctl exists at boot.
+    """
+    settings = config.get('conntrack', {})
+    header = '# Conntrack sizing (generated by Ubuntu Router UI)\n'
+    if settings.get('auto_size'):
+        size = plan_conntrack(config)
+        files = {
+            'conntrack-sysctl.conf': header + f"net.netfilter.nf_conntrack_max = {size['max']}\n",
+            'conntrack-modprobe.conf': header + f"options nf_conntrack hashsize={size['hashsize']}\n",
+            'conntrack-modules.conf': header + 'nf_conntrack\n'
+        }
     else:
-        content += "# No load balancing configured.\n"
-        content += "echo 'No load balancing rules to apply.'\n"
-            
-    with open(os.path.join(GENERATED_DIR, 'setup_loadbalance.sh'), 'w') as f:
-        f.write(content)
+        # Kernel defaults
+        files = {'conntrack-sysctl.conf': header, 'conntrack-modprobe.conf': header, 'conntrack-modules.conf': header}
+    files['setup_conntrack.sh'] = _conntrack_script()
+
+    changed = []
+    for name, content in files.items():
+        if _write_generated(name, content):
+            changed.append(name)
+    return changed
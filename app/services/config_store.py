@@ -0,0 +1,489 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from app.services import green, json_patch
+
+try:
+    import fcntl
+except ImportError:  # Windows dev environment: no cross-process lock
+    fcntl = None
+
+# Storage backends for the settings. Both offer the same calls:
+#   read() -> (config, revision)
+#   key() -> cheap token that changes whenever the stored config does
+#   update(sections, items, order) -> new revision, applied as one transaction
+# config_service picks one with CONFIG_BACKEND.
+
+# Sections stored one row per item instead of one row for the whole section.
+# None: the section is a dict of items; a field name: a list of dicts keyed by that field.
+COLLECTIONS = {'pppoe_subscribers': None, 'qos_plans': None, 'dhcp_reservations': 'mac'}
+
+# Marks a section or item to be removed in update()
+DELETED = object()
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def _is_collection(section, value):
+    return section in COLLECTIONS and isinstance(value, dict if COLLECTIONS[section] is None else list)
+
+
+def item_rows(section, value):
+    """
+    The items of a collection section as [(key, item)], in order. List items are
+    keyed by their key field; items without a usable key get a positional one.
+    """
+    field = COLLECTIONS[section]
+    if not _is_collection(section, value):
+        return []
+    if field is None:
+        return list(value.items())
+    rows = []
+    seen = set()
+    for position, item in enumerate(value):
+        key = item.get(field) if isinstance(item, dict) else None
+        if not isinstance(key, str) or key in seen:
+            key = f'#{position}'
+        seen.add(key)
+        rows.append((key, item))
+    return rows
+
+
+def _apply(config, sections, items, order):
+    """
+    Applies an update to a config dict in place (the JSON backend's update).
+    """
+    for name, value in (sections or {}).items():
+        if value is DELETED:
+            config.pop(name, None)
+        else:
+            config[name] = value
+    for name, changes in (items or {}).items():
+        current = dict(item_rows(name, config.get(name)))
+        for key, item in changes.items():
+            if item is DELETED:
+                current.pop(key, None)
+            else:
+                current[key] = item
+        keys = [k for k in (order or {}).get(name, []) if k in current]
+        keys += [k for k in current if k not in set(keys)]
+        if COLLECTIONS[name] is None:
+            config[name] = {k: current[k] for k in keys}
+        else:
+            config[name] = [current[k] for k in keys]
+
+
+def diff(base, config):
+    """
+    What changed from base to config, as the (sections, items, order) arguments
+    of update(): collections are compared item by item, other sections whole.
+    order is only given for a collection whose items were reordered.
+    """
+    sections, items, order = {}, {}, {}
+    for name in list(base) + [n for n in config if n not in base]:
+        if name not in config:
+            sections[name] = DELETED
+            continue
+        old, new = base.get(name), config[name]
+        if name in base and old == new:
+            continue
+        if not (_is_collection(name, old) and _is_collection(name, new)):
+            sections[name] = new
+            continue
+        old_rows = dict(item_rows(name, old))
+        new_rows = item_rows(name, new)
+        new_keys = [key for key, _ in new_rows]
+        changes = {key: item for key, item in new_rows if key not in old_rows or old_rows[key] != item}
+        changes.update((key, DELETED) for key in set(old_rows) - set(new_keys))
+        items[name] = changes
+        # update() appends new items; anything else is a reorder
+        kept = set(new_keys)
+        appended = [k for k in old_rows if k in kept] + [k for k in new_keys if k not in old_rows]
+        if new_keys != appended:
+            order[name] = new_keys
+    return sections, items, order
+
+
+class JsonStore:
+    """
+    The whole config in one JSON file, as before. Updates hold an flock on a
+    lock file for the read-modify-write, so concurrent partial updates from
+    several workers are not lost, but every update still rewrites the file.
+    The revision is kept in a small file next to it. No history is kept.
+    """
+
+    keeps_history = False
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.revision_path = path + '.revision'
+        # (revision, key) of the last update() from this process
+        self._written = None
+
+    def key(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def key_at(self, revision):
+        """
+        Cache key of revision if this process wrote it, else None (unknown).
+        """
+        written = self._written
+        return written[1] if written and written[0] == revision else None
+
+    def _read_config(self):
+        try:
+            with open(self.path, 'r') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return value if isinstance(value, dict) else {}
+
+    def revision(self):
+        try:
+            with open(self.revision_path, 'r') as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def read(self):
+        return self._read_config(), self.revision()
+
+    def _write(self, path, text):
+        # Temp file and rename, so readers never see a half written file and
+        # the cache key (inode) changes on every save
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.settings-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def update(self, sections=None, items=None, order=None):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            if fcntl:
+                green.blocking(fcntl.flock, lock, fcntl.LOCK_EX)
+            config = self._read_config()
+            _apply(config, sections, items, order)
+            revision = self.revision() + 1
+            self._write(self.path, json.dumps(config, indent=4))
+            self._write(self.revision_path, f'{revision}\n')
+            # Still under the lock, so this is the file just written and not a later save
+            self._written = (revision, self.key())
+        return revision
+
+
+class SqliteStore:
+    """
+    The config in a SQLite database in WAL mode: one row per section, and for
+    the COLLECTIONS one row per item. An update only touches the rows that
+    changed and bumps the revision in the same transaction, so concurrent
+    saves of different sections (or different items) from several workers
+    all survive, and readers are never blocked. On first use an existing
+    settings.json is imported.
+
+    Every revision is also recorded in the history: a JSON patch from the
+    previous revision, plus a full snapshot every SNAPSHOT_EVERY revisions so
+    rebuilding any revision applies at most that many patches. The generated
+    artifacts of each revision are kept as content-addressed blobs.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS sections (name TEXT PRIMARY KEY, value TEXT NOT NULL, revision INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS items (section TEXT NOT NULL, key TEXT NOT NULL, position INTEGER NOT NULL, '
+        'value TEXT NOT NULL, revision INTEGER NOT NULL, PRIMARY KEY (section, key))',
+        'CREATE TABLE IF NOT EXISTS revisions (revision INTEGER PRIMARY KEY, time REAL NOT NULL, '
+        'sections TEXT NOT NULL, delta TEXT NOT NULL, snapshot BLOB)',
+        'CREATE TABLE IF NOT EXISTS artifacts (revision INTEGER NOT NULL, name TEXT NOT NULL, hash TEXT NOT NULL, '
+        'PRIMARY KEY (revision, name))',
+        'CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, content BLOB NOT NULL)',
+    )
+
+    keeps_history = True
+    SNAPSHOT_EVERY = 50
+    # Revisions older than this many are dropped (from the next snapshot back)
+    HISTORY_KEEP = 1000
+
+    def __init__(self, path, import_path=None):
+        self.path = path
+        self.import_path = import_path
+        # sqlite3 connections must stay in the thread that opened them
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Autocommit mode; transactions are opened explicitly with BEGIN
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        self._local.conn = conn
+        self._import(conn)
+        return conn
+
+    def _import(self, conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()
+            if row is None:
+                config = JsonStore(self.import_path).read()[0] if self.import_path else {}
+                revision = 1 if config else 0
+                self._write(conn, revision, config, None, None)
+                conn.execute("INSERT INTO meta (key, value) VALUES ('revision', ?)", (revision,))
+            else:
+                revision = row[0]
+            # The history starts with a snapshot of whatever is there
+            if revision and conn.execute('SELECT 1 FROM revisions LIMIT 1').fetchone() is None:
+                self._record(conn, revision, [], sorted(self._read_config(conn)), snapshot=True)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def key(self):
+        return self.revision()
+
+    def key_at(self, revision):
+        return revision
+
+    def revision(self):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()
+        return row[0] if row else 0
+
+    def _read_section(self, conn, name, value):
+        for key, item in conn.execute('SELECT key, value FROM items WHERE section = ? ORDER BY position', (name,)):
+            if isinstance(value, dict):
+                value[key] = json.loads(item)
+            else:
+                value.append(json.loads(item))
+        return value
+
+    def _read_config(self, conn):
+        config = {}
+        for name, value in conn.execute('SELECT name, value FROM sections ORDER BY rowid'):
+            config[name] = json.loads(value)
+        for section, key, value in conn.execute('SELECT section, key, value FROM items ORDER BY section, position'):
+            container = config.get(section)
+            if isinstance(container, dict):
+                container[key] = json.loads(value)
+            elif isinstance(container, list):
+                container.append(json.loads(value))
+        return config
+
+    def read(self):
+        conn = self._connect()
+        # One read transaction, so the rows and the revision belong together
+        conn.execute('BEGIN')
+        try:
+            revision = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+            config = self._read_config(conn)
+        finally:
+            conn.execute('COMMIT')
+        return config, revision
+
+    def _write_collection(self, conn, revision, name, rows, replace, order):
+        """
+        Writes the items of one collection and returns the patch operations of
+        the change. For list collections that is the whole list, since items
+        have no stable index.
+        """
+        ops = []
+        if replace or order:
+            existing = {key: (position, value) for key, position, value in
+                        conn.execute('SELECT key, position, value FROM items WHERE section = ?', (name,))}
+        else:
+            # A partial update only looks at the rows it changes
+            existing = {}
+            for key, _ in rows:
+                row = conn.execute('SELECT position, value FROM items WHERE section = ? AND key = ?', (name, key)).fetchone()
+                if row:
+                    existing[key] = row
+        removed = [key for key, item in rows if item is DELETED and key in existing]
+        if replace:
+            removed += list(set(existing) - {key for key, _ in rows})
+        for key in removed:
+            conn.execute('DELETE FROM items WHERE section = ? AND key = ?', (name, key))
+            ops.append({'op': 'remove', 'path': json_patch.pointer(name, key)})
+            existing.pop(key)
+        next_position = conn.execute('SELECT COALESCE(MAX(position), -1) + 1 FROM items WHERE section = ?', (name,)).fetchone()[0]
+        for key, item in rows:
+            if item is DELETED:
+                continue
+            text = _dumps(item)
+            if key not in existing:
+                conn.execute('INSERT INTO items (section, key, position, value, revision) VALUES (?, ?, ?, ?, ?)',
+                             (name, key, next_position, text, revision))
+                ops.append({'op': 'add', 'path': json_patch.pointer(name, key), 'value': item})
+                existing[key] = (next_position, text)
+                next_position += 1
+            elif existing[key][1] != text:
+                conn.execute('UPDATE items SET value = ?, revision = ? WHERE section = ? AND key = ?',
+                             (text, revision, name, key))
+                ops.extend(json_patch.make_patch(json.loads(existing[key][1]), item, json_patch.pointer(name, key)))
+        # Only positions that moved are rewritten
+        moved = False
+        for position, key in enumerate(order or []):
+            if key in existing and existing[key][0] != position:
+                conn.execute('UPDATE items SET position = ? WHERE section = ? AND key = ?', (position, name, key))
+                moved = True
+        if COLLECTIONS[name] is not None and (ops or moved):
+            ops = [{'op': 'add', 'path': json_patch.pointer(name), 'value': self._read_section(conn, name, [])}]
+        return ops
+
+    def _write(self, conn, revision, sections, items, order):
+        """
+        Writes an update and returns its patch operations.
+        """
+        ops = []
+        order = order or {}
+        for name, value in (sections or {}).items():
+            row = conn.execute('SELECT value FROM sections WHERE name = ?', (name,)).fetchone()
+            if value is DELETED:
+                if row is not None:
+                    conn.execute('DELETE FROM sections WHERE name = ?', (name,))
+                    conn.execute('DELETE FROM items WHERE section = ?', (name,))
+                    ops.append({'op': 'remove', 'path': json_patch.pointer(name)})
+                continue
+            if _is_collection(name, value):
+                # The section row only records the container type; the items have their own rows
+                rows = item_rows(name, value)
+                value = {} if COLLECTIONS[name] is None else []
+            else:
+                rows = None
+                conn.execute('DELETE FROM items WHERE section = ?', (name,))
+            text = _dumps(value)
+            if row is None:
+                conn.execute('INSERT INTO sections (name, value, revision) VALUES (?, ?, ?)', (name, text, revision))
+                ops.append({'op': 'add', 'path': json_patch.pointer(name), 'value': value})
+            elif row[0] != text:
+                conn.execute('UPDATE sections SET value = ?, revision = ? WHERE name = ?', (text, revision, name))
+                old = json.loads(row[0])
+                if rows is not None and type(old) is not type(value):
+                    ops.append({'op': 'add', 'path': json_patch.pointer(name), 'value': value})
+                elif rows is None:
+                    ops.extend(json_patch.make_patch(old, value, json_patch.pointer(name)))
+            if rows is not None:
+                ops.extend(self._write_collection(conn, revision, name, rows, True, [key for key, _ in rows]))
+        for name, changes in (items or {}).items():
+            if conn.execute('SELECT 1 FROM sections WHERE name = ?', (name,)).fetchone() is None:
+                value = {} if COLLECTIONS[name] is None else []
+                conn.execute('INSERT INTO sections (name, value, revision) VALUES (?, ?, ?)', (name, _dumps(value), revision))
+                ops.append({'op': 'add', 'path': json_patch.pointer(name), 'value': value})
+            ops.extend(self._write_collection(conn, revision, name, list(changes.items()), False, order.get(name)))
+        return ops
+
+    def _record(self, conn, revision, ops, sections, snapshot=False):
+        last = conn.execute('SELECT MAX(revision) FROM revisions WHERE snapshot IS NOT NULL').fetchone()[0]
+        snapshot = snapshot or last is None or revision - last >= self.SNAPSHOT_EVERY
+        conn.execute('INSERT OR REPLACE INTO revisions (revision, time, sections, delta, snapshot) VALUES (?, ?, ?, ?, ?)',
+                     (revision, time.time(), _dumps(sections), _dumps(ops),
+                      zlib.compress(_dumps(self._read_config(conn)).encode('utf-8')) if snapshot else None))
+        if snapshot:
+            # Drop what is older than HISTORY_KEEP, keeping the snapshot the rest is rebuilt from
+            base = conn.execute('SELECT MAX(revision) FROM revisions WHERE snapshot IS NOT NULL AND revision <= ?',
+                                (revision - self.HISTORY_KEEP,)).fetchone()[0]
+            if base is not None:
+                conn.execute('DELETE FROM revisions WHERE revision < ?', (base,))
+                conn.execute('DELETE FROM artifacts WHERE revision < ?', (base,))
+                conn.execute('DELETE FROM blobs WHERE hash NOT IN (SELECT hash FROM artifacts)')
+
+    def update(self, sections=None, items=None, order=None):
+        conn = self._connect()
+        # IMMEDIATE takes the write lock up front; other writers wait (timeout) instead of failing
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            revision = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0] + 1
+            ops = self._write(conn, revision, sections, items, order)
+            touched = sorted({op['path'].split('/')[1].replace('~1', '/').replace('~0', '~') for op in ops})
+            self._record(conn, revision, ops, touched)
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'revision'", (revision,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return revision
+
+    def revisions(self, offset=0, limit=50):
+        """
+        Newest first: [{'revision', 'time', 'sections', 'changes', 'snapshot'}].
+        """
+        rows = self._connect().execute(
+            'SELECT revision, time, sections, delta, snapshot IS NOT NULL FROM revisions '
+            'ORDER BY revision DESC LIMIT ? OFFSET ?', (limit, offset))
+        return [{'revision': r, 'time': t, 'sections': json.loads(s), 'changes': len(json.loads(d)), 'snapshot': bool(snap)}
+                for r, t, s, d, snap in rows]
+
+    def config_at(self, revision):
+        """
+        The config as it was after revision: the nearest snapshot at or before
+        it, with the patches since applied. Raises KeyError if the revision is
+        unknown or no longer kept.
+        """
+        conn = self._connect()
+        conn.execute('BEGIN')
+        try:
+            if conn.execute('SELECT 1 FROM revisions WHERE revision = ?', (revision,)).fetchone() is None:
+                raise KeyError(revision)
+            row = conn.execute('SELECT revision, snapshot FROM revisions WHERE revision <= ? AND snapshot IS NOT NULL '
+                               'ORDER BY revision DESC LIMIT 1', (revision,)).fetchone()
+            if row is None:
+                raise KeyError(revision)
+            config = json.loads(zlib.decompress(row[1]))
+            for (delta,) in conn.execute('SELECT delta FROM revisions WHERE revision > ? AND revision <= ? ORDER BY revision',
+                                         (row[0], revision)):
+                config = json_patch.apply_patch(config, json.loads(delta))
+        finally:
+            conn.execute('COMMIT')
+        return config
+
+    def record_artifacts(self, revision, files):
+        """
+        Stores the generated files {name: bytes} of a revision.
+        """
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for name, content in files.items():
+                digest = hashlib.sha256(content).hexdigest()
+                conn.execute('INSERT OR IGNORE INTO blobs (hash, content) VALUES (?, ?)', (digest, content))
+                conn.execute('INSERT OR REPLACE INTO artifacts (revision, name, hash) VALUES (?, ?, ?)',
+                             (revision, name, digest))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def artifacts_at(self, revision):
+        """
+        (recorded revision, {name: sha256}) of the newest artifact set recorded
+        at or before revision, or (None, {}).
+        """
+        conn = self._connect()
+        row = conn.execute('SELECT MAX(revision) FROM artifacts WHERE revision <= ?', (revision,)).fetchone()
+        if row[0] is None:
+            return None, {}
+        return row[0], dict(conn.execute('SELECT name, hash FROM artifacts WHERE revision = ?', (row[0],)))
+
+    def blob(self, digest):
+        row = self._connect().execute('SELECT content FROM blobs WHERE hash = ?', (digest,)).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,171 @@
+import os
+import time
+from app.services import green
+
+# Connection tracking table. Everything here comes from small procfs files the
+# kernel keeps up to date (counters, not a walk of the table); only the
+# per-protocol breakdown looks at entries, and it reads just the first
+# BREAKDOWN_SAMPLE of them.
+PROC_NETFILTER = '/proc/sys/net/netfilter'
+PROC_STAT = '/proc/net/stat/nf_conntrack'
+PROC_TABLE = '/proc/net/nf_conntrack'
+HASHSIZE_PARAM = '/sys/module/nf_conntrack/parameters/hashsize'
+
+# The table is dumped in hash bucket order, which has nothing to do with the
+# protocol, so the first entries are a fair sample of the whole table
+BREAKDOWN_SAMPLE = 20000
+BREAKDOWN_TTL = 30.0
+
+# Stat columns worth showing; the others (found, ignore, ...) count normal work
+STAT_FIELDS = ('drop', 'early_drop', 'insert_failed', 'invalid', 'search_restart', 'clash_resolve')
+
+# Sizing: a base for the router itself and its LAN, plus an allowance per
+# subscriber, capped at a share of RAM. The base is the kernel's default on
+# machines with more than 4 GB, so sizing never shrinks the table there. An
+# entry costs about 320 bytes of slab plus a bucket pointer; 384 leaves room
+# for the extensions NAT adds.
+BASE_ENTRIES = 262144
+ENTRIES_PER_SUBSCRIBER = 1000
+ENTRY_BYTES = 384
+MEMORY_SHARE = 8  # at most 1/8 of RAM
+# Round up so adding one subscriber does not rewrite the sysctl every time
+GRANULARITY = 65536
+
+WARN_PERCENT = 75
+CRITICAL_PERCENT = 90
+
+
+def _read_int(path):
+    try:
+        with open(path, 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def read_stats():
+    """
+    Sums the per-CPU lines of /proc/net/stat/nf_conntrack (hex columns, named
+    in the header line; the set of columns depends on the kernel version).
+    Returns {} if conntrack is not loaded.
+    """
+    try:
+        with open(PROC_STAT, 'r') as f:
+            header = f.readline().split()
+            rows = [line.split() for line in f]
+    except OSError:
+        return {}
+    totals = dict.fromkeys(header, 0)
+    for row in rows:
+        for name, value in zip(header, row):
+            try:
+                totals[name] += int(value, 16)
+            except ValueError:
+                pass
+    # 'entries' is the global count repeated on every CPU line
+    totals.pop('entries', None)
+    if 'clashres' in totals:
+        totals['clash_resolve'] = totals.pop('clashres')
+    return totals
+
+
+_breakdown = {'time': 0.0, 'value': None}
+
+
+def _sample_table():
+    protocols = {}
+    tcp_states = {}
+    sampled = 0
+    with open(PROC_TABLE, 'r') as f:
+        for line in f:
+            # ipv4     2 tcp      6 431999 ESTABLISHED src=...
+            fields = line.split(None, 6)
+            if len(fields) < 5:
+                continue
+            proto = fields[2]
+            protocols[proto] = protocols.get(proto, 0) + 1
+            if proto == 'tcp' and len(fields) > 5:
+                tcp_states[fields[5]] = tcp_states.get(fields[5], 0) + 1
+            sampled += 1
+            if sampled >= BREAKDOWN_SAMPLE:
+                break
+    return protocols, tcp_states, sampled
+
+
+def read_breakdown(count, now=None):
+    """
+    Estimated entries per protocol (and per TCP state) from the first
+    BREAKDOWN_SAMPLE lines of the table, scaled to count. Cached for
+    BREAKDOWN_TTL seconds. Returns None if the kernel has no procfs table.
+    """
+    now = time.monotonic() if now is None else now
+    if _breakdown['value'] is not None and now - _breakdown['time'] < BREAKDOWN_TTL:
+        return _breakdown['value']
+
+    try:
+        # The kernel builds the dump under its locks; other greenlets keep running meanwhile
+        protocols, tcp_states, sampled = green.blocking(_sample_table)
+    except OSError:
+        return None
+
+    scale = (count or sampled) / sampled if sampled else 0
+    value = {
+        'sampled': sampled,
+        'protocols': {p: round(n * scale) for p, n in sorted(protocols.items(), key=lambda i: -i[1])},
+        'tcp_states': {s: round(n * scale) for s, n in sorted(tcp_states.items(), key=lambda i: -i[1])}
+    }
+    _breakdown.update(time=now, value=value)
+    return value
+
+
+def alert_level(usage, settings):
+    """
+    'ok', 'warning' or 'critical' for a table usage in percent.
+    """
+    if usage >= settings.get('critical_percent', CRITICAL_PERCENT):
+        return 'critical'
+    if usage >= settings.get('warn_percent', WARN_PERCENT):
+        return 'warning'
+    return 'ok'
+
+
+def read_status(settings=None, breakdown=True):
+    """
+    Returns {'available', 'count', 'max', 'buckets', 'usage', 'level', 'stats', 'breakdown'}.
+    available is False when the nf_conntrack module is not loaded.
+    """
+    settings = settings or {}
+    count = _read_int(os.path.join(PROC_NETFILTER, 'nf_conntrack_count'))
+    if count is None:
+        return {'available': False, 'count': 0, 'max': 0, 'buckets': 0, 'usage': 0.0,
+                'level': 'ok', 'stats': {}, 'breakdown': None}
+    maximum = _read_int(os.path.join(PROC_NETFILTER, 'nf_conntrack_max')) or 0
+    buckets = _read_int(os.path.join(PROC_NETFILTER, 'nf_conntrack_buckets')) or _read_int(HASHSIZE_PARAM) or 0
+    usage = round(count * 100.0 / maximum, 1) if maximum else 0.0
+    stats = read_stats()
+    return {
+        'available': True,
+        'count': count,
+        'max': maximum,
+        'buckets': buckets,
+        'usage': usage,
+        'level': alert_level(usage, settings),
+        'stats': {name: stats[name] for name in STAT_FIELDS if name in stats},
+        'breakdown': read_breakdown(count) if breakdown else None
+    }
+
+
+def plan_size(settings, memory_bytes, subscribers):
+    """
+    Returns {'max', 'hashsize', 'demand', 'memory_cap'} for the conntrack table.
+    settings may pin 'max' and 'hashsize'; otherwise max covers BASE_ENTRIES plus
+    ENTRIES_PER_SUBSCRIBER (or settings['per_subscriber']) for each subscriber,
+    up to 1/MEMORY_SHARE of RAM. hashsize is one bucket per entry, the
+    kernel's own default ratio, rounded to a power of two.
+    """
+    per_subscriber = settings.get('per_subscriber') or ENTRIES_PER_SUBSCRIBER
+    demand = BASE_ENTRIES + subscribers * per_subscriber
+    memory_cap = max(GRANULARITY, memory_bytes // MEMORY_SHARE // ENTRY_BYTES // GRANULARITY * GRANULARITY)
+    maximum = settings.get('max') or min(-(-demand // GRANULARITY) * GRANULARITY, memory_cap)
+    hashsize = settings.get('hashsize') or 1 << (maximum - 1).bit_length()
+    return {'max': maximum, 'hashsize': hashsize, 'demand': demand, 'memory_cap': memory_cap}
@@ -0,0 +1,261 @@
+import bisect
+import ipaddress
+import re
+from app.services import template_service
+
+# DHCP scope math and static reservations. Scopes are derived from the address of
+# the interface DHCP serves (br0 takes the LAN address, like in netplan), so the
+# subnet, netmask and router always match what is actually configured.
+DEFAULT_PREFIX = 24
+DEFAULT_DNS = ('8.8.8.8', '8.8.4.4')
+DEFAULT_LEASE = 86400
+MAX_LEASE_FACTOR = 2
+
+_MAC_RE = re.compile(r'^[0-9a-f]{2}([:-]?)[0-9a-f]{2}(\1[0-9a-f]{2}){4}$')
+_HOSTNAME_RE = re.compile(r'^[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?$')
+# Dot-separated host name labels; ends up quoted in dhcpd.conf, so nothing else may pass
+_DOMAIN_RE = re.compile(r'^(?=.{1,253}$)[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?(\.[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?)*$')
+_PLAN_RE = re.compile(r'^[A-Za-z0-9_.-]{1,32}$')
+
+
+def normalize_mac(mac):
+    """
+    Returns the MAC as lower-case colon separated hex, or raises ValueError.
+    """
+    mac = str(mac or '').strip().lower()
+    if not _MAC_RE.match(mac):
+        raise ValueError(f'Invalid MAC address: {mac}')
+    digits = re.sub(r'[^0-9a-f]', '', mac)
+    return ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+def _interface_address(address):
+    # Stored LAN/WAN addresses may be bare ('192.168.1.1') or carry a prefix
+    address = str(address).strip()
+    if '/' not in address:
+        address = f'{address}/{DEFAULT_PREFIX}'
+    return ipaddress.IPv4Interface(address)
+
+
+def serving_address(config, iface):
+    """
+    IPv4Interface the DHCP server answers from on iface, or None if it has none.
+    br0 uses the first LAN address, the same one netplan puts on the bridge.
+    """
+    network = config.get('network', {})
+    if iface == 'br0':
+        candidates = [s.get('ip') for s in network.values() if s.get('role') == 'lan']
+    else:
+        candidates = [network.get(iface, {}).get('ip')]
+    for address in candidates:
+        if address:
+            try:
+                return _interface_address(address)
+            except ValueError:
+                return None
+    return None
+
+
+def _parse_dns(value):
+    if not value:
+        return list(DEFAULT_DNS)
+    if isinstance(value, str):
+        value = value.replace(',', ' ').split()
+    return [str(ipaddress.IPv4Address(v)) for v in value]
+
+
+def build_scope(config, iface, settings):
+    """
+    Validates one DHCP scope and returns a dict with interface, network, router,
+    range_start, range_end, dns, lease, domain. Raises ValueError with a readable
+    message when the settings do not fit the interface's subnet.
+    """
+    start = ipaddress.IPv4Address(str(settings.get('start') or '').strip())
+    end = ipaddress.IPv4Address(str(settings.get('end') or '').strip())
+
+    address = serving_address(config, iface)
+    if address is None:
+        # No address known for the interface (e.g. configured outside the UI):
+        # fall back to the /24 around the range, with the router on .1
+        network = ipaddress.IPv4Network(f'{start}/{DEFAULT_PREFIX}', strict=False)
+        router = network.network_address + 1
+    else:
+        network = address.network
+        router = address.ip
+
+    if start not in network or end not in network:
+        raise ValueError(f'{iface}: range {start} - {end} is outside {network}')
+    if start > end:
+        raise ValueError(f'{iface}: range start {start} is after range end {end}')
+    if network.prefixlen < 31 and (start == network.network_address or end == network.broadcast_address):
+        raise ValueError(f'{iface}: range must not include the network or broadcast address of {network}')
+    if start <= router <= end:
+        raise ValueError(f'{iface}: range {start} - {end} contains the router address {router}')
+
+    try:
+        lease = int(settings.get('lease') or DEFAULT_LEASE)
+    except (TypeError, ValueError):
+        lease = DEFAULT_LEASE
+
+    domain = str(settings.get('domain') or '').strip()
+    if domain and not _DOMAIN_RE.match(domain):
+        raise ValueError(f'{iface}: invalid domain name: {domain}')
+
+    return {
+        'interface': iface,
+        'network': network,
+        'router': router,
+        'range_start': start,
+        'range_end': end,
+        'dns': _parse_dns(settings.get('dns')),
+        'lease': max(lease, 60),
+        'domain': domain
+    }
+
+
+def build_scopes(config):
+    """
+    Returns (scopes, errors) for all enabled DHCP interfaces. Scopes are sorted
+    by network address; invalid ones are left out and reported in errors.
+    """
+    scopes = []
+    errors = []
+    for iface, settings in config.get('dhcp', {}).items():
+        if not settings.get('enabled'):
+            continue
+        try:
+            scopes.append(build_scope(config, iface, settings))
+        except ValueError as e:
+            errors.append(str(e))
+    scopes.sort(key=lambda s: int(s['network'].network_address))
+    return scopes, errors
+
+
+class ReservationStore:
+    """
+    Static MAC to IP reservations, indexed both ways: a dict keyed by MAC and a
+    sorted array of IP integers searched with bisect. Scopes are kept sorted by
+    network address too, so the duplicate, out-of-scope and in-dynamic-range
+    checks of an insert are all O(log n).
+    """
+
+    def __init__(self, scopes=()):
+        self._scopes = sorted(scopes, key=lambda s: int(s['network'].network_address))
+        self._scope_starts = [int(s['network'].network_address) for s in self._scopes]
+        self._by_mac = {}
+        self._ips = []
+        self._ip_macs = []
+
+    def __len__(self):
+        return len(self._by_mac)
+
+    def scope_for(self, ip):
+        """
+        Scope whose subnet contains ip, or None.
+        """
+        if not isinstance(ip, ipaddress.IPv4Address):
+            ip = ipaddress.IPv4Address(ip)
+        index = bisect.bisect_right(self._scope_starts, int(ip)) - 1
+        if index >= 0 and ip in self._scopes[index]['network']:
+            return self._scopes[index]
+        return None
+
+    def by_mac(self, mac):
+        return self._by_mac.get(normalize_mac(mac))
+
+    def by_ip(self, ip):
+        # Parsing dominates bulk loads; add() passes addresses it already parsed
+        value = int(ip if isinstance(ip, ipaddress.IPv4Address) else ipaddress.IPv4Address(ip))
+        index = bisect.bisect_left(self._ips, value)
+        if index < len(self._ips) and self._ips[index] == value:
+            return self._by_mac[self._ip_macs[index]]
+        return None
+
+    def add(self, mac, ip, hostname='', check_scope=True, plan=''):
+        """
+        Adds a reservation. Raises ValueError for malformed values, duplicates
+        and (with check_scope) addresses outside every scope, in a dynamic range
+        or on a router. plan names the client's QoS bandwidth plan.
+        """
+        mac = normalize_mac(mac)
+        ip = ipaddress.IPv4Address(str(ip or '').strip())
+        hostname = str(hostname or '').strip()
+        if hostname and not _HOSTNAME_RE.match(hostname):
+            raise ValueError(f'Invalid hostname: {hostname}')
+        plan = str(plan or '').strip()
+        if plan and not _PLAN_RE.match(plan):
+            raise ValueError(f'Invalid plan name: {plan}')
+
+        if mac in self._by_mac:
+            raise ValueError(f'{mac} already has a reservation ({self._by_mac[mac]["ip"]})')
+        if self.by_ip(ip) is not None:
+            raise ValueError(f'{ip} is already reserved for {self.by_ip(ip)["mac"]}')
+        if check_scope and self._scopes:
+            scope = self.scope_for(ip)
+            if scope is None:
+                raise ValueError(f'{ip} is not inside any DHCP scope')
+            if scope['range_start'] <= ip <= scope['range_end']:
+                raise ValueError(f'{ip} is inside the dynamic range of {scope["interface"]}')
+            if ip == scope['router'] or ip in (scope['network'].network_address, scope['network'].broadcast_address):
+                raise ValueError(f'{ip} cannot be reserved in {scope["network"]}')
+
+        entry = {'mac': mac, 'ip': str(ip), 'hostname': hostname}
+        if plan:
+            entry['plan'] = plan
+        index = bisect.bisect_left(self._ips, int(ip))
+        self._ips.insert(index, int(ip))
+        self._ip_macs.insert(index, mac)
+        self._by_mac[mac] = entry
+        return entry
+
+    def remove(self, mac):
+        """
+        Removes the reservation of mac. Returns the removed entry or None.
+        """
+        entry = self._by_mac.pop(normalize_mac(mac), None)
+        if entry is None:
+            return None
+        index = bisect.bisect_left(self._ips, int(ipaddress.IPv4Address(entry['ip'])))
+        del self._ips[index]
+        del self._ip_macs[index]
+        return entry
+
+    def entries(self):
+        """
+        Reservations ordered by IP address.
+        """
+        return [self._by_mac[mac] for mac in self._ip_macs]
+
+    def in_network(self, network):
+        """
+        Reservations inside network, ordered by IP (a bisect range, not a scan).
+        """
+        low = bisect.bisect_left(self._ips, int(network.network_address))
+        high = bisect.bisect_right(self._ips, int(network.broadcast_address))
+        return [self._by_mac[mac] for mac in self._ip_macs[low:high]]
+
+
+def load_reservations(config, scopes=None, strict=True):
+    """
+    ReservationStore for the 'dhcp_reservations' section. With strict, entries
+    that no longer fit (scope removed or shrunk) are skipped and returned as
+    errors; editors pass strict=False so such entries are kept, not dropped.
+    """
+    if scopes is None:
+        scopes, _errors = build_scopes(config)
+    store = ReservationStore(scopes)
+    errors = []
+    for entry in config.get('dhcp_reservations', []):
+        try:
+            store.add(entry.get('mac'), entry.get('ip'), entry.get('hostname', ''), check_scope=strict,
+                      plan=entry.get('plan', ''))
+        except ValueError as e:
+            errors.append(str(e))
+    return store, errors
+
+
+def render_dhcpd_conf(scopes, store):
+    """
+    Yields dhcpd.conf in chunks as the template renders, one statement at a time.
+    """
+    return template_service.render_stream('dhcpd.conf.j2', scopes=scopes, store=store, max_lease_factor=MAX_LEASE_FACTOR)
@@ -0,0 +1,27 @@
+import sys
+
+# Cooperative serving (gunicorn gevent workers, see gunicorn_config.py). Under
+# gevent's monkey patching, sockets, sleeps, locks, threads, selectors and
+# subprocesses already yield to the other clients of the worker. Calls that
+# block inside C do not: flock(), psutil's /proc readers and large /proc
+# reads. blocking() runs those on gevent's pool of native threads instead.
+# Without gevent (sync workers, tests, scripts) it simply calls the function.
+
+
+def active():
+    """
+    True if this process runs with gevent's monkey patching.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    return bool(monkey and monkey.is_module_patched('socket'))
+
+
+def blocking(func, *args, **kwargs):
+    """
+    func(*args, **kwargs), run so that it does not stall the other greenlets.
+    func must not use locks or other gevent objects: it runs in a real thread.
+    """
+    if not active():
+        return func(*args, **kwargs)
+    import gevent
+    return gevent.get_hub().threadpool.apply(func, args, kwargs)
@@ -0,0 +1,329 @@
+import collections
+import errno
+import ipaddress
+import os
+import socket
+import struct
+import threading
+import time
+import psutil
+from app.services import green
+
+# rtnetlink message types / multicast groups (linux/rtnetlink.h)
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+NLMSG_OVERRUN = 4
+
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_BROADCAST = 4
+IFF_UP = 0x1
+IFF_RUNNING = 0x40
+RT_SCOPE_LINK = 253
+
+_NLMSGHDR = struct.Struct('=IHHII')
+_IFINFOMSG = struct.Struct('=BxHiII')
+_IFADDRMSG = struct.Struct('=BBBBI')
+_RTATTR = struct.Struct('=HH')
+
+# Without netlink (non-Linux dev machines) the inventory is rebuilt at most this often
+FALLBACK_TTL = 5.0
+# Number of hotplug events kept for detect_new_cards() callers that fall behind
+EVENT_HISTORY = 512
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _parse_attrs(data, offset, end):
+    attrs = {}
+    while offset + _RTATTR.size <= end:
+        length, kind = _RTATTR.unpack_from(data, offset)
+        if length < _RTATTR.size:
+            break
+        attrs[kind] = data[offset + _RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def _read_speed(name):
+    # Same value psutil reports; -1 (unknown, e.g. link down) is shown as 0
+    try:
+        with open(f'/sys/class/net/{name}/speed', 'r') as f:
+            return max(int(f.read().strip()), 0)
+    except (OSError, ValueError):
+        return 0
+
+
+class InterfaceInventory:
+    """
+    In-memory interface list, built once from psutil and then kept current by an
+    rtnetlink listener thread that applies link/address add, remove and change
+    events as deltas. Each worker process owns one inventory. Event sequence
+    numbers are microsecond timestamps, so a cursor from one worker means the
+    same on any other (they all hear the same kernel events).
+    """
+
+    def __init__(self, is_wireless):
+        self._is_wireless = is_wireless
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._interfaces = {}
+        self._names = {}
+        self._events = collections.deque(maxlen=EVENT_HISTORY)
+        self._seq = 0
+        self._pid = None
+        self._listening = False
+        self._loaded_at = 0.0
+
+    # --- public API ---
+
+    def snapshot(self):
+        """
+        Returns a list of interface dicts (private copies, safe to modify).
+        """
+        self._ensure_started()
+        if not self._listening and time.monotonic() - self._loaded_at > FALLBACK_TTL:
+            self.resync()
+        with self._lock:
+            return [
+                dict(info, addresses=[dict(addr) for addr in info['addresses']])
+                for info in self._interfaces.values()
+            ]
+
+    def events_since(self, since=0, timeout=0):
+        """
+        Returns (seq, events) with all hotplug events newer than since, waiting
+        up to timeout seconds for one to arrive. seq is the cursor for the next
+        call: the last event returned, or since if there was none.
+        """
+        self._ensure_started()
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while self._seq <= since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            events = [event for event in self._events if event['seq'] > since]
+            return (events[-1]['seq'] if events else since), events
+
+    def resync(self, emit=True):
+        """
+        Rebuilds the inventory from psutil and emits events for the differences
+        (unless emit is False: the initial load is not a hotplug).
+        """
+        stats = green.blocking(psutil.net_if_stats)
+        addrs = green.blocking(psutil.net_if_addrs)
+        try:
+            indexes = {name: index for index, name in socket.if_nameindex()}
+        except (AttributeError, OSError):
+            indexes = {}
+
+        fresh = {}
+        for name, stat in stats.items():
+            info = {
+                'name': name,
+                'is_up': stat.isup,
+                'speed': stat.speed,
+                'mtu': stat.mtu,
+                'is_wireless': self._is_wireless(name),
+                'addresses': []
+            }
+            for addr in addrs.get(name, []):
+                if addr.family == socket.AF_INET:
+                    info['addresses'].append({
+                        'family': 'IPv4',
+                        'address': addr.address,
+                        'netmask': addr.netmask,
+                        'broadcast': addr.broadcast
+                    })
+                elif addr.family == socket.AF_INET6:
+                    info['addresses'].append({
+                        'family': 'IPv6',
+                        'address': addr.address
+                    })
+            fresh[name] = info
+
+        with self._lock:
+            old = self._interfaces if emit else fresh
+            for name in fresh:
+                if name not in old:
+                    self._emit('added', name)
+                elif old[name]['is_up'] != fresh[name]['is_up']:
+                    self._emit('changed', name)
+            for name in old:
+                if name not in fresh:
+                    self._emit('removed', name)
+            self._interfaces = fresh
+            self._names = {index: name for name, index in indexes.items() if name in fresh}
+            self._loaded_at = time.monotonic()
+
+    # --- internals ---
+
+    def _emit(self, kind, name):
+        # Caller holds self._lock. Strictly increasing even if the clock steps back
+        self._seq = max(self._seq + 1, int(time.time() * 1000000))
+        self._events.append({'seq': self._seq, 'event': kind, 'name': name, 'time': time.time()})
+        self._changed.notify_all()
+
+    def _ensure_started(self):
+        # Threads don't survive fork(); restart the listener in each worker process
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._listening = False
+            sock = self._open_netlink()
+            # Subscribe before the initial scan so no change between the two is lost
+            self.resync(emit=False)
+            if sock is not None:
+                self._listening = True
+                threading.Thread(target=self._listen, args=(sock,), name='netlink-inventory', daemon=True).start()
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _open_netlink():
+        if not hasattr(socket, 'AF_NETLINK'):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+            return sock
+        except OSError:
+            return None
+
+    def _listen(self, sock):
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    # Kernel dropped events (burst of PPPoE logins, etc.): start over
+                    self.resync()
+                    continue
+                self._listening = False
+                return
+            try:
+                self._handle(data)
+            except (struct.error, ValueError):
+                self.resync()
+
+    def _handle(self, data):
+        offset = 0
+        while offset + _NLMSGHDR.size <= len(data):
+            length, kind, _flags, _seq, _pid = _NLMSGHDR.unpack_from(data, offset)
+            if length < _NLMSGHDR.size:
+                break
+            body = offset + _NLMSGHDR.size
+            end = offset + length
+            if kind == NLMSG_OVERRUN:
+                self.resync()
+            elif kind in (RTM_NEWLINK, RTM_DELLINK):
+                self._handle_link(kind, data, body, end)
+            elif kind in (RTM_NEWADDR, RTM_DELADDR):
+                self._handle_addr(kind, data, body, end)
+            offset += _align(length)
+
+    def _handle_link(self, kind, data, body, end):
+        _family, _type, index, flags, _change = _IFINFOMSG.unpack_from(data, body)
+        attrs = _parse_attrs(data, body + _IFINFOMSG.size, end)
+        name = attrs.get(IFLA_IFNAME, b'').rstrip(b'\0').decode('utf-8', 'replace') or self._names.get(index)
+        if not name:
+            return
+
+        if kind == RTM_DELLINK:
+            with self._lock:
+                self._names.pop(index, None)
+                if self._interfaces.pop(name, None) is not None:
+                    self._emit('removed', name)
+            return
+
+        is_up = bool(flags & IFF_UP) and bool(flags & IFF_RUNNING)
+        mtu = struct.unpack('=I', attrs[IFLA_MTU])[0] if IFLA_MTU in attrs else None
+        # Only touch sysfs for new links or when the link state flips
+        with self._lock:
+            info = self._interfaces.get(name)
+            old_name = self._names.get(index)
+            needs_speed = info is None or info['is_up'] != is_up
+        if needs_speed:
+            speed = _read_speed(name)
+        wireless = self._is_wireless(name) if info is None else None
+
+        with self._lock:
+            if old_name and old_name != name and old_name in self._interfaces:
+                # Interface was renamed (udev naming)
+                renamed = self._interfaces.pop(old_name)
+                renamed['name'] = name
+                self._interfaces[name] = renamed
+                self._emit('removed', old_name)
+                self._emit('added', name)
+            self._names[index] = name
+            info = self._interfaces.get(name)
+            if info is None:
+                self._interfaces[name] = {
+                    'name': name,
+                    'is_up': is_up,
+                    'speed': speed,
+                    'mtu': mtu or 0,
+                    'is_wireless': wireless,
+                    'addresses': []
+                }
+                self._emit('added', name)
+                return
+            if mtu is not None:
+                info['mtu'] = mtu
+            if needs_speed:
+                info['speed'] = speed
+            if info['is_up'] != is_up:
+                info['is_up'] = is_up
+                self._emit('changed', name)
+
+    def _handle_addr(self, kind, data, body, end):
+        family, prefixlen, _flags, scope, index = _IFADDRMSG.unpack_from(data, body)
+        attrs = _parse_attrs(data, body + _IFADDRMSG.size, end)
+
+        with self._lock:
+            name = self._names.get(index)
+            info = self._interfaces.get(name) if name else None
+            if info is None:
+                return
+
+            if family == socket.AF_INET:
+                # On point-to-point links (ppp*) IFA_ADDRESS is the peer, IFA_LOCAL our side
+                raw = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+                if not raw:
+                    return
+                address = socket.inet_ntop(socket.AF_INET, raw)
+                entry = {
+                    'family': 'IPv4',
+                    'address': address,
+                    'netmask': str(ipaddress.IPv4Network(f'0.0.0.0/{prefixlen}').netmask),
+                    'broadcast': socket.inet_ntop(socket.AF_INET, attrs[IFA_BROADCAST]) if IFA_BROADCAST in attrs else None
+                }
+            elif family == socket.AF_INET6:
+                raw = attrs.get(IFA_ADDRESS) or attrs.get(IFA_LOCAL)
+                if not raw:
+                    return
+                address = socket.inet_ntop(socket.AF_INET6, raw)
+                if scope == RT_SCOPE_LINK:
+                    address = f'{address}%{name}'
+                entry = {'family': 'IPv6', 'address': address}
+            else:
+                return
+
+            addresses = [a for a in info['addresses'] if not (a['family'] == entry['family'] and a['address'] == address)]
+            if kind == RTM_NEWADDR:
+                addresses.append(entry)
+            info['addresses'] = addresses
@@ -0,0 +1,390 @@
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from app.services import apply_service, config_service, green
+
+try:
+    import fcntl
+except ImportError:  # Windows dev environment: single process only
+    fcntl = None
+
+# Job state lives on disk so that any gunicorn worker can answer status and
+# stream requests, no matter which worker accepted the apply.
+JOBS_DIR = 'config/jobs'
+# Number of finished jobs kept around for status lookups
+MAX_JOBS = 50
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{12}$')
+_PENDING_FILE = 'pending'
+# Config revision of the last apply that succeeded (and was confirmed, if asked to)
+_APPLIED_FILE = 'applied-revision'
+# How often a job waiting for confirmation looks for it
+CONFIRM_POLL = 0.5
+_STATE_LOCK = '.state.lock'
+_RUN_LOCK = '.run.lock'
+# A job whose process died (worker timeout, recycle, restart) is taken over by
+# another process this many times before it is given up as failed
+MAX_RESUMES = 2
+
+# States of a job some process is working on
+_IN_FLIGHT = ('running', 'awaiting_confirmation', 'rolling_back')
+
+_thread_lock = threading.Lock()
+_worker_thread = None
+
+
+@contextlib.contextmanager
+def _file_lock(name):
+    """
+    Exclusive lock shared by all worker processes (blocks until acquired).
+    """
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    with open(os.path.join(JOBS_DIR, name), 'a') as f:
+        if fcntl:
+            green.blocking(fcntl.flock, f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _job_path(job_id, ext):
+    return os.path.join(JOBS_DIR, f'{job_id}.{ext}')
+
+
+def _write_job(job):
+    path = _job_path(job['id'], 'json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, path)
+
+
+def _read_pending():
+    try:
+        with open(os.path.join(JOBS_DIR, _PENDING_FILE), 'r') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def _write_pending(job_id):
+    path = os.path.join(JOBS_DIR, _PENDING_FILE)
+    if job_id is None:
+        if os.path.exists(path):
+            os.unlink(path)
+        return
+    with open(path, 'w') as f:
+        f.write(job_id)
+
+
+def _read_applied():
+    try:
+        with open(os.path.join(JOBS_DIR, _APPLIED_FILE), 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_applied(revision):
+    path = os.path.join(JOBS_DIR, _APPLIED_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write(f'{revision}\n')
+    os.replace(path + '.tmp', path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def get_job(job_id):
+    """
+    Returns the job record, or None if the id is unknown.
+    """
+    if not job_id or not _JOB_ID_RE.match(job_id):
+        return None
+    try:
+        with open(_job_path(job_id, 'json'), 'r') as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if job['state'] in _IN_FLIGHT and job.get('pid') and not _pid_alive(job['pid']):
+        # The worker running it was killed; the next process calling
+        # resume_orphans() takes it over: it continues the apply, the wait for
+        # confirmation (deadline and rollback revision are in the record) or
+        # the rollback
+        job['orphaned'] = True
+    return job
+
+
+def read_log(job_id, offset=0):
+    """
+    Returns (entries, new_offset) for log lines appended after offset.
+    Each entry is {'t', 'stream', 'line'}.
+    """
+    entries = []
+    try:
+        with open(_job_path(job_id, 'log'), 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except OSError:
+        return entries, offset
+    # Only consume complete lines; a partially written one is picked up next time
+    end = data.rfind(b'\n') + 1
+    for raw in data[:end].splitlines():
+        try:
+            entries.append(json.loads(raw))
+        except ValueError:
+            continue
+    return entries, offset + end
+
+
+def _prune_jobs():
+    jobs = []
+    for name in os.listdir(JOBS_DIR):
+        if name.endswith('.json'):
+            path = os.path.join(JOBS_DIR, name)
+            jobs.append((os.path.getmtime(path), name[:-5]))
+    jobs.sort(reverse=True)
+    for _mtime, job_id in jobs[MAX_JOBS:]:
+        job = get_job(job_id)
+        if job and (job['state'] == 'queued' or job['state'] in _IN_FLIGHT):
+            continue
+        for ext in ('json', 'log'):
+            with contextlib.suppress(OSError):
+                os.unlink(_job_path(job_id, ext))
+
+
+def submit_apply(force=False, confirm_timeout=None):
+    """
+    Queues an apply and returns its job id immediately.
+    Applies are single-flight: while one runs, all further requests merge into
+    one pending job that runs once the current apply is done.
+    With confirm_timeout (seconds), a successful apply waits for
+    confirm_apply(); without it in time, the config of the last applied
+    revision is restored and applied again. Raises ValueError if nothing was
+    applied yet, since there would be nothing to go back to.
+    """
+    if confirm_timeout and _read_applied() is None:
+        raise ValueError('Nothing has been applied yet, so there is no earlier configuration to roll back to. '
+                         'Apply once without confirmation first.')
+    with _file_lock(_STATE_LOCK):
+        pending_id = _read_pending()
+        job = get_job(pending_id)
+        if job and job['state'] == 'queued':
+            job['merged'] = job.get('merged', 0) + 1
+            job['force'] = job['force'] or force
+            if confirm_timeout:
+                job['confirm_timeout'] = min(job.get('confirm_timeout') or confirm_timeout, confirm_timeout)
+            _write_job(job)
+        else:
+            job = {
+                'id': uuid.uuid4().hex[:12],
+                'state': 'queued',
+                'force': force,
+                'merged': 0,
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'report': None,
+                'summary': None,
+                'confirm_timeout': confirm_timeout,
+            }
+            _write_job(job)
+            _write_pending(job['id'])
+            _prune_jobs()
+    _ensure_worker()
+    return job['id']
+
+
+def _ensure_worker():
+    global _worker_thread
+    with _thread_lock:
+        if _worker_thread is None:
+            _worker_thread = threading.Thread(target=_worker, name='apply-jobs', daemon=True)
+            _worker_thread.start()
+
+
+def resume_orphans():
+    """
+    Makes sure jobs left behind by a dead process are taken over by this one.
+    Called at startup and whenever a status request notices such a job.
+    """
+    _ensure_worker()
+
+
+def _claim_orphan():
+    with _file_lock(_STATE_LOCK):
+        for name in sorted(os.listdir(JOBS_DIR)):
+            if not name.endswith('.json'):
+                continue
+            job = get_job(name[:-5])
+            if not job or not job.pop('orphaned', False):
+                continue
+            if job.get('resumed', 0) >= MAX_RESUMES:
+                job['state'] = 'failed'
+                job['error'] = f"Worker process exited during apply (gave up after {job['resumed']} resumes)"
+                job['finished'] = time.time()
+                _write_job(job)
+                continue
+            job['resumed'] = job.get('resumed', 0) + 1
+            job['pid'] = os.getpid()
+            _write_job(job)
+            return job
+    return None
+
+
+def _claim_pending():
+    with _file_lock(_STATE_LOCK):
+        job = get_job(_read_pending())
+        _write_pending(None)
+        if not job or job['state'] != 'queued':
+            return None
+        job['state'] = 'running'
+        job['started'] = time.time()
+        job['pid'] = os.getpid()
+        _write_job(job)
+        return job
+
+
+def confirm_apply(job_id):
+    """
+    Confirms an apply that waits for it. Returns the job, or None if that job
+    is not waiting (unknown, not in confirm mode or already rolled back).
+    """
+    with _file_lock(_STATE_LOCK):
+        job = get_job(job_id)
+        if not job or job['state'] != 'awaiting_confirmation':
+            return None
+        job['confirmed'] = time.time()
+        _write_job(job)
+        return job
+
+
+def _await_confirmation(job, log):
+    """
+    Waits until confirm_apply() marks the job or its deadline passes.
+    Returns True if it was confirmed.
+    """
+    with _file_lock(_STATE_LOCK):
+        job['state'] = 'awaiting_confirmation'
+        # A resumed job keeps the deadline it was given; an overdue one rolls back right away
+        job.setdefault('confirm_deadline', time.time() + job['confirm_timeout'])
+        _write_job(job)
+    remaining = max(job['confirm_deadline'] - time.time(), 0)
+    log('info', f"Waiting {remaining:.0f} s for confirmation; without it revision "
+                f"{job['rollback_revision']} is restored.")
+    while time.time() < job['confirm_deadline']:
+        time.sleep(CONFIRM_POLL)
+        current = get_job(job['id']) or {}
+        if current.get('confirmed'):
+            job['confirmed'] = current['confirmed']
+            log('info', 'Apply confirmed.')
+            return True
+    with _file_lock(_STATE_LOCK):
+        # A confirmation that arrived with the deadline still counts; after this none is accepted
+        current = get_job(job['id']) or {}
+        if current.get('confirmed'):
+            job['confirmed'] = current['confirmed']
+            log('info', 'Apply confirmed.')
+            return True
+        job['state'] = 'rolling_back'
+        _write_job(job)
+    return False
+
+
+def _rollback(job, log):
+    if not job.get('rollback'):
+        revision = job['rollback_revision']
+        log('info', f'Not confirmed in time; restoring revision {revision}.')
+        new_revision, changed = config_service.rollback_config(revision)
+        # Recorded before applying, so a resumed rollback only applies again
+        job['rollback'] = {'revision': new_revision}
+        _write_job(job)
+        log('info', f"Restored as revision {new_revision} ({', '.join(changed) or 'no artifacts changed'}).")
+    new_revision = job['rollback']['revision']
+    report = apply_service.apply_changes(log=log)
+    job['rollback'].update(report=report, summary=apply_service.summarize(report))
+    if any(e['status'] == 'failed' for e in report):
+        return 'failed'
+    _write_applied(new_revision)
+    return 'rolled_back'
+
+
+def _apply(job, log):
+    revision = config_service.config_revision()
+    job['revision'] = revision
+    report = apply_service.apply_changes(force=job['force'], log=log)
+    job['report'] = report
+    job['summary'] = apply_service.summarize(report)
+    job['warnings'] = config_service.generator_warnings()
+    job['state'] = 'failed' if any(e['status'] == 'failed' for e in report) else 'succeeded'
+    if job['state'] != 'succeeded' or not job.get('confirm_timeout'):
+        return
+    job['rollback_revision'] = _read_applied()
+    if job['rollback_revision'] is None:
+        # submit_apply() refuses this; only reachable if the record went missing since
+        job['unprotected'] = True
+        log('stderr', 'No earlier applied revision to roll back to: this apply is NOT protected by a rollback.')
+    elif job['rollback_revision'] == revision:
+        log('info', f'Revision {revision} is already the last applied one; not waiting for confirmation.')
+    elif _await_confirmation(job, log):
+        job['state'] = 'succeeded'
+    else:
+        job['state'] = _rollback(job, log)
+
+
+def _run_job(job):
+    log_file = open(_job_path(job['id'], 'log'), 'a')
+
+    def log(stream, line):
+        log_file.write(json.dumps({'t': round(time.time(), 3), 'stream': stream, 'line': line}) + '\n')
+        log_file.flush()
+
+    if job.get('resumed'):
+        log('info', f"The process running this apply exited; resuming it in process {job['pid']}.")
+    try:
+        if job['state'] == 'running':
+            _apply(job, log)
+        elif job['state'] == 'awaiting_confirmation':
+            job['state'] = 'succeeded' if _await_confirmation(job, log) else _rollback(job, log)
+        elif job['state'] == 'rolling_back':
+            job['state'] = _rollback(job, log)
+        if job['state'] == 'succeeded':
+            _write_applied(job['revision'])
+    except Exception as e:
+        log('stderr', f'Unexpected error: {e}')
+        job['state'] = 'failed'
+        job['error'] = str(e)
+    finally:
+        log_file.close()
+    job['finished'] = time.time()
+    _write_job(job)
+
+
+def _worker():
+    global _worker_thread
+    while True:
+        # Only one apply runs at a time across all worker processes
+        with _file_lock(_RUN_LOCK):
+            with _thread_lock:
+                job = _claim_orphan() or _claim_pending()
+                if job is None:
+                    _worker_thread = None
+                    return
+            _run_job(job)
+
+
+def is_finished(job):
+    return job['state'] in ('succeeded', 'failed', 'rolled_back')
@@ -0,0 +1,69 @@
+import copy
+
+# The subset of RFC 6902 JSON Patch the config history needs: 'add' (which
+# replaces an existing object member) and 'remove' on object members, and
+# 'add' of a whole value. Lists are replaced as a whole rather than diffed by
+# index; config lists are short, the big collections are objects.
+
+
+def pointer(*parts):
+    """
+    JSON Pointer (RFC 6901) for a path of object keys: ('a/b', 'c~') -> '/a~1b/c~0'.
+    """
+    return ''.join('/' + str(p).replace('~', '~0').replace('/', '~1') for p in parts)
+
+
+def _split(path):
+    return [p.replace('~1', '/').replace('~0', '~') for p in path.split('/')[1:]]
+
+
+def same(a, b):
+    """
+    Equality as the stored JSON sees it: 1, 1.0 and True are three different values.
+    """
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same(a[key], b[key]) for key in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    return type(a) is type(b) and a == b
+
+
+def make_patch(old, new, path=''):
+    """
+    Patch operations turning old into new. Objects are compared member by
+    member, so a change deep inside a big section is one small operation.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({'op': 'remove', 'path': path + pointer(key)})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({'op': 'add', 'path': path + pointer(key), 'value': value})
+            elif not same(old[key], value):
+                ops.extend(make_patch(old[key], value, path + pointer(key)))
+        return ops
+    if same(old, new):
+        return []
+    return [{'op': 'add', 'path': path, 'value': new}]
+
+
+def apply_patch(doc, ops):
+    """
+    Applies operations from make_patch() to doc and returns the result. doc is
+    changed in place where possible; values taken from ops are copied.
+    """
+    for op in ops:
+        parts = _split(op['path'])
+        if not parts:
+            doc = copy.deepcopy(op['value'])
+            continue
+        target = doc
+        for part in parts[:-1]:
+            target = target[int(part)] if isinstance(target, list) else target[part]
+        if op['op'] == 'remove':
+            target.pop(int(parts[-1]) if isinstance(target, list) else parts[-1], None)
+        else:
+            target[parts[-1]] = copy.deepcopy(op['value'])
+    return doc
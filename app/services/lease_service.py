@@ -0,0 +1,233 @@
+import calendar
+import mmap
+import os
+import re
+import socket
+import threading
+import time
+
+# ISC dhcpd appends every lease change to this file and periodically rewrites it
+# from scratch (new file renamed over the old one). The index below only ever
+# parses what was appended since its last read, and starts over on a rewrite.
+LEASES_FILE = '/var/lib/dhcp/dhcpd.leases'
+# The file is stat()ed at most this often, however many requests come in
+REFRESH_INTERVAL = 1.0
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+_LEASE_RE = re.compile(rb'^lease\s+(\d{1,3}(?:\.\d{1,3}){3})\s*\{(.*?)^\}', re.M | re.S)
+_BLOCK_END = b'\n}\n'
+_TIME_RE = re.compile(r'^\d (\d{4})/(\d\d)/(\d\d) (\d\d):(\d\d):(\d\d)$')
+
+
+def _parse_time(value):
+    """
+    'W YYYY/MM/DD HH:MM:SS' (UTC), 'epoch N' or 'never'. Returns epoch seconds or None.
+    """
+    value = value.strip()
+    if value.startswith('epoch '):
+        try:
+            return int(value[6:])
+        except ValueError:
+            return None
+    # Parsed by hand: strptime is the slowest part of reading a large lease file
+    match = _TIME_RE.match(value)
+    if not match:
+        return None
+    return calendar.timegm(tuple(int(v) for v in match.groups()))
+
+
+def parse_lease(ip, body):
+    """
+    Turns the body of one 'lease <ip> { ... }' block into a dict.
+    """
+    lease = {'ip': ip, 'mac': None, 'hostname': None, 'state': None, 'starts': None, 'ends': None}
+    for line in body.decode('utf-8', 'replace').split('\n'):
+        # Statements end with ';', optionally followed by a '# ...' comment
+        keyword, _, value = line.strip().partition(' ')
+        value = value.split(';', 1)[0]
+        if keyword == 'starts':
+            lease['starts'] = _parse_time(value)
+        elif keyword == 'ends':
+            lease['ends'] = _parse_time(value)
+        elif keyword == 'binding' and value.startswith('state '):
+            lease['state'] = value[6:]
+        elif keyword == 'hardware' and value.startswith('ethernet '):
+            lease['mac'] = value[9:].lower()
+        elif keyword == 'client-hostname':
+            lease['hostname'] = value.strip('"')
+    return lease
+
+
+def is_active(lease, now=None):
+    now = time.time() if now is None else now
+    return lease['state'] == 'active' and (lease['ends'] is None or lease['ends'] > now)
+
+
+class LeaseIndex:
+    """
+    In-memory view of dhcpd.leases. The last lease statement for an address wins
+    (that is how dhcpd itself reads the file), and the leases are indexed by IP,
+    MAC and hostname. New bytes are read through an mmap of the file starting at
+    the last parsed offset, so a refresh costs one stat() when nothing changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._inode = None
+        self._offset = 0
+        self._checked = 0.0
+        self._by_ip = {}
+        self._by_mac = {}
+        self._by_hostname = {}
+        self._order = None
+
+    def refresh(self, force=False):
+        """
+        Parses whatever dhcpd appended since the last call.
+        Returns the number of lease statements read.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked < REFRESH_INTERVAL:
+                return 0
+            self._checked = now
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                self._reset(None)
+                return 0
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                # dhcpd rewrote the file: everything in it is current, start over
+                self._reset(st.st_ino)
+            if st.st_size == self._offset:
+                return 0
+            return self._read_tail(st.st_size)
+
+    def _reset(self, inode):
+        self._inode = inode
+        self._offset = 0
+        self._by_ip = {}
+        self._by_mac = {}
+        self._by_hostname = {}
+        self._order = None
+
+    def _read_tail(self, size):
+        try:
+            with open(self.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return 0
+        with mm:
+            # Only complete blocks: dhcpd may be in the middle of appending one
+            end = mm.rfind(_BLOCK_END, self._offset)
+            if end < 0:
+                return 0
+            end += len(_BLOCK_END)
+            count = 0
+            for match in _LEASE_RE.finditer(mm[self._offset:end]):
+                self._store(parse_lease(match.group(1).decode('ascii'), match.group(2)))
+                count += 1
+            self._offset = end
+        return count
+
+    def _store(self, lease):
+        ip = lease['ip']
+        old = self._by_ip.get(ip)
+        if old is not None:
+            if old['mac'] and self._by_mac.get(old['mac']) == ip:
+                del self._by_mac[old['mac']]
+            if old['hostname']:
+                owners = self._by_hostname.get(old['hostname'].lower())
+                if owners:
+                    owners.discard(ip)
+                    if not owners:
+                        del self._by_hostname[old['hostname'].lower()]
+        else:
+            self._order = None
+        self._by_ip[ip] = lease
+        if lease['mac']:
+            self._by_mac[lease['mac']] = ip
+        if lease['hostname']:
+            self._by_hostname.setdefault(lease['hostname'].lower(), set()).add(ip)
+
+    def _sorted_ips(self):
+        if self._order is None:
+            self._order = sorted(self._by_ip, key=socket.inet_aton)
+        return self._order
+
+    def lookup(self, key):
+        """
+        Lease of a client by IP or MAC address, or None.
+        """
+        self.refresh()
+        key = key.strip().lower()
+        with self._lock:
+            ip = self._by_mac.get(key.replace('-', ':'), key)
+            lease = self._by_ip.get(ip)
+            return dict(lease, active=is_active(lease)) if lease else None
+
+    def query(self, mac=None, ip=None, hostname=None, search=None, state='active', offset=0, limit=DEFAULT_LIMIT):
+        """
+        Returns {'total', 'offset', 'limit', 'leases'} ordered by IP address.
+        mac, ip and hostname are exact lookups through the indexes; search is a
+        substring match over all three. state is 'active' or 'all'.
+        """
+        self.refresh()
+        now = time.time()
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        offset = max(0, int(offset))
+        with self._lock:
+            if mac or ip or hostname:
+                candidates = None
+                for keys in (
+                    {self._by_mac.get(mac.lower().replace('-', ':'))} if mac else None,
+                    {ip} if ip else None,
+                    self._by_hostname.get(hostname.lower(), set()) if hostname else None,
+                ):
+                    if keys is not None:
+                        candidates = keys if candidates is None else candidates & keys
+                ips = sorted((i for i in candidates if i in self._by_ip), key=socket.inet_aton)
+            else:
+                ips = self._sorted_ips()
+
+            leases = (self._by_ip[i] for i in ips)
+            if state != 'all':
+                leases = (lease for lease in leases if is_active(lease, now))
+            if search:
+                needle = search.lower()
+                leases = (lease for lease in leases if needle in lease['ip']
+                          or needle in (lease['mac'] or '') or needle in (lease['hostname'] or '').lower())
+            matched = list(leases)
+
+        return {
+            'total': len(matched),
+            'offset': offset,
+            'limit': limit,
+            'leases': [dict(lease, active=is_active(lease, now)) for lease in matched[offset:offset + limit]]
+        }
+
+    def counts(self):
+        self.refresh()
+        now = time.time()
+        with self._lock:
+            return {
+                'total': len(self._by_ip),
+                'active': sum(1 for lease in self._by_ip.values() if is_active(lease, now))
+            }
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    The process-wide lease index for LEASES_FILE.
+    """
+    global _index
+    with _index_lock:
+        if _index is None or _index.path != LEASES_FILE:
+            _index = LeaseIndex(LEASES_FILE)
+        return _index
@@ -0,0 +1,188 @@
+import os
+import threading
+
+# prometheus_client is optional: without it every hook below is a no-op and
+# /metrics answers 503. Under gunicorn, gunicorn_config.py points
+# PROMETHEUS_MULTIPROC_DIR at a shared directory before any worker imports
+# this module, so samples from all workers are aggregated at scrape time.
+# The library is only imported (and the metrics created) when the first
+# sample is recorded, so the CLI tools importing config_service stay quick.
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def _get():
+    """
+    {name: metric}, or None if prometheus_client is not installed.
+    """
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = _create() or {}
+    return _metrics or None
+
+
+def _create():
+    try:
+        from prometheus_client import Counter, Histogram
+    except ImportError:
+        return None
+    return {
+        'request_latency': Histogram(
+            'ubunturouter_http_request_duration_seconds',
+            'Time spent handling requests of the main blueprint',
+            ['endpoint', 'method', 'status']
+        ),
+        'generator_duration': Histogram(
+            'ubunturouter_generator_duration_seconds',
+            'Time spent in each config generator',
+            ['generator'],
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+        ),
+        'apply_duration': Histogram(
+            'ubunturouter_apply_duration_seconds',
+            'Time spent applying each subsystem',
+            ['subsystem'],
+            buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+        ),
+        'apply_results': Counter(
+            'ubunturouter_apply_total',
+            'Subsystem applies by outcome',
+            ['subsystem', 'status']
+        ),
+        'apply_commands': Counter(
+            'ubunturouter_apply_commands_total',
+            'Activation commands run by subsystem and exit status',
+            ['subsystem', 'exit_code']
+        ),
+        'config_cache': Counter(
+            'ubunturouter_config_cache_requests_total',
+            'load_config() lookups by cache result',
+            ['result']
+        )
+    }
+
+
+def observe_request(endpoint, method, status, seconds):
+    metrics = _get()
+    if metrics:
+        metrics['request_latency'].labels(endpoint or 'unknown', method, str(status)).observe(seconds)
+
+
+def observe_generator(name, seconds):
+    metrics = _get()
+    if metrics:
+        metrics['generator_duration'].labels(name).observe(seconds)
+
+
+def observe_apply(entry):
+    """
+    Records one entry of an apply_service report.
+    """
+    metrics = _get()
+    if not metrics or entry['status'] == 'unchanged':
+        return
+    metrics['apply_duration'].labels(entry['name']).observe(entry['duration'])
+    metrics['apply_results'].labels(entry['name'], entry['status']).inc()
+    for action in entry['actions']:
+        metrics['apply_commands'].labels(entry['name'], str(action['returncode'])).inc()
+
+
+def observe_config_cache(hit):
+    metrics = _get()
+    if metrics:
+        metrics['config_cache'].labels('hit' if hit else 'miss').inc()
+
+
+class _InterfaceCollector:
+    """
+    Exposes the counters of the shared interface sampler. They already live in
+    one place for all workers, so they are read at scrape time instead of being
+    mirrored into per-process metrics.
+    """
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+        from app.services import stats_service
+
+        counters = stats_service.get_all_counters()
+        families = {}
+        for field in stats_service.FIELDS:
+            direction, kind = field.split('_', 1)
+            name = f"ubunturouter_interface_{'receive' if direction == 'rx' else 'transmit'}_{kind}"
+            families[field] = CounterMetricFamily(name, f'Interface {field.replace("_", " ")} counter', labels=['interface'])
+        rates = GaugeMetricFamily('ubunturouter_interface_bits_per_second', 'Current interface bit rate', labels=['interface', 'direction'])
+
+        for iface, values in counters.items():
+            for field, value in values.items():
+                families[field].add_metric([iface], value)
+        for iface, values in stats_service.get_all_rates().items():
+            rates.add_metric([iface, 'rx'], values['rx_bytes'] * 8)
+            rates.add_metric([iface, 'tx'], values['tx_bytes'] * 8)
+
+        yield from families.values()
+        yield rates
+
+
+class _ConntrackCollector:
+    """
+    Conntrack table fill and drop counters, read from procfs at scrape time.
+    """
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+        from app.services import conntrack_service
+
+        status = conntrack_service.read_status(breakdown=False)
+        if not status['available']:
+            return
+        yield GaugeMetricFamily('ubunturouter_conntrack_entries', 'Entries in the conntrack table', value=status['count'])
+        yield GaugeMetricFamily('ubunturouter_conntrack_max', 'nf_conntrack_max', value=status['max'])
+        yield GaugeMetricFamily('ubunturouter_conntrack_buckets', 'Conntrack hash table buckets', value=status['buckets'])
+        events = CounterMetricFamily('ubunturouter_conntrack_events', 'Conntrack failure counters summed over CPUs', labels=['event'])
+        for name, value in status['stats'].items():
+            events.add_metric([name], value)
+        yield events
+
+
+_default_registered = False
+
+
+def render():
+    """
+    Returns (body, content type) for the /metrics endpoint, or None if
+    prometheus_client is not installed.
+    """
+    global _default_registered
+    if not _get():
+        return None
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, multiprocess
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(_InterfaceCollector())
+        registry.register(_ConntrackCollector())
+    else:
+        registry = prometheus_client.REGISTRY
+        if not _default_registered:
+            registry.register(_InterfaceCollector())
+            registry.register(_ConntrackCollector())
+            _default_registered = True
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """
+    gunicorn child_exit hook: drops the live gauges of a dead worker.
+    """
+    if not MULTIPROC_DIR:
+        return
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(pid)
@@ -1,7 +1,6 @@
-import psutil
-import socket
 import platform
 import os
+from app.services.interface_inventory import InterfaceInventory
 
 def is_wireless(interface_name):
     """
@@ -15,46 +14,30 @@ def is_wireless(interface_name):
         # Fallback for dev environment
         return interface_name.startswith('wl') or 'wi' in interface_name.lower()
 
-def get_network_interfaces():
+# Per-subscriber links of the PPPoE server; listed by the session monitor instead
+SESSION_PREFIXES = ('ppp',)
+
+def get_network_interfaces(include_sessions=False):
     """
     Returns a list of network interfaces with their status and IP addresses.
+    Served from the netlink-maintained inventory; every call gets its own copies.
+    PPPoE session links (ppp*) are left out unless include_sessions is set.
     """
-    interfaces = []
-    stats = psutil.net_if_stats()
-    addrs = psutil.net_if_addrs()
-
-    for name, stat in stats.items():
-        if_info = {
-            'name': name,
-            'is_up': stat.isup,
-            'speed': stat.speed,
-            'mtu': stat.mtu,
-            'is_wireless': is_wireless(name),
-            'addresses': []
-        }
+    interfaces = _inventory.snapshot()
+    if include_sessions:
+        return interfaces
+    return [iface for iface in interfaces if not iface['name'].startswith(SESSION_PREFIXES)]
 
-        if name in addrs:
-            for addr in addrs[name]:
-                if addr.family == socket.AF_INET:
-                    if_info['addresses'].append({
-                        'family': 'IPv4',
-                        'address': addr.address,
-                        'netmask': addr.netmask,
-                        'broadcast': addr.broadcast
-                    })
-                elif addr.family == socket.AF_INET6:
-                    if_info['addresses'].append({
-                        'family': 'IPv6',
-                        'address': addr.address
-                    })
-        
-        interfaces.append(if_info)
-    
-    return interfaces
-
-def detect_new_cards():
+def detect_new_cards(since=0, timeout=0):
     """
-    This function would ideally run in a background loop or be triggered by udev events.
-    For the dashboard, calling get_network_interfaces() is sufficient to show current state.
+    Hotplug notifications: returns {'seq': ..., 'events': [...]} with every
+    interface added/removed/changed event after sequence number since, waiting
+    up to timeout seconds for one. Pass the returned seq as since on the next
+    call; it is a timestamp in microseconds, valid on every worker process.
+    Each event is {'seq', 'event': 'added'|'removed'|'changed', 'name', 'time'}.
     """
-    return get_network_interfaces()
+    seq, events = _inventory.events_since(since, timeout)
+    return {'seq': seq, 'events': events}
+
+# Built on first use in each worker process
+_inventory = InterfaceInventory(is_wireless)
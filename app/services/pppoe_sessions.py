@@ -0,0 +1,282 @@
+import os
+import socket
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows dev environment: no compaction
+    fcntl = None
+
+# pppd runs the ip-up/ip-down hooks generated below for every PPPoE session. Each
+# hook appends one tab separated line to EVENTS_FILE; every worker tails that log
+# from its last offset, so a dashboard hit never rescans thousands of ppp links.
+RUN_DIR = '/run/ubuntu-router'
+EVENTS_FILE = os.path.join(RUN_DIR, 'pppoe-events.log')
+LOCK_FILE = os.path.join(RUN_DIR, 'pppoe-events.lock')
+# pppoe-server sessions carry this ipparam, so PPPoE client WAN links are ignored
+IPPARAM = 'ubuntu-router'
+# The log is rewritten with only the live sessions once it grows past this size
+COMPACT_BYTES = 4 * 1024 * 1024
+REFRESH_INTERVAL = 0.5
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+SORT_KEYS = ('started', 'username', 'ip', 'iface')
+
+
+def hook_script(kind):
+    """
+    Content of the /etc/ppp/ip-up.d (kind='up') or ip-down.d (kind='down') hook.
+    """
+    fields = '"$(clean "$PPP_IFACE")" "$(clean "$PEERNAME")" "$(clean "$PPP_REMOTE")" "$(clean "$PPP_LOCAL")"'
+    fmt = 'up\\t%s\\t%s\\t%s\\t%s\\t%s'
+    if kind == 'down':
+        fields += ' "${CONNECT_TIME:-0}" "${BYTES_SENT:-0}" "${BYTES_RCVD:-0}"'
+        fmt = 'down\\t%s\\t%s\\t%s\\t%s\\t%s\\t%s\\t%s\\t%s'
+    return f'''#!/bin/sh
+# PPPoE session {kind} hook (generated by Ubuntu Router UI)
+# Feeds the session monitor; only sessions of our pppoe-server are recorded.
+[ "$PPP_IPPARAM" = "{IPPARAM}" ] || exit 0
+mkdir -p {RUN_DIR}
+clean() {{ printf '%s' "$1" | tr -d '\\t\\r\\n'; }}
+LINE=$(printf '{fmt}' "$(date +%s)" {fields})
+flock {LOCK_FILE} sh -c 'printf "%s\\n" "$1" >> "$2"' _ "$LINE" {EVENTS_FILE}
+exit 0
+'''
+
+
+def _read_counters():
+    from app.services import stats_service
+    return stats_service.read_counters()
+
+
+class SessionStore:
+    """
+    Live PPPoE sessions keyed by ppp interface, with indexes by username and
+    assigned IP. Fed incrementally from the hook event log; a rewritten log
+    (compaction, reboot) is detected by inode/size and replayed from the start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._inode = None
+        self._offset = 0
+        self._checked = 0.0
+        self._sessions = {}
+        self._by_user = {}
+        self._by_ip = {}
+        self._order = {}
+
+    def refresh(self, force=False, compact=True):
+        """
+        Applies the events appended since the last call. Returns how many were read.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked < REFRESH_INTERVAL:
+                return 0
+            self._checked = now
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                self._reset(None)
+                return 0
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                self._reset(st.st_ino)
+            if st.st_size == self._offset:
+                return 0
+            count = self._read_tail()
+        if compact and st.st_size > COMPACT_BYTES:
+            self.compact()
+        return count
+
+    def _reset(self, inode):
+        self._inode = inode
+        self._offset = 0
+        self._sessions = {}
+        self._by_user = {}
+        self._by_ip = {}
+        self._order = {}
+
+    def _read_tail(self):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except OSError:
+            return 0
+        # A hook may be half way through its write; keep the partial line for later
+        end = data.rfind(b'\n') + 1
+        count = 0
+        for line in data[:end].decode('utf-8', 'replace').split('\n'):
+            fields = line.split('\t')
+            if fields[0] == 'up' and len(fields) >= 6:
+                self._add(fields)
+                count += 1
+            elif fields[0] == 'down' and len(fields) >= 3:
+                self._remove(fields[2])
+                count += 1
+        self._offset += end
+        return count
+
+    def _add(self, fields):
+        _kind, started, iface, username, remote, local = fields[:6]
+        # ppp interface names are reused; a new session replaces whatever was there
+        self._remove(iface)
+        try:
+            started = float(started)
+        except ValueError:
+            started = time.time()
+        session = {'iface': iface, 'username': username, 'ip': remote, 'local_ip': local, 'started': started}
+        self._sessions[iface] = session
+        self._by_user.setdefault(username, set()).add(iface)
+        self._by_ip[remote] = iface
+        self._order = {}
+
+    def _remove(self, iface):
+        session = self._sessions.pop(iface, None)
+        if session is None:
+            return None
+        owners = self._by_user.get(session['username'])
+        if owners:
+            owners.discard(iface)
+            if not owners:
+                del self._by_user[session['username']]
+        if self._by_ip.get(session['ip']) == iface:
+            del self._by_ip[session['ip']]
+        self._order = {}
+        return session
+
+    def _sorted(self, key):
+        # Sorted views are cached per key until the next login/logout
+        order = self._order.get(key)
+        if order is None:
+            if key == 'ip':
+                sort_key = lambda s: _ip_key(s['ip'])
+            else:
+                sort_key = lambda s: s[key]
+            order = sorted(self._sessions.values(), key=sort_key)
+            self._order[key] = order
+        return order
+
+    def _drop_stale(self, counters):
+        # pppd killed without running ip-down: the link is gone, so is the session
+        stale = [iface for iface in self._sessions if iface not in counters]
+        for iface in stale:
+            self._remove(iface)
+        return stale
+
+    def query(self, search=None, username=None, ip=None, sort='started', offset=0, limit=DEFAULT_LIMIT):
+        """
+        Returns {'total', 'offset', 'limit', 'counts', 'sessions'}. username and ip
+        are exact index lookups, search a substring match on username, IP and
+        interface. Byte counters and uptime are filled in for the returned page only.
+        """
+        self.refresh()
+        counters = _read_counters()
+        now = time.time()
+        sort = sort if sort in SORT_KEYS else 'started'
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        offset = max(0, int(offset))
+
+        with self._lock:
+            if counters:
+                self._drop_stale(counters)
+            if username or ip:
+                ifaces = set(self._by_user.get(username, ())) if username else None
+                if ip:
+                    by_ip = {self._by_ip[ip]} if ip in self._by_ip else set()
+                    ifaces = by_ip if ifaces is None else ifaces & by_ip
+                sessions = [s for s in self._sorted(sort) if s['iface'] in ifaces]
+            else:
+                sessions = self._sorted(sort)
+            if search:
+                needle = search.lower()
+                sessions = [s for s in sessions if needle in s['username'].lower()
+                            or needle in s['ip'] or needle in s['iface']]
+            page = [dict(s) for s in sessions[offset:offset + limit]]
+            total = len(sessions)
+            counts = self._counts(counters)
+
+        for session in page:
+            values = counters.get(session['iface'])
+            session['uptime'] = max(int(now - session['started']), 0)
+            session['rx_bytes'] = values[0] if values else 0
+            session['tx_bytes'] = values[1] if values else 0
+        return {'total': total, 'offset': offset, 'limit': limit, 'counts': counts, 'sessions': page}
+
+    def _counts(self, counters):
+        rx = tx = 0
+        for iface in self._sessions:
+            values = counters.get(iface)
+            if values:
+                rx += values[0]
+                tx += values[1]
+        return {
+            'sessions': len(self._sessions),
+            'users': len(self._by_user),
+            'rx_bytes': rx,
+            'tx_bytes': tx
+        }
+
+    def counts(self):
+        """
+        Aggregated numbers for the dashboard.
+        """
+        self.refresh()
+        counters = _read_counters()
+        with self._lock:
+            if counters:
+                self._drop_stale(counters)
+            return self._counts(counters)
+
+    def compact(self):
+        """
+        Rewrites the event log with one 'up' line per live session. Hooks take the
+        same lock before appending, so no event is lost during the swap.
+        """
+        if fcntl is None:
+            return False
+        try:
+            lock_fd = os.open(LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            return False
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False  # Another worker is compacting, or a hook is writing
+            self.refresh(force=True, compact=False)
+            with self._lock:
+                lines = [f"up\t{s['started']:.0f}\t{s['iface']}\t{s['username']}\t{s['ip']}\t{s['local_ip']}\n"
+                         for s in self._sessions.values()]
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.writelines(lines)
+            os.replace(tmp_path, self.path)
+            return True
+        finally:
+            os.close(lock_fd)
+
+
+def _ip_key(ip):
+    try:
+        return socket.inet_aton(ip)
+    except OSError:
+        return b'\xff' * 4
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    The process-wide session store for EVENTS_FILE.
+    """
+    global _store
+    with _store_lock:
+        if _store is None or _store.path != EVENTS_FILE:
+            _store = SessionStore(EVENTS_FILE)
+        return _store
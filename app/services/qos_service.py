@@ -0,0 +1,295 @@
+import json
+import os
+import re
+from app.services import pppoe_sessions
+
+# Per-client bandwidth plans. Every shaped interface gets one HTB tree with the
+# same class numbers: a client's class on the LAN side carries its download rate,
+# on the WAN side its upload rate. nftables sets skb->priority to the client's
+# class in the forward hook (a single map lookup), and HTB takes a priority that
+# names one of its classes as the classification, so no tc filter ever runs.
+NFT_TABLE = 'ubr_qos'
+# Class numbers below this are the tree itself: 1:1 root, 1:2 unclassified traffic
+FIRST_CLIENT_CLASS = 0x10
+MAX_CLIENT_CLASS = 0xffff
+DEFAULT_CLASS = 2
+QUANTUM = 1514
+# Class numbers handed out so far, kept next to the artifacts so a client keeps
+# its class across regenerations and a plan change only touches its own classes
+CLASSES_STATE_FILE = '.qos-classes.json'
+APP_ETC_DIR = '/etc/ubuntu-router'
+SESSIONS_FILE = os.path.join(APP_ETC_DIR, 'qos-sessions')
+
+_PLAN_RE = re.compile(r'^[A-Za-z0-9_.-]{1,32}$')
+
+
+def validate_plan(name, settings):
+    """
+    Returns {'name', 'down_kbit', 'up_kbit'} or raises ValueError.
+    """
+    name = str(name or '').strip()
+    if not _PLAN_RE.match(name):
+        raise ValueError(f'Invalid plan name: {name!r}')
+    plan = {'name': name}
+    for key in ('down_kbit', 'up_kbit'):
+        try:
+            plan[key] = int(settings.get(key))
+        except (TypeError, ValueError):
+            raise ValueError(f'{name}: {key} must be a whole number of kbit/s')
+        if not 8 <= plan[key] <= 100000000:
+            raise ValueError(f'{name}: {key} must be between 8 and 100000000 kbit/s')
+    return plan
+
+
+def load_plans(config):
+    """
+    Returns ({name: plan}, errors) for the 'qos_plans' section.
+    """
+    plans = {}
+    errors = []
+    for name, settings in config.get('qos_plans', {}).items():
+        try:
+            plans[name] = validate_plan(name, settings)
+        except ValueError as e:
+            errors.append(str(e))
+    return plans, errors
+
+
+def shaped_interfaces(config):
+    """
+    Interfaces with a link rate, as {'name', 'direction', 'rate_kbit'} sorted by
+    name. Egress of a WAN is client upload; of br0 and LAN ports, client download.
+    """
+    network = config.get('network', {})
+    interfaces = []
+    for name, settings in config.get('qos', {}).get('interfaces', {}).items():
+        try:
+            rate = int(settings.get('rate_kbit') or 0)
+        except (TypeError, ValueError):
+            rate = 0
+        if rate <= 0:
+            continue
+        direction = 'up' if network.get(name, {}).get('role') == 'wan' else 'down'
+        interfaces.append({'name': name, 'direction': direction, 'rate_kbit': rate})
+    interfaces.sort(key=lambda i: i['name'])
+    return interfaces
+
+
+def qos_clients(config, plans):
+    """
+    Clients with a known plan: PPPoE subscribers (classified by the address of
+    their session) and DHCP reservations (by their reserved address). Returns
+    (clients, errors); each client is {'key', 'name', 'ip', 'plan'}.
+    """
+    clients = []
+    errors = []
+    for username, entry in sorted(config.get('pppoe_subscribers', {}).items()):
+        plan = entry.get('plan')
+        if not plan:
+            continue
+        if plan not in plans:
+            errors.append(f'PPPoE subscriber {username}: unknown plan {plan}')
+            continue
+        clients.append({'key': f'pppoe:{username}', 'name': username, 'ip': entry.get('ip', ''), 'plan': plan})
+    for entry in config.get('dhcp_reservations', []):
+        plan = entry.get('plan')
+        if not plan:
+            continue
+        if plan not in plans:
+            errors.append(f'Reservation {entry["ip"]}: unknown plan {plan}')
+            continue
+        clients.append({'key': f'lan:{entry["mac"]}', 'name': entry.get('hostname') or entry['mac'],
+                        'ip': entry['ip'], 'plan': plan})
+    return clients, errors
+
+
+def load_class_ids(directory):
+    try:
+        with open(os.path.join(directory, CLASSES_STATE_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_class_ids(directory, class_ids):
+    path = os.path.join(directory, CLASSES_STATE_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(class_ids, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def assign_class_ids(clients, previous):
+    """
+    Returns {client key: class number}. Clients keep the number they had in
+    previous; new ones get the lowest free number. Raises ValueError when there
+    are more clients than HTB class numbers.
+    """
+    keys = {c['key'] for c in clients}
+    class_ids = {k: v for k, v in previous.items() if k in keys}
+    used = set(class_ids.values())
+    candidate = FIRST_CLIENT_CLASS
+    for client in clients:
+        if client['key'] in class_ids:
+            continue
+        while candidate in used:
+            candidate += 1
+        if candidate > MAX_CLIENT_CLASS:
+            raise ValueError(f'Too many shaped clients (at most {MAX_CLIENT_CLASS - FIRST_CLIENT_CLASS + 1})')
+        class_ids[client['key']] = candidate
+        used.add(candidate)
+    return class_ids
+
+
+def classid(number):
+    # tc and nft both read the minor number as hex
+    return f'1:{number:x}'
+
+
+def render_tc_batch(interfaces, clients, class_ids, plans):
+    """
+    Yields the complete HTB setup as 'tc -batch' lines, one tree per interface.
+    Every line is idempotent (replace), so the setup script can send just the
+    lines that differ from the last applied run.
+    """
+    for iface in interfaces:
+        dev = iface['name']
+        rate = iface['rate_kbit']
+        rate_key = f"{iface['direction']}_kbit"
+        yield f'qdisc replace dev {dev} root handle 1: htb default {DEFAULT_CLASS:x}\n'
+        yield f'class replace dev {dev} parent 1: classid 1:1 htb rate {rate}kbit ceil {rate}kbit quantum {QUANTUM}\n'
+        yield (f'class replace dev {dev} parent 1:1 classid {classid(DEFAULT_CLASS)} htb '
+               f'rate {max(rate // 10, 8)}kbit ceil {rate}kbit quantum {QUANTUM}\n')
+        yield f'qdisc replace dev {dev} parent {classid(DEFAULT_CLASS)} handle {DEFAULT_CLASS:x}: fq_codel\n'
+        for client in clients:
+            client_rate = min(plans[client['plan']][rate_key], rate)
+            yield (f"class replace dev {dev} parent 1:1 classid {classid(class_ids[client['key']])} htb "
+                   f'rate {client_rate}kbit ceil {client_rate}kbit quantum {QUANTUM}\n')
+
+
+def render_nft(enabled, clients, class_ids):
+    """
+    Classification ruleset. Addresses known in advance (reservations, static
+    PPPoE addresses) are in the 'clients' map; the 'sessions' map is filled by
+    the PPPoE ip-up/ip-down hooks and is left alone here.
+    """
+    lines = ['# QoS classification (generated by Ubuntu Router UI)']
+    if not enabled:
+        lines.append(f'table inet {NFT_TABLE} {{}}')
+        lines.append(f'delete table inet {NFT_TABLE}')
+        return '\n'.join(lines) + '\n'
+
+    lines.append(f'add table inet {NFT_TABLE}')
+    for name in ('clients', 'sessions'):
+        lines.append(f'add map inet {NFT_TABLE} {name} {{ type ipv4_addr : classid; }}')
+    lines.append(f'add chain inet {NFT_TABLE} forward {{ type filter hook forward priority mangle; policy accept; }}')
+    lines.append(f'flush chain inet {NFT_TABLE} forward')
+    lines.append(f'flush map inet {NFT_TABLE} clients')
+    # Upload is matched first so that for LAN to LAN traffic the receiver's class wins
+    for field in ('saddr', 'daddr'):
+        for name in ('clients', 'sessions'):
+            lines.append(f'add rule inet {NFT_TABLE} forward meta priority set ip {field} map @{name}')
+
+    elements = []
+    seen = set()
+    for client in clients:
+        if client['ip'] and client['ip'] not in seen:
+            seen.add(client['ip'])
+            elements.append(f"{client['ip']} : {classid(class_ids[client['key']])}")
+    for start in range(0, len(elements), 1000):
+        lines.append(f'add element inet {NFT_TABLE} clients {{ {", ".join(elements[start:start + 1000])} }}')
+    return '\n'.join(lines) + '\n'
+
+
+def render_session_classes(clients, class_ids):
+    """
+    'username<TAB>classid' lines read by the PPPoE hooks at login.
+    """
+    for client in clients:
+        if client['key'].startswith('pppoe:'):
+            yield f"{client['name']}\t{classid(class_ids[client['key']])}\n"
+
+
+def hook_script(kind):
+    """
+    Content of the /etc/ppp/ip-up.d (kind='up') or ip-down.d (kind='down') hook
+    that puts a session's address into the 'sessions' map.
+    """
+    if kind == 'down':
+        action = f'nft delete element inet {NFT_TABLE} sessions "{{ $PPP_REMOTE }}" 2>/dev/null'
+    else:
+        action = (f"CLASS=$(awk -F'\\t' -v u=\"$PEERNAME\" '$1 == u {{print $2; exit}}' {SESSIONS_FILE} 2>/dev/null)\n"
+                  f'[ -n "$CLASS" ] && nft add element inet {NFT_TABLE} sessions "{{ $PPP_REMOTE : $CLASS }}" 2>/dev/null')
+    return f'''#!/bin/sh
+# PPPoE session QoS {kind} hook (generated by Ubuntu Router UI)
+[ "$PPP_IPPARAM" = "{pppoe_sessions.IPPARAM}" ] || exit 0
+{action}
+exit 0
+'''
+
+
+def setup_script():
+    """
+    Content of setup_qos.sh. It diffs the generated tc batch against the copy
+    kept from the last successful run and sends only the lines that changed
+    (plus deletes for classes and trees that are gone) in one 'tc -batch'.
+    """
+    return f'''#!/bin/bash
+# QoS setup (generated by Ubuntu Router UI)
+# One tc -batch for the HTB classes that changed since the last run, one nft -f
+# for the classification maps.
+
+DIR="$(cd "$(dirname "$0")" && pwd)"
+NEW="$DIR/qos-classes.tc"
+APPLIED="$DIR/qos-classes.applied"
+BATCH="$(mktemp)"
+SEED="$(mktemp)"
+trap 'rm -f "$BATCH" "$SEED"' EXIT
+
+# A device without our tree (first run, or netplan recreated it) gets every line
+FULL=0
+[ -f "$APPLIED" ] || FULL=1
+for DEV in $(awk '$1 == "qdisc" && $5 == "root" {{print $4}}' "$NEW"); do
+    tc qdisc show dev "$DEV" root 2>/dev/null | grep -q '^qdisc htb 1: ' || FULL=1
+    # Leaf classes get a pfifo sized by the queue length, which is 0 on bridges
+    [ "$(cat "/sys/class/net/$DEV/tx_queue_len" 2>/dev/null)" = "0" ] && ip link set dev "$DEV" txqueuelen 1000
+done
+touch "$APPLIED"
+
+awk -v full="$FULL" '
+    {{ key = $1 == "class" ? "class " $4 " " $8 : ($5 == "root" ? "root " $4 : "leaf " $4 " " $6) }}
+    NR == FNR {{ old[key] = $0; next }}
+    {{ seen[key] = 1; if (full || old[key] != $0) print }}
+    END {{
+        for (key in old) {{
+            if (key in seen) continue
+            split(key, part, " ")
+            if (part[1] == "root") print "qdisc del dev " part[2] " root"
+            else if (part[1] == "class" && ("root " part[2]) in seen) print "class del dev " part[2] " classid " part[3]
+        }}
+    }}' "$APPLIED" "$NEW" > "$BATCH"
+
+if [ -s "$BATCH" ]; then
+    echo "Updating $(wc -l < "$BATCH") QoS tc entries"
+    if ! tc -batch "$BATCH"; then
+        rm -f "$APPLIED"
+        exit 1
+    fi
+fi
+cp "$NEW" "$APPLIED"
+
+nft -f "$DIR/qos.nft" || exit 1
+
+# Sessions that logged in before this run: rebuild their map from the session log
+if nft list map inet {NFT_TABLE} sessions >/dev/null 2>&1; then
+    echo "flush map inet {NFT_TABLE} sessions" > "$SEED"
+    awk -F'\\t' '
+        NR == FNR {{ class[$1] = $2; next }}
+        $1 == "up" {{ user[$3] = $4; addr[$3] = $5 }}
+        $1 == "down" {{ delete user[$3] }}
+        END {{ for (i in user) if (user[i] in class) print "add element inet {NFT_TABLE} sessions {{ " addr[i] " : " class[user[i]] " }}" }}
+    ' "$DIR/qos-sessions" {pppoe_sessions.EVENTS_FILE} 2>/dev/null >> "$SEED"
+    nft -f "$SEED" || exit 1
+fi
+echo 'QoS applied.'
+'''
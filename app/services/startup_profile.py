@@ -0,0 +1,122 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Cold start profile: a fresh interpreter (python -X importtime) imports the
+# app, runs create_app() and serves one request through the test client, the
+# way a gunicorn worker starts after a reboot. Nothing from the calling
+# process is reused, so modules it already imported are timed as well.
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+PHASES = ('import', 'create_app', 'first_request')
+
+_CHILD = r'''
+import json, sys, time
+
+def phase(name):
+    # importtime lines go to stderr as modules load; this splits them by phase
+    sys.stderr.write(f'-- phase {name}\n')
+    sys.stderr.flush()
+
+times = [time.perf_counter()]
+phase('import')
+from app import create_app
+times.append(time.perf_counter())
+phase('create_app')
+app = create_app()
+times.append(time.perf_counter())
+phase('first_request')
+status = app.test_client().get(sys.argv[1]).status_code
+times.append(time.perf_counter())
+print(json.dumps({'times': times, 'status': status}))
+'''
+
+
+def _parse_importtime(stderr):
+    imports = []
+    phase = None
+    for line in stderr.splitlines():
+        if line.startswith('-- phase '):
+            phase = line[9:].strip()
+            continue
+        # import time:       984 |       9303 |     http.client
+        if not line.startswith('import time:') or phase is None:
+            continue
+        fields = line[12:].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        imports.append({
+            'module': name.strip(),
+            'phase': phase,
+            'self_ms': int(fields[0]) / 1000,
+            'cumulative_ms': int(fields[1]) / 1000,
+            # Nested imports are indented by two spaces per level below the first
+            'depth': (len(name) - len(name.lstrip()) - 1) // 2
+        })
+    return imports
+
+
+def profile(url='/', cwd=None, timeout=120):
+    """
+    Starts the app in a fresh interpreter and returns {'phases': {phase: ms},
+    'total_ms', 'status', 'imports': [{'module', 'phase', 'self_ms',
+    'cumulative_ms', 'depth'}]}. total_ms is the whole process lifetime,
+    interpreter start and exit included. cwd is where config/ and generated/
+    end up (default: the project directory, as in production).
+    """
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR)
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', _CHILD, url], cwd=cwd or PROJECT_DIR,
+                            env=env, capture_output=True, text=True, timeout=timeout)
+    total = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f'app failed to start: {result.stderr.strip().splitlines()[-1:]}')
+    child = json.loads(result.stdout.strip().splitlines()[-1])
+    times = child['times']
+    return {
+        'phases': {name: round((times[i + 1] - times[i]) * 1000, 3) for i, name in enumerate(PHASES)},
+        'total_ms': round(total, 3),
+        'status': child['status'],
+        'imports': _parse_importtime(result.stderr)
+    }
+
+
+def by_package(imports):
+    """
+    {top-level package: summed self time in ms}; app modules are kept apart.
+    """
+    totals = {}
+    for entry in imports:
+        module = entry['module']
+        key = module if module.startswith('app.') else module.split('.')[0]
+        totals[key] = totals.get(key, 0) + entry['self_ms']
+    return totals
+
+
+def report(result, url='/', top=15):
+    """
+    The profile as text lines: time per phase, then the slowest imports.
+    """
+    lines = ['Cold start profile']
+    for name in PHASES:
+        label = f'first request (GET {url})' if name == 'first_request' else name
+        lines.append(f"  {label:40} {result['phases'][name]:9.1f} ms")
+    lines.append(f"  {'process total (interpreter included)':40} {result['total_ms']:9.1f} ms")
+    if result['status'] >= 400:
+        lines.append(f"  first request returned HTTP {result['status']}")
+
+    lines.append('')
+    lines.append(f'Slowest imports by phase (cumulative, top-level imports only, top {top})')
+    for name in PHASES:
+        entries = sorted((e for e in result['imports'] if e['phase'] == name and e['depth'] == 0),
+                         key=lambda e: -e['cumulative_ms'])
+        for entry in entries[:top]:
+            lines.append(f"  {name:14} {entry['module']:40} {entry['cumulative_ms']:9.1f} ms")
+
+    lines.append('')
+    lines.append(f'Import time by package (self time, top {top})')
+    for package, ms in sorted(by_package(result['imports']).items(), key=lambda i: -i[1])[:top]:
+        lines.append(f'  {package:55} {ms:9.1f} ms')
+    return lines
@@ -0,0 +1,374 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from app.services import green
+
+try:
+    import fcntl
+except ImportError:  # Windows dev environment: every process samples for itself
+    fcntl = None
+
+# Shared sample buffer. One worker (whoever holds the lock file) samples the
+# counters once a second and writes them here; every other worker only reads.
+STATS_FILE = 'config/ifstats.bin'
+LOCK_FILE = 'config/ifstats.lock'
+# Ring buffer length in samples (= seconds of history) and interfaces tracked.
+# The slot of an interface missing for a whole HISTORY goes to the next new one.
+HISTORY = 300
+MAX_INTERFACES = 64
+INTERVAL = 1.0
+# PPPoE sessions come and go by the hundreds; they have their own session monitor
+EXCLUDED_PREFIXES = ('ppp',)
+
+FIELDS = ('rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets', 'rx_errors', 'tx_errors', 'rx_drops', 'tx_drops')
+
+_MAGIC = b'UBRSTAT1'
+# magic, max interfaces, history, interface count, head slot, seqlock counter, last update
+_HEADER = struct.Struct('=8sIIIIQd')
+_NAME = struct.Struct('=16s')
+_ROW = struct.Struct('=' + 'Q' * len(FIELDS))
+_TIME = struct.Struct('=d')
+
+_TIMES_OFFSET = _HEADER.size
+_RECORDS_OFFSET = _TIMES_OFFSET + HISTORY * _TIME.size
+_RECORD_SIZE = _NAME.size + HISTORY * _ROW.size
+FILE_SIZE = _RECORDS_OFFSET + MAX_INTERFACES * _RECORD_SIZE
+
+# Row written for interfaces that are gone at sample time
+_MISSING = (2 ** 64 - 1,) * len(FIELDS)
+
+# A sampler that has not written for this long is considered dead and replaced
+STALE_AFTER = 3.0
+
+
+def read_counters():
+    """
+    Returns {iface: (rx_bytes, tx_bytes, rx_packets, tx_packets, rx_errors, tx_errors, rx_drops, tx_drops)}.
+    Reads /proc/net/dev in one go on Linux, psutil elsewhere.
+    """
+    counters = {}
+    try:
+        with open('/proc/net/dev', 'r') as f:
+            lines = f.readlines()[2:]
+    except OSError:
+        import psutil
+        for name, c in green.blocking(psutil.net_io_counters, pernic=True).items():
+            counters[name] = (c.bytes_recv, c.bytes_sent, c.packets_recv, c.packets_sent,
+                              c.errin, c.errout, c.dropin, c.dropout)
+        return counters
+
+    for line in lines:
+        name, _, data = line.partition(':')
+        values = data.split()
+        if len(values) < 16:
+            continue
+        v = [int(x) for x in values]
+        # rx: bytes packets errs drop fifo frame compressed multicast, tx: bytes packets errs drop ...
+        counters[name.strip()] = (v[0], v[8], v[1], v[9], v[2], v[10], v[3], v[11])
+    return counters
+
+
+class _Sampler:
+    """
+    Writer side. The shared file is a set of fixed-size packed arrays: one ring of
+    sample times and, per interface, a ring of HISTORY rows of uint64 counters.
+    Each sample overwrites the oldest row under a seqlock (odd = write in progress).
+    """
+
+    def __init__(self, mm):
+        self.mm = mm
+        self.slots = {}
+        # Samples each vanished interface has been missing for, slots given back, slots used so far
+        self.missing = {}
+        self.free = []
+        self.count = 0
+        self.head = -1
+        self.seq = 0
+        # Start from a clean buffer; slot assignments of a previous sampler are void
+        mm[:] = bytes(FILE_SIZE)
+        _HEADER.pack_into(mm, 0, _MAGIC, MAX_INTERFACES, HISTORY, 0, 0, 0, 0.0)
+
+    def sample(self):
+        now = time.time()
+        counters = read_counters()
+        self.head = (self.head + 1) % HISTORY
+
+        self.seq += 1  # odd: write in progress
+        self._write_header(now)
+        try:
+            _TIME.pack_into(self.mm, _TIMES_OFFSET + self.head * _TIME.size, now)
+            for name, slot in list(self.slots.items()):
+                if name in counters:
+                    self.missing.pop(name, None)
+                    continue
+                self._write_row(slot, _MISSING)
+                self.missing[name] = self.missing.get(name, 0) + 1
+                if self.missing[name] >= HISTORY:
+                    # Nothing but gaps left in its ring (VLAN, veth or tap churn): free the slot
+                    del self.slots[name], self.missing[name]
+                    _NAME.pack_into(self.mm, _RECORDS_OFFSET + slot * _RECORD_SIZE, b'')
+                    self.free.append(slot)
+            for name, values in counters.items():
+                if name.startswith(EXCLUDED_PREFIXES):
+                    continue
+                slot = self.slots.get(name)
+                if slot is None:
+                    if self.free:
+                        slot = self.free.pop(0)
+                    elif self.count < MAX_INTERFACES:
+                        slot = self.count
+                        self.count += 1
+                    else:
+                        continue
+                    self.slots[name] = slot
+                    _NAME.pack_into(self.mm, _RECORDS_OFFSET + slot * _RECORD_SIZE, name.encode('utf-8')[:16])
+                    # The ring still holds zeros (or a previous interface's gaps) for
+                    # samples taken before this interface showed up; no rate against those
+                    self._fill_missing(slot)
+                self._write_row(slot, values)
+        finally:
+            self.seq += 1  # even: consistent (readers must not wait on a failed sample forever)
+            self._write_header(now)
+        return counters
+
+    def _write_row(self, slot, values):
+        _ROW.pack_into(self.mm, _RECORDS_OFFSET + slot * _RECORD_SIZE + _NAME.size + self.head * _ROW.size, *values)
+
+    def _fill_missing(self, slot):
+        base = _RECORDS_OFFSET + slot * _RECORD_SIZE + _NAME.size
+        self.mm[base:base + HISTORY * _ROW.size] = _ROW.pack(*_MISSING) * HISTORY
+
+    def _write_header(self, now):
+        _HEADER.pack_into(self.mm, 0, _MAGIC, MAX_INTERFACES, HISTORY, self.count, self.head, self.seq, now)
+
+
+_lock = threading.Lock()
+_pid = None
+_mm = None
+_lock_fd = None
+_leader = False
+_listeners = []
+_log = logging.getLogger(__name__)
+_reported = set()
+
+
+def _open_shared():
+    global _mm
+    os.makedirs(os.path.dirname(STATS_FILE) or '.', exist_ok=True)
+    fd = os.open(STATS_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != FILE_SIZE:
+            os.ftruncate(fd, FILE_SIZE)
+        _mm = mmap.mmap(fd, FILE_SIZE)
+    finally:
+        os.close(fd)
+
+
+def _try_lead():
+    """
+    Becomes the sampling process if nobody else holds the lock file.
+    """
+    global _lock_fd, _leader
+    if _leader:
+        return True
+    fd = os.open(LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+    _lock_fd = fd
+    _leader = True
+    threading.Thread(target=_run_sampler, name='ifstats-sampler', daemon=True).start()
+    return True
+
+
+def _report(where, error):
+    # Once per place and exception type: something failing every second must not flood the log
+    key = (where, type(error))
+    if key not in _reported:
+        _reported.add(key)
+        _log.error('%s failed (further %s errors there are not logged)', where, type(error).__name__,
+                   exc_info=(type(error), error, error.__traceback__))
+
+
+def _tick(sampler):
+    """
+    One sample, then every listener. A failing listener does not keep the others from running.
+    """
+    try:
+        counters = sampler.sample()
+    except Exception as e:
+        _report('Interface sampling', e)
+        return
+    for listener in list(_listeners):
+        try:
+            listener(sampler, counters)
+        except Exception as e:
+            _report(f'Sample listener {getattr(listener, "__qualname__", listener)!r}', e)
+
+
+def _run_sampler():
+    sampler = _Sampler(_mm)
+    next_tick = time.monotonic()
+    while True:
+        _tick(sampler)
+        next_tick += INTERVAL
+        delay = next_tick - time.monotonic()
+        if delay < 0:
+            # Fell behind (suspend, overloaded box): don't try to catch up
+            next_tick = time.monotonic()
+            delay = 0
+        time.sleep(delay)
+
+
+def add_listener(callback):
+    """
+    Registers callback(sampler, counters), called after each sample in the sampling process.
+    """
+    _listeners.append(callback)
+
+
+def ensure_sampler():
+    """
+    Maps the shared buffer in this process and starts sampling if no other
+    worker does. Safe to call on every request.
+    """
+    global _pid, _leader, _lock_fd
+    with _lock:
+        if _pid != os.getpid():
+            # Fresh worker process (or first call): locks and threads are not inherited
+            _pid = os.getpid()
+            _leader = False
+            _lock_fd = None
+            _open_shared()
+            _try_lead()
+        elif not _leader:
+            header = _HEADER.unpack_from(_mm, 0)
+            if header[0] != _MAGIC or time.time() - header[6] > STALE_AFTER:
+                _try_lead()
+
+
+def _snapshot():
+    """
+    Consistent copy of the shared buffer as (header, raw bytes), or None before the first sample.
+    """
+    for _attempt in range(20):
+        header = _HEADER.unpack_from(_mm, 0)
+        magic, _max, history, count, head, seq, updated = header
+        if magic != _MAGIC or seq == 0:
+            return None
+        if seq % 2:
+            time.sleep(0.001)
+            continue
+        data = bytes(_mm[:_RECORDS_OFFSET + count * _RECORD_SIZE])
+        if _HEADER.unpack_from(_mm, 0)[5] == seq:
+            return header, data
+    return None
+
+
+def _rate(older, newer, dt):
+    if older == _MISSING or newer == _MISSING:
+        return {field: 0.0 for field in FIELDS}
+    return {
+        field: (max(newer[i] - older[i], 0) / dt) if dt > 0 else 0.0
+        for i, field in enumerate(FIELDS)
+    }
+
+
+def _interface_slots(data, count):
+    slots = {}
+    for slot in range(count):
+        raw = _NAME.unpack_from(data, _RECORDS_OFFSET + slot * _RECORD_SIZE)[0].rstrip(b'\0')
+        if raw:  # empty: freed, waiting for the next new interface
+            slots[raw.decode('utf-8', 'replace')] = slot
+    return slots
+
+
+def _history(data, header, slot, length):
+    """
+    Returns [(t, counters)] oldest first, for up to length samples.
+    """
+    _magic, _max, history, _count, head, _seq, _updated = header
+    samples = []
+    base = _RECORDS_OFFSET + slot * _RECORD_SIZE + _NAME.size
+    for back in range(min(length, history)):
+        index = (head - back) % history
+        t = _TIME.unpack_from(data, _TIMES_OFFSET + index * _TIME.size)[0]
+        if t == 0.0:
+            break
+        samples.append((t, _ROW.unpack_from(data, base + index * _ROW.size)))
+    samples.reverse()
+    return samples
+
+
+def get_all_rates():
+    """
+    Returns {iface: {field: per-second rate}} computed from the last two samples.
+    """
+    ensure_sampler()
+    snapshot = _snapshot()
+    if snapshot is None:
+        return {}
+    header, data = snapshot
+    rates = {}
+    for name, slot in _interface_slots(data, header[3]).items():
+        samples = _history(data, header, slot, 2)
+        if len(samples) == 2 and samples[1][1] != _MISSING:
+            (t0, c0), (t1, c1) = samples
+            rates[name] = _rate(c0, c1, t1 - t0)
+    return rates
+
+
+def get_all_counters():
+    """
+    Returns {iface: {field: latest raw counter}} for every sampled interface.
+    """
+    ensure_sampler()
+    snapshot = _snapshot()
+    if snapshot is None:
+        return {}
+    header, data = snapshot
+    counters = {}
+    for name, slot in _interface_slots(data, header[3]).items():
+        samples = _history(data, header, slot, 1)
+        if samples and samples[0][1] != _MISSING:
+            counters[name] = dict(zip(FIELDS, samples[0][1]))
+    return counters
+
+
+def get_interface_stats(name, history=60):
+    """
+    Returns current rates, raw counters and rate history for one interface,
+    or None if the interface is not sampled.
+    """
+    ensure_sampler()
+    snapshot = _snapshot()
+    if snapshot is None:
+        return None
+    header, data = snapshot
+    slot = _interface_slots(data, header[3]).get(name)
+    if slot is None:
+        return None
+
+    samples = _history(data, header, slot, history + 1)
+    if samples and samples[-1][1] == _MISSING:
+        return None
+    points = []
+    for (t0, c0), (t1, c1) in zip(samples, samples[1:]):
+        point = _rate(c0, c1, t1 - t0)
+        point['t'] = round(t1, 3)
+        points.append(point)
+
+    return {
+        'name': name,
+        'updated': header[6],
+        'interval': INTERVAL,
+        'counters': dict(zip(FIELDS, samples[-1][1])) if samples else {},
+        'rates': {k: v for k, v in points[-1].items() if k != 't'} if points else {},
+        'history': points
+    }
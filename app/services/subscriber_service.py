@@ -0,0 +1,461 @@
+import contextlib
+import csv
+import io
+import ipaddress
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from app.services import apply_service, green
+from app.services.config_service import load_config, save_config
+
+try:
+    import fcntl
+except ImportError:  # Windows dev environment: single process only
+    fcntl = None
+
+# PPPoE subscriber accounts live in the 'pppoe_subscribers' config section
+# ({username: {password, ip, plan}}) and are mirrored into chap-secrets, which
+# pppd reads on every login. Lines written by the app carry MARKER; anything
+# else in the file (hand-written accounts, comments) is left alone.
+CHAP_SECRETS = '/etc/ppp/chap-secrets'
+LOCK_FILE = 'config/chap-secrets.lock'
+MARKER = '# ubuntu-router'
+SECTION = 'pppoe_subscribers'
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+# A reconcile with more changed accounts than this rewrites the file once
+# instead of patching line by line (every patch copies the whole file)
+PATCH_LIMIT = 16
+
+_USERNAME_RE = re.compile(r'^[A-Za-z0-9_.@+-]{1,64}$')
+_PLAN_RE = re.compile(r'^[A-Za-z0-9_.-]{0,32}$')
+
+
+def validate_subscriber(entry):
+    """
+    Returns a normalized {'username', 'password', 'ip', 'plan'} or raises ValueError.
+    ip is '' for "any address from the pool".
+    """
+    username = str(entry.get('username') or '').strip()
+    password = str(entry.get('password') or '')
+    ip = str(entry.get('ip') or '').strip()
+    plan = str(entry.get('plan') or '').strip()
+
+    if not _USERNAME_RE.match(username):
+        raise ValueError(f'Invalid username: {username!r}')
+    if not password or any(c in password for c in '"\\\r\n'):
+        raise ValueError(f'{username}: password must be non-empty and must not contain quotes, backslashes or line breaks')
+    if ip and ip != '*':
+        ip = str(ipaddress.IPv4Address(ip))
+    else:
+        ip = ''
+    if not _PLAN_RE.match(plan):
+        raise ValueError(f'{username}: invalid rate plan name {plan!r}')
+    return {'username': username, 'password': password, 'ip': ip, 'plan': plan}
+
+
+def format_line(subscriber):
+    """
+    chap-secrets line: client, server, secret, allowed addresses.
+    """
+    return f'"{subscriber["username"]}" * "{subscriber["password"]}" {subscriber["ip"] or "*"} {MARKER}\n'
+
+
+@contextlib.contextmanager
+def _file_lock():
+    """
+    Serializes chap-secrets writers across worker processes.
+    """
+    os.makedirs(os.path.dirname(LOCK_FILE) or '.', exist_ok=True)
+    with open(LOCK_FILE, 'a') as f:
+        if fcntl:
+            green.blocking(fcntl.flock, f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ChapSecretsFile:
+    """
+    chap-secrets with an index of where each managed account's line starts and
+    how long it is. A single account change copies the bytes before and after
+    that line around the new one into a temp file and renames it over the
+    original: nothing is parsed or re-validated, and pppd never sees a partial
+    file. The index is keyed on (inode, size, mtime) and rebuilt only if the file
+    was changed by someone else.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = {}
+        self._key = None
+
+    def _stat_key(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _ensure_index(self):
+        key = self._stat_key()
+        if key == self._key and key is not None:
+            return
+        self._index = {}
+        offset = 0
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if line.rstrip().endswith(MARKER.encode('utf-8')) and line.startswith(b'"'):
+                        username = line[1:line.index(b'"', 1)].decode('utf-8', 'replace')
+                        self._index[username] = (offset, len(line))
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+        self._key = key
+
+    def _swap(self, start, length, replacement):
+        """
+        Writes the file with bytes [start, start + length) replaced and renames it into place.
+        """
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.chap-secrets.')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                try:
+                    with open(self.path, 'rb') as src:
+                        _copy_range(src, out, 0, start)
+                        out.write(replacement)
+                        src.seek(start + length)
+                        shutil.copyfileobj(src, out)
+                except FileNotFoundError:
+                    out.write(replacement)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        # Shift the offsets of every line after the patched one
+        delta = len(replacement) - length
+        if delta:
+            for username, (offset, size) in self._index.items():
+                if offset > start:
+                    self._index[username] = (offset + delta, size)
+        self._key = self._stat_key()
+
+    # The file lock is taken before the thread lock everywhere, so a reconcile
+    # and a single-account change in two threads cannot wait on each other
+
+    def upsert(self, subscriber):
+        with _file_lock(), self._lock:
+            self._upsert(subscriber['username'], format_line(subscriber).encode('utf-8'))
+
+    def remove(self, username):
+        with _file_lock(), self._lock:
+            self._ensure_index()
+            if username not in self._index:
+                return False
+            self._remove(username)
+            return True
+
+    def sync(self, subscribers):
+        """
+        Full rewrite for bulk changes: keeps every unmanaged line and replaces
+        all managed ones with subscribers (an iterable of validated dicts).
+        """
+        with _file_lock(), self._lock:
+            self._rewrite(format_line(s).encode('utf-8') for s in subscribers)
+
+    def reconcile(self, section):
+        """
+        Makes the managed lines match section ({username: {password, ip, plan}}).
+        Nothing is written if they already do; a few differences are patched
+        line by line, more are written with one full rewrite. Accounts that do
+        not validate are left out. Returns the number of accounts changed.
+        """
+        if not section and not os.path.exists(self.path):
+            return 0
+        with _file_lock(), self._lock:
+            current = self._managed_lines()
+            wanted = {}
+            for username, entry in section.items():
+                try:
+                    line = format_line({'username': username, 'password': entry.get('password', ''),
+                                        'ip': entry.get('ip', '')}).encode('utf-8')
+                    if current.get(username) != line:
+                        # Only lines that are not in the file yet are checked: a
+                        # full-config save or an old revision may hold anything
+                        line = format_line(validate_subscriber(dict(entry, username=username))).encode('utf-8')
+                except (ValueError, AttributeError):
+                    continue
+                wanted[username] = line
+            changed = [username for username, line in wanted.items() if current.get(username) != line]
+            removed = [username for username in current if username not in wanted]
+            if len(changed) + len(removed) > PATCH_LIMIT:
+                self._rewrite(wanted[username] for username in sorted(wanted))
+            else:
+                for username in removed:
+                    self._remove(username)
+                for username in changed:
+                    self._upsert(username, wanted[username])
+            return len(changed) + len(removed)
+
+    def _managed_lines(self):
+        # {username: raw line} of every managed account, read through the index
+        self._ensure_index()
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+        return {username: data[start:start + length] for username, (start, length) in self._index.items()}
+
+    def _upsert(self, username, line):
+        self._ensure_index()
+        if username in self._index:
+            start, length = self._index[username]
+            self._swap(start, length, line)
+            self._index[username] = (start, len(line))
+            return
+        # New accounts go at the end of the file
+        start = self._key[1] if self._key else 0
+        prefix = b'' if start == 0 or self._ends_with_newline() else b'\n'
+        self._swap(start, 0, prefix + line)
+        self._index[username] = (start + len(prefix), len(line))
+
+    def _remove(self, username):
+        start, length = self._index.pop(username)
+        self._swap(start, length, b'')
+
+    def _rewrite(self, lines):
+        kept = []
+        try:
+            with open(self.path, 'rb') as f:
+                kept = [line for line in f if not line.rstrip().endswith(MARKER.encode('utf-8'))]
+        except FileNotFoundError:
+            pass
+        if kept and not kept[-1].endswith(b'\n'):
+            kept[-1] += b'\n'
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.chap-secrets.')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.writelines(kept)
+                out.writelines(lines)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._key = None
+        self._ensure_index()
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def lookup_line(self, username):
+        """
+        Raw line of a managed account (reads just that line through the index).
+        """
+        with self._lock:
+            self._ensure_index()
+            if username not in self._index:
+                return None
+            start, length = self._index[username]
+            with open(self.path, 'rb') as f:
+                f.seek(start)
+                return f.read(length).decode('utf-8', 'replace')
+
+
+def _copy_range(src, out, start, length):
+    src.seek(start)
+    remaining = length
+    while remaining > 0:
+        chunk = src.read(min(remaining, 1 << 20))
+        if not chunk:
+            break
+        out.write(chunk)
+        remaining -= len(chunk)
+
+
+class SubscriberIndex:
+    """
+    Lookup structures over the subscriber section: by username (the section
+    itself), by static IP and by rate plan, plus a username-sorted list for
+    paging. Rebuilt only when load_config() hands out a different section.
+    """
+
+    def __init__(self, section):
+        self.section = section
+        self.by_ip = {}
+        self.by_plan = {}
+        for username, entry in section.items():
+            if entry.get('ip'):
+                self.by_ip[entry['ip']] = username
+            self.by_plan.setdefault(entry.get('plan', ''), []).append(username)
+        self.usernames = sorted(section)
+
+
+_chap_file = None
+_index = None
+_state_lock = threading.Lock()
+
+
+def _chap():
+    global _chap_file
+    path = apply_service.installed_path(CHAP_SECRETS)
+    with _state_lock:
+        if _chap_file is None or _chap_file.path != path:
+            _chap_file = ChapSecretsFile(path)
+        return _chap_file
+
+
+def get_index():
+    global _index
+    section = load_config().get(SECTION, {})
+    with _state_lock:
+        # The config cache returns the same frozen object until the file changes
+        if _index is None or _index.section is not section:
+            _index = SubscriberIndex(section)
+        return _index
+
+
+def _public(username, entry):
+    return {'username': username, 'password': entry['password'], 'ip': entry.get('ip', ''), 'plan': entry.get('plan', '')}
+
+
+def get_subscriber(username):
+    entry = get_index().section.get(username)
+    return _public(username, entry) if entry else None
+
+
+def find_by_ip(ip):
+    username = get_index().by_ip.get(ip)
+    return get_subscriber(username) if username else None
+
+
+def list_subscribers(search=None, plan=None, offset=0, limit=DEFAULT_LIMIT):
+    """
+    Returns {'total', 'offset', 'limit', 'subscribers'} ordered by username.
+    """
+    index = get_index()
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    offset = max(0, int(offset))
+    usernames = sorted(index.by_plan.get(plan, [])) if plan is not None else index.usernames
+    if search:
+        needle = search.lower()
+        usernames = [u for u in usernames if needle in u.lower() or needle in index.section[u].get('ip', '')]
+    page = usernames[offset:offset + limit]
+    return {
+        'total': len(usernames),
+        'offset': offset,
+        'limit': limit,
+        'subscribers': [_public(u, index.section[u]) for u in page]
+    }
+
+
+def _check_ip_free(index, subscriber):
+    owner = index.by_ip.get(subscriber['ip']) if subscriber['ip'] else None
+    if owner and owner != subscriber['username']:
+        raise ValueError(f'{subscriber["ip"]} is already assigned to {owner}')
+
+
+def reconcile(config):
+    """
+    Brings the managed chap-secrets lines in line with the subscriber section
+    of config. config_service runs this under its generation lock after every
+    save and rollback and before every apply, so whatever rewrote the section
+    (this module, a full-config save, a rollback) pppd sees the same accounts.
+    """
+    return _chap().reconcile(config.get(SECTION, {}))
+
+
+def save_subscriber(entry):
+    """
+    Creates or updates one account; save_config() patches its chap-secrets
+    line under the same lock as the config write.
+    Raises ValueError for invalid data or a static IP already in use.
+    """
+    subscriber = validate_subscriber(entry)
+    _check_ip_free(get_index(), subscriber)
+
+    config = load_config(mutable=True)
+    config.setdefault(SECTION, {})[subscriber['username']] = {
+        'password': subscriber['password'], 'ip': subscriber['ip'], 'plan': subscriber['plan']
+    }
+    save_config(config)
+    return subscriber
+
+
+def delete_subscriber(username):
+    config = load_config(mutable=True)
+    if username not in config.get(SECTION, {}):
+        return False
+    del config[SECTION][username]
+    save_config(config)
+    return True
+
+
+def parse_import(data, filename=''):
+    """
+    Parses an upload into a list of raw entries. JSON: a list of objects or a
+    {username: {...}} mapping. CSV: header row with username,password[,ip][,plan].
+    """
+    text = data.decode('utf-8-sig') if isinstance(data, bytes) else data
+    if filename.lower().endswith('.json') or text.lstrip().startswith(('[', '{')):
+        parsed = json.loads(text)
+        if isinstance(parsed, dict):
+            return [dict(v, username=k) for k, v in parsed.items()]
+        return list(parsed)
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def import_subscribers(entries, replace=False):
+    """
+    Bulk import: validates everything first, then saves the config, which
+    rewrites the managed chap-secrets lines once. With replace, accounts not
+    in the import are removed. Returns {'imported', 'errors'}; nothing is
+    written if any entry is invalid.
+    """
+    config = load_config(mutable=True)
+    current = {} if replace else config.get(SECTION, {})
+    by_ip = {e['ip']: u for u, e in current.items() if e.get('ip')}
+    errors = []
+    imported = {}
+    for n, entry in enumerate(entries, 1):
+        try:
+            subscriber = validate_subscriber(entry)
+            if subscriber['username'] in imported:
+                raise ValueError(f'{subscriber["username"]} appears more than once')
+            owner = by_ip.get(subscriber['ip']) if subscriber['ip'] else None
+            if owner and owner != subscriber['username']:
+                raise ValueError(f'{subscriber["ip"]} is already assigned to {owner}')
+        except (ValueError, AttributeError) as e:
+            errors.append(f'Entry {n}: {e}')
+            continue
+        if subscriber['ip']:
+            by_ip[subscriber['ip']] = subscriber['username']
+        imported[subscriber['username']] = {
+            'password': subscriber['password'], 'ip': subscriber['ip'], 'plan': subscriber['plan']
+        }
+    if errors:
+        return {'imported': 0, 'errors': errors}
+
+    merged = dict(current)
+    merged.update(imported)
+    config[SECTION] = merged
+    save_config(config)
+    return {'imported': len(imported), 'errors': []}
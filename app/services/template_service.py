@@ -0,0 +1,62 @@
+import hashlib
+import os
+import threading
+
+# Daemon config templates (Jinja). Each template is compiled to Python code
+# the first time it is used and then kept for the life of the process: the
+# environment never evicts and never re-checks the files, since they only
+# change with a deploy, which restarts the workers.
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config_templates')
+
+_environment = None
+_fingerprints = {}
+_lock = threading.Lock()
+
+
+def environment():
+    """
+    The shared Jinja environment for TEMPLATE_DIR. Output is plain text (no
+    HTML escaping) and an undefined variable is an error, not an empty string.
+    """
+    global _environment
+    with _lock:
+        if _environment is None or _environment.loader.searchpath != [TEMPLATE_DIR]:
+            import jinja2
+            _environment = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
+                autoescape=False,
+                undefined=jinja2.StrictUndefined,
+                trim_blocks=True,
+                lstrip_blocks=True,
+                keep_trailing_newline=True,
+                auto_reload=False,
+                cache_size=-1
+            )
+        return _environment
+
+
+def render(name, **context):
+    """
+    The whole rendered template as one string, for small files.
+    """
+    return environment().get_template(name).render(**context)
+
+
+def render_stream(name, **context):
+    """
+    The rendered template in chunks, produced as the file is written
+    (see config_service._write_generated_stream).
+    """
+    return environment().get_template(name).generate(**context)
+
+
+def fingerprint(name):
+    """
+    Content hash of a template, so regeneration notices template changes.
+    """
+    path = os.path.join(TEMPLATE_DIR, name)
+    with _lock:
+        if path not in _fingerprints:
+            with open(path, 'rb') as f:
+                _fingerprints[path] = hashlib.sha256(f.read()).hexdigest()
+        return _fingerprints[path]
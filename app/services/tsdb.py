@@ -0,0 +1,285 @@
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+# Round-robin time-series files, one per series. Every file has a fixed size,
+# so disk and page-cache use stay bounded no matter how long the router runs.
+# Interface series exist only for the interfaces the sampler tracks (at most
+# stats_service.MAX_INTERFACES at a time) and are deleted once their interface
+# has been gone for INTERFACE_EXPIRY, so VLAN or bridge churn does not add up.
+METRICS_DIR = 'config/metrics'
+INTERFACE_EXPIRY = 7 * 86400
+
+# (step in seconds, number of rows): 1s for an hour, 1m for a week, 1h for a year
+ARCHIVES = ((1, 3600), (60, 10080), (3600, 8784))
+
+# Named ranges accepted by fetch_range()
+RANGES = {
+    'hour': 3600,
+    'day': 86400,
+    'week': 7 * 86400,
+    'month': 31 * 86400,
+    'year': 366 * 86400,
+}
+
+_MAGIC = b'UBRRRD01'
+_HEADER = struct.Struct('=8sI')
+_ARCHIVE = struct.Struct('=II')
+# bucket start time, min, max, sum, sample count
+_SLOT = struct.Struct('=ddddQ')
+_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]{1,100}$')
+
+
+class Series:
+    """
+    One memory-mapped round-robin series. Every update is rolled up into all
+    archives at once (min/max/sum/count per bucket), so coarse resolutions never
+    have to be recomputed and reads are plain struct unpacks from the mapping.
+    """
+
+    def __init__(self, path, archives=ARCHIVES):
+        self.path = path
+        self.archives = []
+        offset = _HEADER.size + len(archives) * _ARCHIVE.size
+        for step, rows in archives:
+            self.archives.append((step, rows, offset))
+            offset += rows * _SLOT.size
+        self.size = offset
+
+        # The descriptor stays open to tell whether the file was deleted since (see remove())
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(self.fd).st_size != self.size
+            if fresh:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+            self.mm = mmap.mmap(self.fd, self.size)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+        if fresh or _HEADER.unpack_from(self.mm, 0) != (_MAGIC, len(archives)):
+            self.mm[:] = bytes(self.size)
+            _HEADER.pack_into(self.mm, 0, _MAGIC, len(archives))
+            for i, (step, rows) in enumerate(archives):
+                _ARCHIVE.pack_into(self.mm, _HEADER.size + i * _ARCHIVE.size, step, rows)
+
+    def update(self, value, t=None):
+        t = time.time() if t is None else t
+        value = float(value)
+        for step, rows, offset in self.archives:
+            bucket = float(int(t // step) * step)
+            pos = offset + (int(t // step) % rows) * _SLOT.size
+            start, low, high, total, count = _SLOT.unpack_from(self.mm, pos)
+            if start != bucket:
+                # Slot holds data from a previous lap around the ring: start over
+                _SLOT.pack_into(self.mm, pos, bucket, value, value, value, 1)
+            else:
+                _SLOT.pack_into(self.mm, pos, bucket, min(low, value), max(high, value), total + value, count + 1)
+
+    def pick_archive(self, start, now=None):
+        """
+        Finest archive whose retention still covers start.
+        """
+        now = time.time() if now is None else now
+        for archive in self.archives:
+            step, rows, _offset = archive
+            # One step of slack so "the last hour" still maps to the 1s archive
+            if now - start <= step * (rows + 1):
+                return archive
+        return self.archives[-1]
+
+    def fetch(self, start, end, step=None):
+        """
+        Returns {'step': seconds, 'points': [[t, min, avg, max], ...]}.
+        Buckets without data are returned as [t, None, None, None].
+        """
+        if step is None:
+            archive = self.pick_archive(start)
+        else:
+            archive = min(self.archives, key=lambda a: abs(a[0] - step))
+        step, rows, offset = archive
+
+        points = []
+        first = int(start // step)
+        last = int(end // step)
+        # Never walk more than one lap of the ring
+        first = max(first, last - rows + 1)
+        for n in range(first, last + 1):
+            bucket = float(n * step)
+            slot_start, low, high, total, count = _SLOT.unpack_from(self.mm, offset + (n % rows) * _SLOT.size)
+            if slot_start == bucket and count:
+                points.append([bucket, low, total / count, high])
+            else:
+                points.append([bucket, None, None, None])
+        return {'step': step, 'points': points}
+
+    def deleted(self):
+        return os.fstat(self.fd).st_nlink == 0
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+_lock = threading.Lock()
+_series = {}
+
+
+def _path(name):
+    return os.path.join(METRICS_DIR, name + '.rrd')
+
+
+def _open(name, create=True):
+    if not _NAME_RE.match(name):
+        raise ValueError(f'Invalid series name: {name}')
+    # Keyed on the path, so pointing METRICS_DIR elsewhere (tests, benchmarks) opens new files
+    path = _path(name)
+    with _lock:
+        series = _series.get(path)
+        if series is not None and series.deleted():
+            # Expired (and maybe created anew) by the recording process: drop the stale mapping
+            series.close()
+            series = None
+        if series is None:
+            if not create and not os.path.exists(path):
+                _series.pop(path, None)
+                return None
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            series = Series(path)
+            _series[path] = series
+        return series
+
+
+def record(name, value, t=None):
+    """
+    Adds one sample to a series, creating its file on first use.
+    """
+    _open(name).update(value, t)
+
+
+def remove(name):
+    """
+    Deletes a series and its file.
+    """
+    path = _path(name)
+    with _lock:
+        series = _series.pop(path, None)
+        if series is not None:
+            series.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def list_series():
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return []
+    return sorted(n[:-4] for n in names if n.endswith('.rrd'))
+
+
+def fetch_range(name, start=None, end=None, period='day'):
+    """
+    Returns the points of a series between start and end (epoch seconds),
+    or for a named period ending now. None if the series does not exist.
+    """
+    if not _NAME_RE.match(name):
+        return None
+    series = _open(name, create=False)
+    if series is None:
+        return None
+    end = time.time() if end is None else end
+    if start is None:
+        start = end - RANGES.get(period, RANGES['day'])
+    result = series.fetch(start, end)
+    result['series'] = name
+    return result
+
+
+_IFACE_SUFFIXES = ('.rx_bps', '.tx_bps')
+
+
+def _interface_series():
+    """
+    {interface: modification time of its newest series file} for the interface series on disk.
+    """
+    seen = {}
+    for series in list_series():
+        if series.startswith('iface.') and series.endswith(_IFACE_SUFFIXES):
+            try:
+                mtime = os.path.getmtime(_path(series))
+            except OSError:
+                continue
+            name = series[len('iface.'):-len('.rx_bps')]
+            seen[name] = max(seen.get(name, 0), mtime)
+    return seen
+
+
+def _interface_recorder():
+    """
+    Listener for the interface sampler: stores per-interface bit rates, the
+    number of PPPoE sessions and system load once a second. Only runs in the sampling process, so every
+    series has exactly one writer.
+    """
+    import psutil
+    from app.services import green, pppoe_sessions
+
+    previous = {}
+    # When each interface was last sampled; files of earlier runs count from their last write
+    seen = _interface_series()
+    state = {'t': None, 'expired': 0.0}
+
+    def on_sample(sampler, counters):
+        now = time.time()
+        last_t = state['t']
+        state['t'] = now
+        # Only the sampler's slots (excluded prefixes are never given one), not every raw counter
+        for name in sampler.slots:
+            values = counters.get(name)
+            if name == 'lo' or values is None:
+                continue
+            seen[name] = now
+            old = previous.get(name)
+            previous[name] = values
+            if old is None or last_t is None or now <= last_t:
+                continue
+            dt = now - last_t
+            record(f'iface.{name}.rx_bps', max(values[0] - old[0], 0) * 8 / dt, now)
+            record(f'iface.{name}.tx_bps', max(values[1] - old[1], 0) * 8 / dt, now)
+        for name in [n for n in previous if n not in counters or n not in sampler.slots]:
+            del previous[name]
+        if now - state['expired'] >= 60:
+            state['expired'] = now
+            for name, t in list(seen.items()):
+                if name not in previous and now - t > INTERFACE_EXPIRY:
+                    del seen[name]
+                    for suffix in _IFACE_SUFFIXES:
+                        remove('iface.' + name + suffix)
+        # ppp interfaces are left out above; the session store knows how many are up
+        record('pppoe.sessions', green.blocking(pppoe_sessions.get_store().counts)['sessions'], now)
+        record('system.cpu_percent', green.blocking(psutil.cpu_percent, None), now)
+        record('system.mem_percent', green.blocking(psutil.virtual_memory).percent, now)
+
+    return on_sample
+
+
+_recording = False
+
+
+def start_recording():
+    """
+    Hooks the recorder into the shared interface sampler (once per process).
+    """
+    global _recording
+    from app.services import stats_service
+    with _lock:
+        if _recording:
+            return
+        _recording = True
+    stats_service.add_listener(_interface_recorder())
@@ -0,0 +1,275 @@
+import os
+
+# NIC interrupt and queue layout. The hardware is read from sysfs and
+# /proc/interrupts; the proposed layout spreads every NIC's queue interrupts over
+# the CPUs (continuing where the previous NIC stopped, so two NICs do not pile
+# onto the same cores) and adds RPS/XPS masks where the NIC has fewer queues
+# than there are CPUs.
+SYS_NET = '/sys/class/net'
+PROC_INTERRUPTS = '/proc/interrupts'
+PROC_IRQ = '/proc/irq'
+# RFS flow table size (net.core.rps_sock_flow_entries), split across RX queues
+RFS_FLOW_ENTRIES = 32768
+OFFLOADS = ('gro', 'gso', 'tso', 'lro')
+
+
+def read_interrupts():
+    """
+    Returns {irq number: {'name', 'counts': [per CPU]}} for the numbered lines of /proc/interrupts.
+    """
+    interrupts = {}
+    try:
+        with open(PROC_INTERRUPTS, 'r') as f:
+            cpus = len(f.readline().split())
+            for line in f:
+                fields = line.split()
+                if not fields or not fields[0].rstrip(':').isdigit():
+                    continue
+                counts = []
+                for value in fields[1:cpus + 1]:
+                    if not value.isdigit():
+                        break
+                    counts.append(int(value))
+                interrupts[int(fields[0].rstrip(':'))] = {
+                    'name': fields[-1] if len(fields) > cpus + 1 else '',
+                    'counts': counts
+                }
+    except OSError:
+        pass
+    return interrupts
+
+
+def nic_irqs(name, interrupts):
+    """
+    IRQ numbers of a NIC in vector order: the MSI vectors of its PCI device if
+    sysfs lists them, otherwise the /proc/interrupts lines named after it.
+    """
+    try:
+        irqs = sorted(int(i) for i in os.listdir(os.path.join(SYS_NET, name, 'device', 'msi_irqs')))
+        return [irq for irq in irqs if irq in interrupts]
+    except (OSError, ValueError):
+        pass
+    return sorted(irq for irq, info in interrupts.items()
+                  if info['name'] == name or info['name'].startswith(f'{name}-'))
+
+
+def _queue_count(name, prefix):
+    try:
+        return sum(1 for q in os.listdir(os.path.join(SYS_NET, name, 'queues')) if q.startswith(prefix))
+    except OSError:
+        return 0
+
+
+def read_hardware(interfaces):
+    """
+    Returns {'cpus', 'nics': {name: {'irqs', 'rx_queues', 'tx_queues', 'speed', 'mtu'}}}
+    for the physical NICs among interfaces (dicts from get_network_interfaces()).
+    irqs is a count; the numbers change between boots and are looked up at runtime.
+    """
+    interrupts = read_interrupts()
+    nics = {}
+    for iface in sorted(interfaces, key=lambda i: i['name']):
+        name = iface['name']
+        if not os.path.exists(os.path.join(SYS_NET, name, 'device')):
+            continue  # bridges, ppp, tunnels, loopback
+        nics[name] = {
+            'irqs': len(nic_irqs(name, interrupts)),
+            'rx_queues': _queue_count(name, 'rx-'),
+            'tx_queues': _queue_count(name, 'tx-'),
+            'speed': iface.get('speed', 0),
+            'mtu': iface.get('mtu', 0)
+        }
+    return {'cpus': os.cpu_count() or 1, 'nics': nics}
+
+
+def _read_value(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def read_current(hardware):
+    """
+    The layout the kernel uses right now: per NIC the IRQs with their affinity
+    and interrupt counts, the RPS/XPS masks, and per CPU the interrupts it took
+    for all NICs together.
+    """
+    interrupts = read_interrupts()
+    per_cpu = [0] * hardware['cpus']
+    nics = {}
+    for name in hardware['nics']:
+        irqs = []
+        for irq in nic_irqs(name, interrupts):
+            counts = interrupts[irq]['counts']
+            for cpu, count in enumerate(counts[:len(per_cpu)]):
+                per_cpu[cpu] += count
+            irqs.append({
+                'irq': irq,
+                'name': interrupts[irq]['name'],
+                'cpus': _read_value(os.path.join(PROC_IRQ, str(irq), 'smp_affinity_list')) or '',
+                'count': sum(counts)
+            })
+        queues = os.path.join(SYS_NET, name, 'queues')
+        nics[name] = {
+            'irqs': irqs,
+            'rps': [_read_value(os.path.join(queues, f'rx-{i}', 'rps_cpus')) or '0'
+                    for i in range(hardware['nics'][name]['rx_queues'])],
+            'xps': [_read_value(os.path.join(queues, f'tx-{i}', 'xps_cpus')) or '0'
+                    for i in range(hardware['nics'][name]['tx_queues'])]
+        }
+    return {'nics': nics, 'per_cpu': per_cpu}
+
+
+def cpu_mask(cpus):
+    """
+    [0, 1, 33] -> '00000002,00000003', the format of rps_cpus/xps_cpus.
+    """
+    value = 0
+    for cpu in cpus:
+        value |= 1 << cpu
+    words = []
+    while True:
+        words.append(value & 0xffffffff)
+        value >>= 32
+        if not value:
+            break
+    if len(words) == 1:
+        return f'{words[0]:x}'
+    return ','.join(f'{w:08x}' for w in reversed(words))
+
+
+def plan_layout(hardware, cpus, settings):
+    """
+    Proposed layout for every NIC in hardware, using only cpus:
+    {name: {'irq_cpus': [CPU per IRQ], 'rps': [mask per RX queue], 'xps': [mask per TX queue],
+    'rfs_flow_cnt'}}. RPS is only used when a NIC has fewer RX queues than
+    CPUs (otherwise RSS in the NIC already spreads the load).
+    """
+    cpus = [c for c in cpus if c < hardware['cpus']] or list(range(hardware['cpus']))
+    layout = {}
+    cursor = 0
+    for name, nic in sorted(hardware['nics'].items()):
+        irq_cpus = []
+        for _ in range(nic['irqs']):
+            irq_cpus.append(cpus[cursor % len(cpus)])
+            cursor += 1
+
+        rx = nic['rx_queues']
+        rps = []
+        if settings.get('rps', True) and 0 < rx < len(cpus):
+            rps = [cpu_mask(c for n, c in enumerate(cpus) if n % rx == q) for q in range(rx)]
+        tx = nic['tx_queues']
+        xps = []
+        if settings.get('xps', True) and tx > 1:
+            xps = [cpu_mask(c for n, c in enumerate(cpus) if n % tx == q) for q in range(tx)]
+
+        layout[name] = {
+            'irq_cpus': irq_cpus if settings.get('irq_affinity', True) else [],
+            'rps': rps,
+            'xps': xps,
+            'rfs_flow_cnt': RFS_FLOW_ENTRIES // rx if rps else 0
+        }
+    return layout
+
+
+def _ring_value(value):
+    value = str(value or '').strip().lower()
+    if value == 'max' or value.isdigit():
+        return value
+    return ''
+
+
+def render_script(layout, settings):
+    """
+    Content of setup_tuning.sh. IRQ numbers are looked up when it runs (they
+    are assigned at boot); everything else was decided at generation time.
+    """
+    lines = [
+        '#!/bin/bash',
+        '# NIC queue and interrupt tuning (generated by Ubuntu Router UI)',
+        '# Runs at boot (ubuntu-router-tuning.service) and on Apply.',
+        '',
+        'put() {',
+        '    # $1 value, $2 sysfs/procfs file; missing queues (hardware changed) are skipped',
+        '    [ -w "$2" ] && echo "$1" > "$2" 2>/dev/null',
+        '}',
+        '',
+        'nic_irqs() {',
+        '    # IRQs of a NIC in vector order, same lookup as the UI',
+        '    if [ -d "/sys/class/net/$1/device/msi_irqs" ]; then',
+        '        ls "/sys/class/net/$1/device/msi_irqs" | sort -n',
+        '    else',
+        "        awk -v dev=\"$1\" '$NF == dev || index($NF, dev \"-\") == 1 {sub(\":\", \"\", $1); print $1}' /proc/interrupts",
+        '    fi',
+        '}',
+        '',
+        'set_irqs() {',
+        '    # $1 NIC, then the CPU for each of its IRQs (reused in turn if there are more IRQs now)',
+        '    local dev=$1 i=0 irq',
+        '    shift',
+        '    local cpus=("$@")',
+        '    for irq in $(nic_irqs "$dev"); do',
+        '        [ -e "/proc/irq/$irq" ] || continue',
+        '        put "${cpus[$((i % ${#cpus[@]}))]}" "/proc/irq/$irq/smp_affinity_list"',
+        '        i=$((i + 1))',
+        '    done',
+        '}',
+        '',
+        'ring_max() {',
+        '    # $1 NIC, $2 RX or TX: the largest ring the driver allows',
+        "    ethtool -g \"$1\" 2>/dev/null | awk -v k=\"$2:\" '/^Pre-set/ {m = 1} /^Current/ {m = 0} m && $1 == k {print $2; exit}'",
+        '}',
+        '',
+    ]
+
+    if not settings.get('enabled') or not layout:
+        lines.append("echo 'NIC tuning disabled.'")
+        return '\n'.join(lines) + '\n'
+
+    if any(nic['irq_cpus'] for nic in layout.values()):
+        lines.append('# irqbalance would move the interrupts right back')
+        lines.append('if systemctl is-active --quiet irqbalance 2>/dev/null; then')
+        lines.append('    systemctl stop irqbalance')
+        lines.append('    systemctl disable irqbalance')
+        lines.append('fi')
+    if any(nic['rps'] for nic in layout.values()):
+        lines.append(f'sysctl -qw net.core.rps_sock_flow_entries={RFS_FLOW_ENTRIES}')
+
+    for name, nic in layout.items():
+        nic_settings = settings.get('interfaces', {}).get(name, {})
+        body = []
+
+        ring_args = []
+        for key, flag in (('rx_ring', 'rx'), ('tx_ring', 'tx')):
+            value = _ring_value(nic_settings.get(key))
+            if value == 'max':
+                ring_args.append(f'{flag} $(ring_max {name} {flag.upper()})')
+            elif value:
+                ring_args.append(f'{flag} {value}')
+        if ring_args:
+            body.append(f"    ethtool -G {name} {' '.join(ring_args)} 2>/dev/null || echo 'Could not set ring sizes of {name}' >&2")
+
+        offloads = [f'{k} {v}' for k, v in sorted(nic_settings.get('offloads', {}).items())
+                    if k in OFFLOADS and v in ('on', 'off')]
+        if offloads:
+            body.append(f"    ethtool -K {name} {' '.join(offloads)} 2>/dev/null || echo 'Could not set offloads of {name}' >&2")
+
+        if nic['irq_cpus']:
+            body.append(f"    set_irqs {name} {' '.join(str(c) for c in nic['irq_cpus'])}")
+        for queue, mask in enumerate(nic['rps']):
+            body.append(f'    put {mask} /sys/class/net/{name}/queues/rx-{queue}/rps_cpus')
+            body.append(f"    put {nic['rfs_flow_cnt']} /sys/class/net/{name}/queues/rx-{queue}/rps_flow_cnt")
+        for queue, mask in enumerate(nic['xps']):
+            body.append(f'    put {mask} /sys/class/net/{name}/queues/tx-{queue}/xps_cpus')
+        if body:
+            lines.append('')
+            lines.append(f'# {name}')
+            lines.append(f'if [ -d /sys/class/net/{name} ]; then')
+            lines.extend(body)
+            lines.append('fi')
+
+    lines.append('')
+    lines.append("echo 'NIC tuning applied.'")
+    return '\n'.join(lines) + '\n'
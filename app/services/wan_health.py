@@ -0,0 +1,408 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import struct
+import tempfile
+import time
+from app.services import config_service
+
+# Health daemon for load-balanced WANs. Every enabled WAN is probed concurrently,
+# with each probe bound to its interface (SO_BINDTODEVICE) and tagged with its
+# connmark (SO_MARK) so it leaves through that WAN and no other. Loss and latency
+# are smoothed with an EWMA; when a WAN crosses the down/up thresholds only the
+# multipath default route is replaced, nothing is regenerated.
+STATE_FILE = 'config/wan_health.json'
+
+INTERVAL = 2.0
+TIMEOUT = 1.0
+DEFAULT_TARGETS = ('1.1.1.1', '8.8.8.8')
+TCP_PORT = 443
+# Weight of the newest round in the moving averages
+ALPHA = 0.3
+# Hysteresis: a WAN goes down when smoothed loss reaches LOSS_DOWN (or latency
+# RTT_DOWN_MS) and only comes back after UP_ROUNDS rounds at or below LOSS_UP
+LOSS_DOWN = 0.6
+LOSS_UP = 0.1
+RTT_DOWN_MS = 1500.0
+UP_ROUNDS = 3
+# The kernel route is re-checked this often even without state changes, so a
+# re-run of setup_loadbalance.sh cannot bring a dead WAN back into the route
+RESYNC_INTERVAL = 30.0
+
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+SO_MARK = getattr(socket, 'SO_MARK', 36)
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _bind(sock, iface, mark=None):
+    sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, iface.encode('utf-8'))
+    if mark:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_MARK, mark)
+        except PermissionError:
+            # Needs CAP_NET_ADMIN; the device binding alone still picks the WAN's nexthop
+            pass
+
+
+# Echo ids for raw sockets, one per probe: every raw socket sees every reply,
+# so the probes of one round must not be able to answer for each other
+_idents = itertools.count(os.getpid())
+
+
+def _icmp_socket():
+    # Unprivileged ping sockets where net.ipv4.ping_group_range allows them, raw otherwise
+    try:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+    except PermissionError:
+        return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True
+
+
+async def probe_icmp(iface, target, timeout=TIMEOUT, mark=None, seq=1):
+    """
+    Sends one echo request out of iface. Returns the round trip in seconds, or None.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        address = socket.inet_aton(target)
+    except OSError:
+        try:
+            infos = await loop.getaddrinfo(target, None, family=socket.AF_INET)
+            address = socket.inet_aton(infos[0][4][0])
+        except (OSError, IndexError):
+            return None
+    try:
+        sock, raw = _icmp_socket()
+    except OSError:
+        return None
+    ident = next(_idents) & 0xffff
+    with sock:
+        try:
+            sock.setblocking(False)
+            _bind(sock, iface, mark)
+            payload = struct.pack('!d', time.monotonic())
+            header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+            packet = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, _checksum(header + payload), ident, seq) + payload
+            start = time.monotonic()
+            sock.sendto(packet, (socket.inet_ntoa(address), 0))
+        except OSError:
+            return None
+
+        deadline = start + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                data = await asyncio.wait_for(loop.sock_recv(sock, 2048), remaining)
+            except (asyncio.TimeoutError, OSError):
+                return None
+            if raw:
+                # Raw sockets see every ICMP packet, IP header included: only
+                # a reply from this target counts, not one to another probe
+                if len(data) < 20 or data[12:16] != address:
+                    continue
+                data = data[(data[0] & 0x0f) * 4:]
+            if len(data) < 8:
+                continue
+            kind, _code, _sum, reply_id, reply_seq = struct.unpack_from('!BBHHH', data)
+            # Ping sockets rewrite the id to their local port, so only raw replies are matched on it
+            if kind == ICMP_ECHO_REPLY and reply_seq == seq and (not raw or reply_id == ident):
+                return time.monotonic() - start
+
+
+async def probe_tcp(iface, target, port=TCP_PORT, timeout=TIMEOUT, mark=None):
+    """
+    Opens (and immediately closes) a TCP connection out of iface. A refused
+    connection still proves the path works. Returns the round trip in seconds, or None.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    except OSError:
+        return None
+    with sock:
+        try:
+            sock.setblocking(False)
+            _bind(sock, iface, mark)
+            start = time.monotonic()
+            await asyncio.wait_for(loop.sock_connect(sock, (target, port)), timeout)
+        except ConnectionRefusedError:
+            pass
+        except (asyncio.TimeoutError, OSError):
+            return None
+        return time.monotonic() - start
+
+
+def _parse_target(target, method):
+    """
+    'host' or 'host:port'. A port switches the target to a TCP probe.
+    """
+    host, _, port = str(target).partition(':')
+    if port:
+        return host, 'tcp', int(port)
+    return host, method, TCP_PORT
+
+
+class WanState:
+    """
+    Smoothed health of one WAN. Pure bookkeeping: fed with the results of
+    one probe round, it reports whether the WAN changed between up and down.
+    """
+
+    def __init__(self, name, up=True):
+        self.name = name
+        self.up = up
+        self.loss = 0.0
+        self.rtt_ms = None
+        self.good_rounds = 0
+        self.last_change = time.time()
+        self.last_results = []
+
+    def update(self, results):
+        """
+        results: list of round trips in seconds (None for a lost probe).
+        Returns True if the WAN went down or came back.
+        """
+        self.last_results = results
+        if not results:
+            return False
+        lost = sum(1 for r in results if r is None) / len(results)
+        self.loss = ALPHA * lost + (1 - ALPHA) * self.loss
+        answered = [r * 1000 for r in results if r is not None]
+        if answered:
+            rtt = sum(answered) / len(answered)
+            self.rtt_ms = rtt if self.rtt_ms is None else ALPHA * rtt + (1 - ALPHA) * self.rtt_ms
+
+        healthy = self.loss <= LOSS_UP and (self.rtt_ms is None or self.rtt_ms < RTT_DOWN_MS)
+        self.good_rounds = self.good_rounds + 1 if healthy else 0
+
+        if self.up and (self.loss >= LOSS_DOWN or (self.rtt_ms or 0) >= RTT_DOWN_MS):
+            self.up = False
+        elif not self.up and self.good_rounds >= UP_ROUNDS:
+            self.up = True
+        else:
+            return False
+        self.last_change = time.time()
+        return True
+
+    def as_dict(self):
+        return {
+            'state': 'up' if self.up else 'down',
+            'loss': round(self.loss, 3),
+            'rtt_ms': round(self.rtt_ms, 1) if self.rtt_ms is not None else None,
+            'last_change': self.last_change,
+            'last_results': [round(r * 1000, 1) if r is not None else None for r in self.last_results]
+        }
+
+
+async def _ip(*args):
+    """
+    Runs ip without blocking the probes. Returns (exit status, stdout, stderr);
+    the status is None if ip could not be started at all.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ip', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        return None, '', str(e)
+    stdout, stderr = await process.communicate()
+    return process.returncode, stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace')
+
+
+async def _wan_gateway(table):
+    """
+    Gateway of a WAN as installed in its own routing table by setup_loadbalance.sh.
+    """
+    _status, stdout, _stderr = await _ip('-4', 'route', 'show', 'table', str(table), 'default')
+    fields = stdout.split()
+    if 'via' in fields:
+        return fields[fields.index('via') + 1]
+    return None
+
+
+def _split_routes(output):
+    """
+    Splits ip route output into one field list per route; the nexthop lines
+    of a multipath route are indented below it.
+    """
+    routes = []
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        if line[0].isspace() and routes:
+            routes[-1] += line.split()
+        else:
+            routes.append(line.split())
+    return routes
+
+
+async def _current_nexthop_devices():
+    """
+    Interfaces in the default route this daemon manages: the one in the main
+    table with metric 0, as installed by setup_loadbalance.sh. Defaults with a
+    metric (DHCP or netplan routes of the WANs themselves) are not ours.
+    Returns None if the routes could not be read.
+    """
+    status, stdout, _stderr = await _ip('-4', 'route', 'show', 'table', 'main', 'default')
+    if status != 0:
+        return None
+    for fields in _split_routes(stdout):
+        metric = fields[fields.index('metric') + 1] if 'metric' in fields[:-1] else '0'
+        if metric == '0':
+            return sorted(fields[i + 1] for i, field in enumerate(fields[:-1]) if field == 'dev')
+    return []
+
+
+async def update_nexthops(wans, states):
+    """
+    Replaces the multipath default route with the WANs that are up. If every
+    WAN is down all of them stay in, since no route at all helps nobody.
+    Returns the interfaces now in the route, or None if the route could not
+    be updated (no gateway known yet, ip failed); the caller then retries.
+    """
+    healthy = [w for w in wans if states[w['name']].up] or wans
+    gateways = await asyncio.gather(*(_wan_gateway(wan['table']) for wan in healthy))
+    nexthops = [(gateway, wan['name'], wan['weight']) for wan, gateway in zip(healthy, gateways) if gateway]
+    if not nexthops:
+        return None
+    names = [name for _gw, name, _weight in nexthops]
+    if await _current_nexthop_devices() == sorted(names):
+        return names
+
+    command = ['route', 'replace', 'default', 'scope', 'global']
+    for gateway, name, weight in nexthops:
+        command += ['nexthop', 'via', gateway, 'dev', name, 'weight', str(weight)]
+    status, _stdout, stderr = await _ip(*command)
+    if status != 0:
+        print(f"Could not update the default route ({' '.join(names)}): {stderr.strip() or status}", flush=True)
+        return None
+    return names
+
+
+def _probe_plan(config):
+    """
+    Returns (wans, {iface: [(host, method, port)]}) for the enabled load-balanced WANs.
+    Per-WAN 'probe' ('icmp' or 'tcp') and 'targets' may be set in the loadbalance settings.
+    """
+    wans = config_service.get_lb_wans(config)
+    plan = {}
+    for wan in wans:
+        settings = config.get('loadbalance', {}).get(wan['name'], {})
+        method = settings.get('probe', 'icmp')
+        targets = settings.get('targets') or DEFAULT_TARGETS
+        plan[wan['name']] = [_parse_target(t, method) for t in targets]
+    return wans, plan
+
+
+async def probe_round(wans, plan, timeout=TIMEOUT, seq=1):
+    """
+    Probes every target of every WAN at once. Returns {iface: [rtt or None]}.
+    """
+    jobs = []
+    owners = []
+    for wan in wans:
+        for host, method, port in plan[wan['name']]:
+            if method == 'tcp':
+                jobs.append(probe_tcp(wan['name'], host, port, timeout, wan['mark']))
+            else:
+                jobs.append(probe_icmp(wan['name'], host, timeout, wan['mark'], seq))
+            owners.append(wan['name'])
+    results = {wan['name']: [] for wan in wans}
+    for owner, rtt in zip(owners, await asyncio.gather(*jobs)):
+        results[owner].append(rtt)
+    return results
+
+
+def read_state():
+    """
+    Last state written by the daemon: {'updated': t, 'wans': {iface: {...}}}.
+    """
+    try:
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'updated': None, 'wans': {}}
+
+
+def _write_state(states, active):
+    os.makedirs(os.path.dirname(STATE_FILE) or '.', exist_ok=True)
+    data = {
+        'updated': time.time(),
+        'active': active,
+        'wans': {name: state.as_dict() for name, state in states.items()}
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(STATE_FILE) or '.', prefix='.wan_health.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, STATE_FILE)
+
+
+async def run(interval=INTERVAL, once=False, apply_routes=True):
+    from app.services import tsdb
+
+    states = {}
+    active = None
+    last_resync = 0.0
+    failed = False
+    seq = 0
+    while True:
+        started = time.monotonic()
+        wans, plan = _probe_plan(config_service.load_config())
+        # Forget WANs that were removed from load balancing, start new ones as up
+        states = {w['name']: states.get(w['name']) or WanState(w['name']) for w in wans}
+
+        seq = (seq + 1) & 0xffff
+        results = await probe_round(wans, plan, min(TIMEOUT, interval), seq)
+        changed = False
+        for name, rtts in results.items():
+            if states[name].update(rtts):
+                changed = True
+                print(f"{name} is {'up' if states[name].up else 'down'} "
+                      f"(loss {states[name].loss:.2f}, rtt {states[name].rtt_ms} ms)", flush=True)
+            tsdb.record(f'wan.{name}.loss', states[name].loss)
+            if states[name].rtt_ms is not None:
+                tsdb.record(f'wan.{name}.rtt_ms', states[name].rtt_ms)
+
+        if apply_routes and wans and (changed or failed or time.monotonic() - last_resync >= RESYNC_INTERVAL):
+            routed = await update_nexthops(wans, states)
+            # On failure the route (and what is reported as active) stays as it
+            # was, and the next round tries again
+            failed = routed is None
+            if not failed:
+                active = routed
+                last_resync = time.monotonic()
+        _write_state(states, active)
+
+        if once:
+            return states
+        await asyncio.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Probe load-balanced WANs and drop dead ones from the default route.')
+    parser.add_argument('--interval', type=float, default=INTERVAL, help='Seconds between probe rounds')
+    parser.add_argument('--once', action='store_true', help='Run a single round and print the result')
+    parser.add_argument('--no-routes', action='store_true', help='Only record health, never touch routes')
+    args = parser.parse_args()
+
+    states = asyncio.run(run(args.interval, args.once, not args.no_routes))
+    if args.once:
+        print(json.dumps({name: state.as_dict() for name, state in states.items()}, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import functools
+import json
+import re
+
+# Canonical block-style YAML for the generated netplan file, without a YAML
+# library: mapping keys are sorted, indentation is two spaces, and a string
+# is only left unquoted when no YAML 1.1 reader (netplan uses libyaml) could
+# take it for anything else. Quoted strings use JSON escaping, which is valid
+# YAML. The same value therefore always gives the same bytes.
+
+_PLAIN_RE = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_./-]*$')
+# Numbers in any YAML 1.1 notation (ints, floats, hex, octal, binary) and dates
+_NUMBER_RE = re.compile(r'^(?:[-+]?(?:[0-9_]*\.?[0-9_]*(?:[eE][-+]?[0-9]+)?|0[xob][0-9a-fA-F_]+|\.(?:inf|nan))|[0-9]{4}-[0-9]{1,2}-[0-9]{1,2}.*)$', re.I)
+_RESERVED = {'y', 'n', 'yes', 'no', 'on', 'off', 'true', 'false', 'null', '~'}
+
+
+def scalar(value):
+    """
+    One scalar as YAML text.
+    """
+    if value is None:
+        return 'null'
+    if value is True or value is False:
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return json.dumps(value)
+    return _string(str(value))
+
+
+# Keys and most values repeat once per interface
+@functools.lru_cache(maxsize=4096)
+def _string(value):
+    if _PLAIN_RE.match(value) and not _NUMBER_RE.match(value) and value.lower() not in _RESERVED:
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _lines(value, indent):
+    pad = ' ' * indent
+    if isinstance(value, dict):
+        for key in sorted(value, key=str):
+            item = value[key]
+            if isinstance(item, (dict, list)) and item:
+                yield f'{pad}{scalar(key)}:\n'
+                # Sequences under a key are indented too, as netplan's examples do
+                yield from _lines(item, indent + 2)
+            else:
+                yield f'{pad}{scalar(key)}: {_inline(item)}\n'
+    else:
+        for item in value:
+            if isinstance(item, (dict, list)) and item:
+                # The first line of a nested block goes on the '- ' line
+                first = True
+                for line in _lines(item, indent + 2):
+                    yield f'{pad}- {line[indent + 2:]}' if first else line
+                    first = False
+            else:
+                yield f'{pad}- {_inline(item)}\n'
+
+
+def _inline(value):
+    if isinstance(value, dict):
+        return '{}'
+    if isinstance(value, list):
+        return '[]'
+    return scalar(value)
+
+
+def dump(value, header=''):
+    """
+    Yields the YAML document for value (a dict) line by line, after header.
+    """
+    if header:
+        yield header
+    if not value:
+        yield '{}\n'
+        return
+    yield from _lines(value, 0)
@@ -0,0 +1,185 @@
+import collections
+import contextlib
+import ipaddress
+import os
+import socket
+import subprocess
+import psutil
+from app.services import (apply_service, config_service, conntrack_service, interface_inventory, job_service,
+                          lease_service, pppoe_sessions, qos_service, stats_service, subscriber_service, tsdb,
+                          tuning_service, wan_health)
+from benchmarks import fixtures
+
+# Stand-ins for what the app reads from the machine, so a benchmark run
+# depends only on the synthetic config: psutil, /proc and /sys readers, and
+# every command the app would run. Paths the app writes to are moved into
+# the run's temp directory.
+
+_IfStats = collections.namedtuple('snicstats', 'isup duplex speed mtu flags')
+_IfAddr = collections.namedtuple('snicaddr', 'family address netmask broadcast ptp')
+_IoCounters = collections.namedtuple('snetio', 'bytes_sent bytes_recv packets_sent packets_recv errin errout dropin dropout')
+_Memory = collections.namedtuple('svmem', 'total available percent used free')
+
+
+class FakeProcess:
+    """
+    subprocess.Popen replacement: the command succeeds at once with no output.
+    """
+
+    def __init__(self, commands, cmd, *args, **kwargs):
+        commands.append(list(cmd))
+        self.args = cmd
+        self.returncode = None
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        os.close(out_w)
+        os.close(err_w)
+        self.stdout = os.fdopen(out_r, 'rb')
+        self.stderr = os.fdopen(err_r, 'rb')
+
+    def wait(self, timeout=None):
+        self.returncode = 0
+        return 0
+
+    def communicate(self, input=None, timeout=None):
+        self.wait()
+        return b'', b''
+
+
+class Machine:
+    """
+    The fake host: interfaces from the config's network section plus br0 and
+    lo, all up with their configured addresses.
+    """
+
+    def __init__(self, config, root):
+        self.root = root
+        self.commands = []
+        self.names = ['lo', 'br0'] + sorted(config['network'])
+        self.addresses = {'lo': '127.0.0.1/8'}
+        for name, settings in config['network'].items():
+            if settings.get('ip'):
+                self.addresses[name] = settings['ip']
+        self.addresses['br0'] = self.addresses.pop('lan0', '192.168.0.1/16')
+
+    # --- psutil ---
+
+    def net_if_stats(self):
+        return {name: _IfStats(True, 2, 10000, 1500, 'up,broadcast,running') for name in self.names}
+
+    def net_if_addrs(self):
+        addrs = {}
+        for name, address in self.addresses.items():
+            iface = ipaddress.IPv4Interface(address if '/' in address else f'{address}/24')
+            addrs[name] = [_IfAddr(socket.AF_INET, str(iface.ip), str(iface.netmask), None, None)]
+        return addrs
+
+    def net_io_counters(self, pernic=False):
+        return {name: _IoCounters(*([n * 1000] * 8)) for n, name in enumerate(self.names)}
+
+    def virtual_memory(self):
+        total = 32 * 1024 ** 3
+        return _Memory(total, total // 2, 50.0, total // 2, total // 2)
+
+    def cpu_percent(self, interval=None, percpu=False):
+        return 12.5
+
+    # --- /proc and commands ---
+
+    def read_counters(self):
+        return {name: (n * 1000,) * len(stats_service.FIELDS) for n, name in enumerate(self.names)}
+
+    def run(self, cmd, *args, **kwargs):
+        self.commands.append(list(cmd))
+        text = kwargs.get('text') or kwargs.get('universal_newlines')
+        return subprocess.CompletedProcess(cmd, 0, '' if text else b'', '' if text else b'')
+
+    def popen(self, cmd, *args, **kwargs):
+        return FakeProcess(self.commands, cmd, *args, **kwargs)
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _fake_proc(root, config, sizes):
+    # conntrack counters and a table sample, as the kernel would show them
+    netfilter = os.path.join(root, 'proc', 'netfilter')
+    _write(os.path.join(netfilter, 'nf_conntrack_count'), f"{sizes['pppoe_sessions'] * 40}\n")
+    _write(os.path.join(netfilter, 'nf_conntrack_max'), '262144\n')
+    _write(os.path.join(netfilter, 'nf_conntrack_buckets'), '262144\n')
+    header = 'entries clashres found new invalid ignore delete delete_list insert insert_failed drop early_drop error expect_new expect_create expect_delete search_restart'
+    row = ' '.join(['0000001f'] * len(header.split()))
+    _write(os.path.join(root, 'proc', 'nf_conntrack_stat'), header + '\n' + '\n'.join([row] * fixtures.CPUS) + '\n')
+    table = ''.join(
+        f'ipv4     2 tcp      6 431999 ESTABLISHED src=10.254.0.{n % 250 + 2} dst=93.184.216.34 sport={1024 + n} dport=443 [ASSURED] mark=0 use=1\n'
+        for n in range(min(conntrack_service.BREAKDOWN_SAMPLE, sizes['pppoe_sessions'] * 10)))
+    _write(os.path.join(root, 'proc', 'nf_conntrack'), table)
+    _write(os.path.join(root, 'proc', 'interrupts'), '           ' + ' '.join(f'CPU{n}' for n in range(fixtures.CPUS)) + '\n')
+
+
+@contextlib.contextmanager
+def installed(root, config, sizes):
+    """
+    Points the app at root and the fake machine for the duration of the block.
+    Yields the Machine, whose commands list records every command run.
+    """
+    machine = Machine(config, root)
+    _fake_proc(root, config, sizes)
+    _write(os.path.join(root, 'run', 'pppoe-events.log'), fixtures.pppoe_events(config, sizes['pppoe_sessions'], 1.8e9))
+    _write(os.path.join(root, 'dhcpd.leases'), fixtures.dhcp_leases(config, sizes['dhcp_leases']))
+
+    patches = [
+        (psutil, 'net_if_stats', machine.net_if_stats),
+        (psutil, 'net_if_addrs', machine.net_if_addrs),
+        (psutil, 'net_io_counters', machine.net_io_counters),
+        (psutil, 'virtual_memory', machine.virtual_memory),
+        (psutil, 'cpu_percent', machine.cpu_percent),
+        (subprocess, 'run', machine.run),
+        (subprocess, 'Popen', machine.popen),
+        (stats_service, 'read_counters', machine.read_counters),
+        # No netlink listener: the host's own link events would leak into the inventory
+        (interface_inventory.InterfaceInventory, '_open_netlink', staticmethod(lambda: None)),
+        (config_service, 'CONFIG_BACKEND', 'sqlite'),
+        (config_service, 'CONFIG_FILE', os.path.join(root, 'config', 'settings.json')),
+        (config_service, 'CONFIG_DB', None),
+        (config_service, 'GENERATED_DIR', os.path.join(root, 'generated')),
+        (apply_service, 'INSTALL_ROOT', os.path.join(root, 'install')),
+        # Whatever ran before (a test file patching them, say), apply works on the real subsystems
+        # and runs commands as they are (no sudo: Popen is faked anyway)
+        (apply_service, 'SUBSYSTEMS', list(apply_service.DEFAULT_SUBSYSTEMS)),
+        (apply_service, '_command', list),
+        (job_service, 'JOBS_DIR', os.path.join(root, 'config', 'jobs')),
+        (stats_service, 'STATS_FILE', os.path.join(root, 'config', 'ifstats.bin')),
+        (stats_service, 'LOCK_FILE', os.path.join(root, 'config', 'ifstats.lock')),
+        (tsdb, 'METRICS_DIR', os.path.join(root, 'config', 'metrics')),
+        (wan_health, 'STATE_FILE', os.path.join(root, 'config', 'wan_health.json')),
+        (subscriber_service, 'CHAP_SECRETS', os.path.join(root, 'install', 'etc', 'ppp', 'chap-secrets')),
+        (subscriber_service, 'LOCK_FILE', os.path.join(root, 'config', 'chap-secrets.lock')),
+        (pppoe_sessions, 'EVENTS_FILE', os.path.join(root, 'run', 'pppoe-events.log')),
+        (pppoe_sessions, 'LOCK_FILE', os.path.join(root, 'run', 'pppoe-events.lock')),
+        (lease_service, 'LEASES_FILE', os.path.join(root, 'dhcpd.leases')),
+        (qos_service, 'SESSIONS_FILE', os.path.join(root, 'install', 'etc', 'ubuntu-router', 'qos-sessions')),
+        (conntrack_service, 'PROC_NETFILTER', os.path.join(root, 'proc', 'netfilter')),
+        (conntrack_service, 'PROC_STAT', os.path.join(root, 'proc', 'nf_conntrack_stat')),
+        (conntrack_service, 'PROC_TABLE', os.path.join(root, 'proc', 'nf_conntrack')),
+        (conntrack_service, 'HASHSIZE_PARAM', os.path.join(root, 'proc', 'hashsize')),
+        # A breakdown cached from the fake table must not outlive it (nor one from before be read)
+        (conntrack_service, '_breakdown', {'time': 0.0, 'value': None}),
+        (tuning_service, 'SYS_NET', os.path.join(root, 'sys', 'class', 'net')),
+        (tuning_service, 'PROC_INTERRUPTS', os.path.join(root, 'proc', 'interrupts')),
+        (tuning_service, 'PROC_IRQ', os.path.join(root, 'proc', 'irq')),
+    ]
+    saved = [(target, name, target.__dict__[name] if isinstance(target, type) else getattr(target, name))
+             for target, name, _value in patches]
+    for directory in ('config', 'generated', 'install'):
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    for target, name, value in patches:
+        setattr(target, name, value)
+    try:
+        yield machine
+    finally:
+        for target, name, value in reversed(saved):
+            setattr(target, name, value)
@@ -0,0 +1,164 @@
+import ipaddress
+
+# Size of the synthetic router at scale 1.0. Smaller scales shrink every count
+# (but keep at least one of each) for quick runs.
+INTERFACES = 500
+DHCP_SCOPES = 200
+DHCP_RESERVATIONS = 20000
+PPPOE_SUBSCRIBERS = 5000
+WANS = 8
+PPPOE_SESSIONS = 2000
+DHCP_LEASES = 10000
+CPUS = 16
+
+
+def counts(scale=1.0):
+    """
+    The object counts for a scale factor.
+    """
+    def scaled(value):
+        return max(1, int(value * scale))
+    sizes = {
+        'interfaces': scaled(INTERFACES),
+        'wans': min(WANS, scaled(WANS)),
+        'dhcp_scopes': scaled(DHCP_SCOPES),
+        'dhcp_reservations': scaled(DHCP_RESERVATIONS),
+        'pppoe_subscribers': scaled(PPPOE_SUBSCRIBERS),
+        'pppoe_sessions': scaled(PPPOE_SESSIONS),
+        'dhcp_leases': scaled(DHCP_LEASES)
+    }
+    # WANs, one bridge port and the scope interfaces all count towards the interfaces
+    sizes['interfaces'] = max(sizes['interfaces'], sizes['wans'] + sizes['dhcp_scopes'] + 1)
+    return sizes
+
+
+def interface_names(sizes):
+    """
+    (wans, bridge ports, scope interfaces), all valid kernel interface names.
+    """
+    wans = [f'wan{n}' for n in range(sizes['wans'])]
+    scopes = [f'vlan{100 + n}' for n in range(sizes['dhcp_scopes'])]
+    ports = [f'lan{n}' for n in range(sizes['interfaces'] - len(wans) - len(scopes))]
+    return wans, ports, scopes
+
+
+def scope_network(n):
+    # One /22 per scope from 10.0.0.0/8; the router is .1, reservations below the dynamic range
+    return ipaddress.IPv4Network((0x0a000000 + n * 1024, 22))
+
+
+def build_config(scale=1.0):
+    """
+    A settings dict with every section filled in at the given scale.
+    """
+    sizes = counts(scale)
+    wans, ports, scopes = interface_names(sizes)
+
+    network = {}
+    for n, name in enumerate(wans):
+        network[name] = {'role': 'wan', 'ip': f'100.64.{n}.2/24'}
+    for n, name in enumerate(ports):
+        network[name] = {'role': 'lan', 'ip': '192.168.0.1/16' if n == 0 else ''}
+    dhcp = {'br0': {'enabled': True, 'start': '192.168.100.1', 'end': '192.168.199.254', 'lease': '3600'}}
+    for n, name in enumerate(scopes):
+        subnet = scope_network(n)
+        network[name] = {'role': 'unassigned', 'ip': f'{subnet.network_address + 1}/22'}
+        dhcp[name] = {
+            'enabled': True,
+            'start': str(subnet.network_address + 512),
+            'end': str(subnet.network_address + 1000),
+            'lease': '7200',
+            'dns': '1.1.1.1 8.8.8.8',
+            'domain': f'site{n}.example'
+        }
+
+    reservations = []
+    per_scope = -(-sizes['dhcp_reservations'] // len(scopes)) if scopes else 0
+    for n in range(sizes['dhcp_reservations']):
+        scope, slot = divmod(n, per_scope) if per_scope else (0, n)
+        subnet = scope_network(scope)
+        reservations.append({
+            'mac': f'02:00:{(n >> 24) & 0xff:02x}:{(n >> 16) & 0xff:02x}:{(n >> 8) & 0xff:02x}:{n & 0xff:02x}',
+            'ip': str(subnet.network_address + 2 + slot),
+            'hostname': f'host{n}',
+            'plan': 'gold' if n % 7 == 0 else ''
+        })
+
+    plans = {
+        'basic': {'down_kbit': 10000, 'up_kbit': 2000},
+        'standard': {'down_kbit': 50000, 'up_kbit': 10000},
+        'gold': {'down_kbit': 200000, 'up_kbit': 40000}
+    }
+    plan_names = sorted(plans)
+    subscribers = {
+        f'user{n}': {'password': f'secret{n}', 'ip': '', 'plan': plan_names[n % len(plan_names)]}
+        for n in range(sizes['pppoe_subscribers'])
+    }
+
+    return {
+        'network': network,
+        'dhcp': dhcp,
+        'dhcp_reservations': reservations,
+        'pppoe': {
+            'br0': {
+                'enabled': True,
+                'local_ip': '10.255.0.1',
+                'remote_start': '10.254.0.2',
+                'remote_end': '10.254.127.254',
+                'dns': '1.1.1.1',
+                'kernel_mode': True,
+                'instances': 4,
+                'max_sessions': sizes['pppoe_subscribers'],
+                'cpus': '2-5'
+            }
+        },
+        'pppoe_subscribers': subscribers,
+        'qos': {'enabled': True, 'interfaces': {name: {'rate_kbit': 1000000} for name in wans + ['br0']}},
+        'qos_plans': plans,
+        'loadbalance': {name: {'enabled': True, 'weight': n % 3 + 1, 'slot': n + 1} for n, name in enumerate(wans)},
+        'firewall': {'enabled': True, 'flow_offload': True,
+                     'blocked': [f'198.51.100.{n}' for n in range(1, 200)] + ['203.0.113.0/24']},
+        'tuning': {'enabled': True, 'hardware': hardware(wans + ports[:8])},
+        'conntrack': {'auto_size': True, 'memory_bytes': 32 * 1024 ** 3}
+    }
+
+
+def hardware(nics):
+    """
+    Tuning hardware snapshot: multi-queue NICs on a CPUS-core machine.
+    """
+    return {
+        'cpus': CPUS,
+        'nics': {name: {'irqs': 8, 'rx_queues': 8, 'tx_queues': 8, 'speed': 10000, 'mtu': 1500} for name in nics}
+    }
+
+
+def pppoe_events(config, count, now):
+    """
+    Session log lines (the ip-up hook format) for the first count subscribers.
+    """
+    lines = []
+    for n, username in enumerate(list(config['pppoe_subscribers'])[:count]):
+        remote = ipaddress.IPv4Address('10.254.0.2') + n
+        lines.append(f'up\t{now - n:.0f}\tppp{n}\t{username}\t{remote}\t10.255.0.1\n')
+    return ''.join(lines)
+
+
+def dhcp_leases(config, count):
+    """
+    dhcpd.leases content with count active leases in the dynamic ranges.
+    """
+    scopes = [s for name, s in sorted(config['dhcp'].items()) if name != 'br0'] or list(config['dhcp'].values())
+    blocks = []
+    for n in range(count):
+        scope = scopes[n % len(scopes)]
+        ip = ipaddress.IPv4Address(scope['start']) + n // len(scopes)
+        blocks.append(
+            f'lease {ip} {{\n'
+            f'  starts 4 2026/01/01 00:00:00;\n'
+            f'  ends 4 2036/01/01 00:00:00;\n'
+            f'  binding state active;\n'
+            f'  hardware ethernet 06:00:{(n >> 16) & 0xff:02x}:{(n >> 8) & 0xff:02x}:{n & 0xff:02x}:01;\n'
+            f'  client-hostname "client{n}";\n'
+            f'}}\n')
+    return ''.join(blocks)
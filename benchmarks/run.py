@@ -0,0 +1,274 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from benchmarks import fakes, fixtures
+
+# Scale benchmarks: generators, config load/save, apply planning and every
+# GET route, against a synthetic router (see fixtures) on a fake machine
+# (see fakes). Results are compared with a JSON baseline recorded on the same
+# machine; timings from different hardware are not comparable.
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+REPEAT = 5
+# A benchmark regressed if its median is this much slower than the baseline ...
+TOLERANCE = 0.5
+# ... and slower by at least this many milliseconds (timer noise on fast ones)
+MIN_DELTA_MS = 2.0
+# A cold start (fresh interpreter to first response, see startup_profile) must
+# fit in this, independent of the baseline: it is how long the UI stays
+# unreachable after a restart
+STARTUP_BUDGET_MS = 1250.0
+GROUPS = ('config', 'generate', 'apply', 'route', 'startup')
+
+# Streams never end and the event long-poll waits on purpose; neither has a duration to compare
+EXCLUDED_ROUTES = ('/api/interfaces/stats/stream', '/api/interfaces/<name>/stats/stream',
+                   '/api/apply/<job_id>/stream', '/api/interfaces/events')
+# Values for route arguments; routes with other arguments are skipped
+ROUTE_ARGS = {
+    'name': 'wan0',
+    'series': 'system.cpu_percent',
+    'revision': 1,
+    'username': 'user1',
+    'mac': '02:00:00:00:00:01',
+    'key': '06:00:00:00:00:01',
+    'address': '198.51.100.1',
+}
+
+
+def measure(func, repeat):
+    """
+    Runs func once to warm up, then repeat times. Returns {'median_ms', 'min_ms', 'runs'}.
+    """
+    func()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - started) * 1000)
+    return {'median_ms': round(statistics.median(times), 3), 'min_ms': round(min(times), 3), 'runs': repeat}
+
+
+def bench_generators(config, repeat):
+    from app.services import config_service
+    results = {}
+    for gen in config_service.GENERATORS:
+        func = gen['func']
+        results[f'generate.{func.__name__}'] = measure(lambda: func(config), repeat)
+    results['generate.regenerate_all'] = measure(lambda: config_service.regenerate(config, force=True), repeat)
+    return results
+
+
+def bench_config(config, repeat):
+    from app.services import config_service
+    results = {}
+    # The first save writes every section and item and runs every generator; it only happens once
+    started = time.perf_counter()
+    config_service.save_config(copy.deepcopy(config))
+    elapsed = round((time.perf_counter() - started) * 1000, 3)
+    results['config.save_config.initial'] = {'median_ms': elapsed, 'min_ms': elapsed, 'runs': 1}
+
+    results['config.load_config'] = measure(config_service.load_config, repeat)
+
+    def load_cold():
+        config_service._config_cache.invalidate()
+        config_service.load_config()
+    results['config.load_config.cold'] = measure(load_cold, repeat)
+
+    plans = sorted(config['qos_plans'])
+    counter = [0]
+
+    def save_one_subscriber():
+        # Edit one subscriber the way the subscriber page does
+        counter[0] += 1
+        edited = config_service.load_config(mutable=True)
+        edited['pppoe_subscribers']['user1']['plan'] = plans[counter[0] % len(plans)]
+        config_service.save_config(edited)
+    results['config.save_config.one_subscriber'] = measure(save_one_subscriber, repeat)
+
+    def save_network():
+        counter[0] += 1
+        network = copy.deepcopy(config['network'])
+        network['wan0']['ip'] = f'100.64.0.{counter[0] % 200 + 2}/24'
+        config_service.save_config_section('network', network)
+    results['config.save_config_section.network'] = measure(save_network, repeat)
+    return results
+
+
+def bench_apply(repeat):
+    from app.services import apply_service
+    results = {}
+    # Nothing installed yet: every artifact differs
+    results['apply.plan_changes'] = measure(apply_service.plan_changes, repeat)
+    results['apply.apply_changes.force'] = measure(lambda: apply_service.apply_changes(force=True), repeat)
+    # Everything installed: the common case of an apply with few changes
+    results['apply.plan_changes.installed'] = measure(apply_service.plan_changes, repeat)
+    return results
+
+
+def route_urls(app):
+    """
+    [(benchmark name, url)] for every GET route that can be called with ROUTE_ARGS.
+    """
+    urls = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+        if 'GET' not in rule.methods or rule.endpoint == 'static' or rule.rule in EXCLUDED_ROUTES:
+            continue
+        if any(arg not in ROUTE_ARGS for arg in rule.arguments):
+            continue
+        with app.test_request_context():
+            from flask import url_for
+            url = url_for(rule.endpoint, **{arg: ROUTE_ARGS[arg] for arg in rule.arguments})
+        urls.append((f'route.GET {rule.rule}', url))
+    return urls
+
+
+def bench_routes(app, repeat):
+    client = app.test_client()
+    results = {}
+    for name, url in route_urls(app):
+        status = []
+
+        def get():
+            status.append(client.get(url).status_code)
+        results[name] = measure(get, repeat)
+        results[name]['status'] = status[-1]
+    return results
+
+
+def bench_startup(root, repeat):
+    """
+    Cold starts in fresh interpreters, with root (holding the saved synthetic
+    config) as working directory. The machine is the real one: the fakes only
+    exist in this process.
+    """
+    from app.services import startup_profile
+    startup_profile.profile(cwd=root)
+    runs = [startup_profile.profile(cwd=root) for _ in range(repeat)]
+    results = {}
+    for name in startup_profile.PHASES:
+        times = [r['phases'][name] for r in runs]
+        results[f'startup.{name}'] = {'median_ms': round(statistics.median(times), 3), 'min_ms': round(min(times), 3), 'runs': repeat}
+    totals = [r['total_ms'] for r in runs]
+    results['startup.total'] = {'median_ms': round(statistics.median(totals), 3), 'min_ms': round(min(totals), 3),
+                                'runs': repeat, 'status': runs[-1]['status']}
+    return results
+
+
+def run(scale=1.0, repeat=REPEAT, only=None):
+    """
+    Runs the suite in a temp directory and returns the results document.
+    only limits it to benchmark groups (see GROUPS).
+    """
+    config = fixtures.build_config(scale)
+    sizes = fixtures.counts(scale)
+    groups = only or GROUPS
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='ubr-bench-') as root:
+        with fakes.installed(root, config, sizes) as machine:
+            from app.services import config_service
+            if 'config' in groups:
+                results.update(bench_config(config, repeat))
+            else:
+                config_service.save_config(copy.deepcopy(config))
+            if 'generate' in groups:
+                results.update(bench_generators(config_service.load_config(), repeat))
+            if 'apply' in groups:
+                results.update(bench_apply(repeat))
+            if 'route' in groups:
+                from app import create_app
+                results.update(bench_routes(create_app(), repeat))
+            commands = len(machine.commands)
+        if 'startup' in groups:
+            results.update(bench_startup(root, repeat))
+    return {
+        'scale': scale,
+        'sizes': sizes,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.time(),
+        'commands_faked': commands,
+        'results': results
+    }
+
+
+def compare(current, baseline, tolerance=TOLERANCE, min_delta_ms=MIN_DELTA_MS):
+    """
+    [{'name', 'baseline_ms', 'current_ms', 'ratio'}] for every benchmark that got
+    slower than the baseline allows. Benchmarks missing on either side are ignored.
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        before, now = base['median_ms'], result['median_ms']
+        if now > before * (1 + tolerance) and now - before >= min_delta_ms:
+            regressions.append({'name': name, 'baseline_ms': before, 'current_ms': now,
+                                'ratio': round(now / before, 2) if before else None})
+    return regressions
+
+
+def load_baseline(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scale benchmarks for Ubuntu Router UI')
+    parser.add_argument('--scale', type=float, default=1.0, help='size of the synthetic config (1.0 = 500 interfaces, 20k reservations, 5k subscribers)')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='timed runs per benchmark')
+    parser.add_argument('--only', action='append', choices=GROUPS, help='run only these groups')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline JSON to compare with')
+    parser.add_argument('--output', help='also write the results JSON here')
+    parser.add_argument('--update', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed slowdown (0.5 = 50%%)')
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET_MS, help='maximum cold start time in ms')
+    args = parser.parse_args(argv)
+
+    current = run(args.scale, args.repeat, args.only)
+    baseline = load_baseline(args.baseline)
+
+    print(f"{'benchmark':60} {'median ms':>10} {'baseline':>10}")
+    for name, result in sorted(current['results'].items()):
+        base = (baseline or {}).get('results', {}).get(name, {}).get('median_ms')
+        print(f"{name:60} {result['median_ms']:10.2f} {base if base is not None else '-':>10}")
+        if result.get('status', 200) >= 500:
+            print(f'  {name} returned HTTP {result["status"]}', file=sys.stderr)
+
+    startup = current['results'].get('startup.total')
+    over_budget = startup is not None and startup['median_ms'] > args.startup_budget
+    if over_budget:
+        print(f"OVER BUDGET startup.total: {startup['median_ms']:.2f} ms > {args.startup_budget:.2f} ms "
+              f"(python run.py --profile-startup shows where the time goes)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print(f'Baseline written to {args.baseline}')
+        return 1 if over_budget else 0
+
+    if baseline is None:
+        print('No baseline to compare with; run with --update to record one.')
+        return 1 if over_budget else 0
+    if baseline.get('scale') != current['scale']:
+        print(f"Baseline was recorded at scale {baseline.get('scale')}, not {current['scale']}; not comparing.")
+        return 1 if over_budget else 0
+    regressions = compare(current, baseline, args.tolerance)
+    for r in regressions:
+        print(f"REGRESSION {r['name']}: {r['baseline_ms']:.2f} ms -> {r['current_ms']:.2f} ms (x{r['ratio']})")
+    return 1 if regressions or over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,33 @@
 import multiprocessing
+import os
+import shutil
 
 bind = "0.0.0.0:80"
-workers = multiprocessing.cpu_count() * 2 + 1
+# 'sync' (default) or 'gevent' (pip install gevent): with gevent one worker
+# serves many clients at once, so SSE streams and long polls don't tie up a
+# whole worker each, and fewer workers are needed.
+worker_class = os.environ.get('UBUNTU_ROUTER_WORKER_CLASS', 'sync')
+if worker_class == 'gevent':
+    workers = min(multiprocessing.cpu_count(), 2)
+    worker_connections = 1000
+else:
+    workers = multiprocessing.cpu_count() * 2 + 1
+workers = int(os.environ.get('UBUNTU_ROUTER_WORKERS', workers))
 accesslog = "-"
 errorlog = "-"
 loglevel = "info"
+
+# Shared directory for Prometheus metrics, so /metrics aggregates all workers.
+# Must be set before the app (and prometheus_client) is imported by a worker.
+prometheus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'prometheus')
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', prometheus_dir)
+
+def on_starting(server):
+    # Counters from a previous run must not be added to the new ones
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    from app.services import metrics_service
+    metrics_service.mark_process_dead(worker.pid)
@@ -1,3 +1,15 @@
+import sys
+
+if __name__ == '__main__' and '--profile-startup' in sys.argv:
+    # python run.py --profile-startup [url]: where a cold start spends its time
+    # (imports by module, create_app(), first request). Runs before anything
+    # else is imported here, so the measurement starts from a bare interpreter.
+    from app.services import startup_profile
+    args = sys.argv[sys.argv.index('--profile-startup') + 1:]
+    url = args[0] if args else '/'
+    print('\n'.join(startup_profile.report(startup_profile.profile(url), url)))
+    sys.exit(0)
+
 from app import create_app
 
 app = create_app()
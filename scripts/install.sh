@@ -12,7 +12,7 @@ sudo apt-get update
 # Added build-essential and python3-dev for compiling python extensions (psutil)
 # Added python3-full for venv support
 # Added hostapd for WiFi Hotspot support
-sudo apt-get install -y python3-full python3-dev build-essential netplan.io isc-dhcp-server pppoe iproute2 hostapd wireless-tools iw
+sudo apt-get install -y python3-full python3-dev build-essential netplan.io isc-dhcp-server pppoe iproute2 nftables ethtool hostapd wireless-tools iw
 
 # Create application directory structure if not exists (assuming running from repo root)
 echo "[2/5] Setting up application environment..."
@@ -47,7 +47,7 @@ After=network.target
 User=root
 WorkingDirectory=$CURRENT_DIR
 # Use the gunicorn from the virtual environment
-ExecStart=$CURRENT_DIR/venv/bin/gunicorn --workers 3 --bind 0.0.0.0:80 run:app
+ExecStart=$CURRENT_DIR/venv/bin/gunicorn -c gunicorn_config.py run:app
 Restart=always
 Environment="PATH=$CURRENT_DIR/venv/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
 
@@ -55,11 +55,45 @@ Environment="PATH=$CURRENT_DIR/venv/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin
 WantedBy=multi-user.target
 EOF
 
+# WAN health daemon: drops dead WANs from the load-balanced default route
+cat <<EOF | sudo tee /etc/systemd/system/ubuntu-router-wanhealth.service
+[Unit]
+Description=Ubuntu Router WAN Health Prober
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+User=root
+WorkingDirectory=$CURRENT_DIR
+ExecStart=$CURRENT_DIR/venv/bin/python3 -m app.services.wan_health
+Restart=always
+Environment="PATH=$CURRENT_DIR/venv/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+# NIC tuning (IRQ affinity, RPS/XPS, rings) is lost on reboot; re-apply the generated script at boot
+cat <<EOF | sudo tee /etc/systemd/system/ubuntu-router-tuning.service
+[Unit]
+Description=Ubuntu Router NIC Tuning
+After=network.target
+ConditionPathExists=/etc/ubuntu-router/setup_tuning.sh
+
+[Service]
+Type=oneshot
+ExecStart=/bin/bash /etc/ubuntu-router/setup_tuning.sh
+RemainAfterExit=yes
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
 # Reload systemd and start service
 echo "[5/5] Starting service..."
 sudo systemctl daemon-reload
-sudo systemctl enable ubuntu-router
-sudo systemctl restart ubuntu-router
+sudo systemctl enable ubuntu-router ubuntu-router-wanhealth ubuntu-router-tuning
+sudo systemctl restart ubuntu-router ubuntu-router-wanhealth
 
 # Make scripts executable
 chmod +x scripts/*.sh
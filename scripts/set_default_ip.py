@@ -69,8 +69,8 @@ def set_default_ip():
         print(f"Error detecting interfaces: {e}")
         return
 
-    # Load existing config
-    config = load_config()
+    # Load existing config (editable copy)
+    config = load_config(mutable=True)
     if 'network' not in config:
         config['network'] = {}
     if 'dhcp' not in config:
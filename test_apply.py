@@ -0,0 +1,79 @@
+import os
+import tempfile
+import time
+from app.services import apply_service, config_service
+
+# Module globals patched below; put back at the end, other test files run in the same process under pytest
+saved = [(config_service, 'CONFIG_FILE'), (config_service, 'GENERATED_DIR'), (apply_service, 'INSTALL_ROOT'),
+         (apply_service, '_command'), (apply_service, 'SUBSYSTEMS'), (apply_service, 'COMMAND_TIMEOUT')]
+saved = [(module, name, getattr(module, name)) for module, name in saved]
+
+tmp_dir = tempfile.mkdtemp()
+config_service.CONFIG_FILE = os.path.join(tmp_dir, 'settings.json')
+config_service.GENERATED_DIR = os.path.join(tmp_dir, 'generated')
+apply_service.INSTALL_ROOT = os.path.join(tmp_dir, 'root')
+os.makedirs(config_service.GENERATED_DIR)
+# One subsystem whose activation runs the installed script, as the current user
+apply_service._command = lambda cmd: cmd
+apply_service.SUBSYSTEMS = [{
+    'name': 'demo',
+    'files': [('demo.sh', '/etc/ubuntu-router/demo.sh', 0o755)],
+    'actions': lambda changed, dependency_applied: [['sh', apply_service.installed_path('/etc/ubuntu-router/demo.sh')]],
+    'after': [],
+}]
+
+
+def generate(script):
+    with open(os.path.join(config_service.GENERATED_DIR, 'demo.sh'), 'w') as f:
+        f.write(script)
+
+
+def apply():
+    report = apply_service.apply_changes()
+    print(apply_service.summarize(report))
+    return report[0]
+
+
+generate('echo first\n')
+entry = apply()
+assert entry['status'] == 'applied' and entry['actions'][0]['stdout'] == 'first\n'
+assert os.path.exists(apply_service.installed_path('/etc/ubuntu-router/demo.sh'))
+
+# Installed file unchanged: no action at all
+assert apply_service.plan_changes() == {'demo': []}
+entry = apply()
+assert entry['status'] == 'unchanged' and entry['actions'] == []
+
+# A failed activation is retried by the next apply, although the file is installed
+generate('exit 3\n')
+entry = apply()
+assert entry['status'] == 'failed' and entry['actions'][0]['returncode'] == 3
+assert apply_service.plan_changes() == {'demo': ['demo.sh']}
+entry = apply()
+assert entry['status'] == 'failed' and len(entry['actions']) == 1
+generate('echo fixed\n')
+entry = apply()
+assert entry['status'] == 'applied'
+assert apply_service.plan_changes() == {'demo': []}
+
+# A command that hangs is killed after COMMAND_TIMEOUT
+apply_service.COMMAND_TIMEOUT = 0.5
+generate('echo started\nsleep 10\n')
+started = time.monotonic()
+entry = apply()
+assert time.monotonic() - started < 5
+assert entry['status'] == 'failed' and 'Timed out' in entry['actions'][0]['stderr']
+assert apply_service.plan_changes() == {'demo': ['demo.sh']}
+
+# What the generators skipped is repeated in every apply log
+apply_service.COMMAND_TIMEOUT = 300
+config_service.regenerate({'firewall': {'enabled': True, 'blocked': ['nonsense']},
+                           'network': {'eth0': {'role': 'wan'}}})
+lines = []
+apply_service.apply_changes(log=lambda stream, line: lines.append((stream, line)))
+print(lines[0])
+assert lines[0] == ('stderr', '[generate] Firewall: skipped blocked host nonsense')
+
+for module, name, value in saved:
+    setattr(module, name, value)
+print('Apply tests passed')
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import tempfile
+from benchmarks import fixtures, run
+
+# The suite itself at a tiny scale: every benchmark runs, no route fails and
+# nothing leaves the temp directory
+result = run.run(scale=0.01, repeat=1)
+names = set(result['results'])
+print(f"--- {len(names)} benchmarks, {result['commands_faked']} commands faked ---")
+assert 'generate.generate_dhcp_config' in names and 'generate.regenerate_all' in names
+assert 'config.save_config.one_subscriber' in names and 'apply.plan_changes' in names
+assert 'route.GET /' in names and 'route.GET /api/pppoe/subscribers/<username>' in names
+assert not any(name.endswith('/stream') for name in names)
+assert {'startup.import', 'startup.create_app', 'startup.first_request', 'startup.total'} <= names
+failed = {name: r['status'] for name, r in result['results'].items() if r.get('status', 200) >= 400}
+assert not failed, failed
+assert result['commands_faked'] > 0
+# The real psutil and subprocess are back
+assert subprocess.run(['true']).returncode == 0
+
+# Fixture sizes at full scale
+sizes = fixtures.counts(1.0)
+config = fixtures.build_config(0.1)
+assert sizes['interfaces'] == 500 and sizes['dhcp_reservations'] == 20000 and sizes['wans'] == 8
+assert len(config['network']) == fixtures.counts(0.1)['interfaces']
+assert len({r['ip'] for r in config['dhcp_reservations']}) == len(config['dhcp_reservations'])
+
+# Regressions need both the relative and the absolute slowdown
+baseline = {'scale': 1.0, 'results': {'a': {'median_ms': 10.0}, 'b': {'median_ms': 0.5}, 'c': {'median_ms': 100.0}}}
+current = {'scale': 1.0, 'results': {'a': {'median_ms': 20.0}, 'b': {'median_ms': 1.5}, 'c': {'median_ms': 120.0}, 'd': {'median_ms': 5.0}}}
+assert [r['name'] for r in run.compare(current, baseline)] == ['a']
+
+# Baseline round trip through the command line
+tmp_dir = tempfile.mkdtemp()
+path = os.path.join(tmp_dir, 'baseline.json')
+assert run.main(['--scale', '0.01', '--repeat', '1', '--only', 'generate', '--baseline', path, '--update']) == 0
+assert run.load_baseline(path)['scale'] == 0.01
+assert run.main(['--scale', '0.01', '--repeat', '1', '--only', 'generate', '--baseline', path, '--tolerance', '100']) == 0
+# A cold start over budget fails the run even without a regression
+assert run.main(['--scale', '0.01', '--repeat', '1', '--only', 'startup', '--baseline', path, '--startup-budget', '1']) == 1
+
+print('Benchmark suite tests passed')
@@ -0,0 +1,70 @@
+import os
+import tempfile
+from app.services import apply_service, config_service
+
+# Point the service at a scratch settings file (and install root)
+tmp_dir = tempfile.mkdtemp()
+apply_service.INSTALL_ROOT = tmp_dir
+backend = config_service.CONFIG_BACKEND
+config_service.CONFIG_BACKEND = 'json'
+config_service.CONFIG_FILE = os.path.join(tmp_dir, 'settings.json')
+config_service.GENERATED_DIR = tmp_dir
+
+config = {
+    'network': {
+        'eth0': {'role': 'wan', 'ip': ''},
+        'eth1': {'role': 'lan', 'ip': '192.168.172.1'}
+    }
+}
+config_service.save_config(config)
+
+# Repeated loads are served from the cache
+first = config_service.load_config()
+second = config_service.load_config()
+assert first is second
+print("--- Cache stats after two loads ---")
+print(config_service.config_cache_stats())
+
+# Cached view is read-only
+try:
+    first['network']['eth0']['role'] = 'lan'
+    raise AssertionError("cached config should be read-only")
+except TypeError as e:
+    print(f"Read-only view: {e}")
+
+# Editable copy does not touch the cache
+editable = config_service.load_config(mutable=True)
+editable['network']['eth0']['role'] = 'lan'
+assert config_service.load_config()['network']['eth0']['role'] == 'wan'
+
+# A write from "another worker" is picked up on the next load
+with open(config_service.CONFIG_FILE, 'w') as f:
+    f.write('{"network": {}}')
+assert config_service.load_config() == {'network': {}}
+print("--- Cache stats after external write ---")
+print(config_service.config_cache_stats())
+
+# Another worker saving between our write and priming the cache: the primed
+# entry must carry the key of our write, so the next load sees theirs
+from app.services import config_store
+from app.services.config_cache import ConfigCache
+
+for name, mine in (('json', config_store.JsonStore(os.path.join(tmp_dir, 'race.json'))),
+                   ('sqlite', config_store.SqliteStore(os.path.join(tmp_dir, 'race.db')))):
+    theirs = type(mine)(mine.path)
+    cache = ConfigCache()
+    revision = mine.update({'network': {'eth0': {'role': 'wan'}}})
+    theirs.update({'network': {'eth0': {'role': 'lan'}}})
+    cache.store(mine, {'network': {'eth0': {'role': 'wan'}}}, revision)
+    value, current = cache.get(mine)
+    print(f"--- {name}: primed revision {revision}, loaded revision {current} ---")
+    assert value['network']['eth0']['role'] == 'lan', value
+    assert current == revision + 1
+    # Without an interleaved save the primed config is served without a reload
+    revision = mine.update({'network': {}})
+    cache.store(mine, {'network': {}}, revision)
+    misses = cache.misses
+    assert cache.get(mine) == ({'network': {}}, revision) and cache.misses == misses
+
+# Other test files may run in this process after this one (pytest)
+config_service.CONFIG_BACKEND = backend
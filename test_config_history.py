@@ -0,0 +1,227 @@
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from app.services import apply_service, config_service, job_service, subscriber_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.CONFIG_FILE = os.path.join(tmp_dir, 'settings.json')
+config_service.GENERATED_DIR = tmp_dir
+apply_service.INSTALL_ROOT = tmp_dir
+subscriber_service.LOCK_FILE = os.path.join(tmp_dir, 'chap-secrets.lock')
+job_service.JOBS_DIR = os.path.join(tmp_dir, 'jobs')
+job_service.CONFIRM_POLL = 0.05
+
+
+# An optional feature: its generator only writes a file while its section is set
+@config_service.generator(sections=['extra'], outputs=['extra.conf'])
+def generate_extra(config):
+    if not config.get('extra'):
+        return []
+    with open(os.path.join(config_service.GENERATED_DIR, 'extra.conf'), 'w') as f:
+        f.write('on\n')
+    return ['extra.conf']
+
+
+# Revision 1 is the empty import; each save adds one delta
+config_service.save_config_section('network', {'eth1': {'role': 'lan', 'ip': '192.168.1.1', 'netmask': '255.255.255.0'}})
+config_service.save_config_section('pppoe_subscribers', {f'user{n}': {'password': 'x', 'ip': '', 'plan': ''} for n in range(200)})
+subscribers = config_service.load_config(mutable=True)
+subscribers['pppoe_subscribers']['user3']['plan'] = 'gold'
+config_service.save_config(subscribers)
+rev_gold = config_service.config_revision()
+
+revisions = config_service.list_revisions()
+assert [r['revision'] for r in revisions][:3] == [rev_gold, rev_gold - 1, rev_gold - 2]
+# A one-field edit is stored as one small patch, not the whole collection
+assert revisions[0]['sections'] == ['pppoe_subscribers'] and revisions[0]['changes'] == 1
+
+# Old revisions are rebuilt from snapshot + deltas
+assert 'pppoe_subscribers' not in config_service.config_at(rev_gold - 2)
+assert config_service.config_at(rev_gold - 1)['pppoe_subscribers']['user3']['plan'] == ''
+assert config_service.config_at(rev_gold)['pppoe_subscribers']['user3']['plan'] == 'gold'
+try:
+    config_service.config_at(9999)
+    assert False, 'unknown revision'
+except KeyError:
+    pass
+
+# Past the snapshot interval the history still replays correctly
+store = config_service.get_store()
+for n in range(store.SNAPSHOT_EVERY + 5):
+    config_service.save_config_section('dns', {'servers': [f'10.0.0.{n}']})
+assert any(r['snapshot'] for r in config_service.list_revisions(limit=store.SNAPSHOT_EVERY + 10))
+assert config_service.config_at(config_service.config_revision() - 3)['dns'] == {'servers': [f'10.0.0.{store.SNAPSHOT_EVERY + 1}']}
+
+patch = config_service.diff_revisions(rev_gold - 1, rev_gold)
+assert patch == [{'op': 'add', 'path': '/pppoe_subscribers/user3/plan', 'value': 'gold'}], patch
+
+# 1 == True == 1.0 in Python, but they are different values in the stored JSON,
+# at any depth
+config_service.save_config_section('options', {'x': {'enabled': 1, 'ratio': 1, 'list': [0]}})
+first = config_service.config_revision()
+config_service.save_config_section('options', {'x': {'enabled': True, 'ratio': 1.0, 'list': [False]}})
+second = config_service.config_revision()
+assert config_service.config_at(second)['options'] == config_service.load_config()['options']
+options = config_service.config_at(second)['options']['x']
+assert options['enabled'] is True and type(options['ratio']) is float and options['list'][0] is False, options
+assert len(config_service.diff_revisions(first, second)) == 3
+
+# Rollback restores both the config and the generated files of that revision
+netplan = os.path.join(tmp_dir, '01-netcfg.yaml')
+with open(netplan) as f:
+    before = f.read()
+config_service.save_config_section('network', {'eth1': {'role': 'lan', 'ip': '10.9.0.1', 'netmask': '255.255.255.0'}})
+with open(netplan) as f:
+    assert f.read() != before
+target = config_service.config_revision() - 1
+new_revision, changed = config_service.rollback_config(target)
+assert new_revision == target + 2
+assert config_service.load_config()['network']['eth1']['ip'] == '192.168.1.1'
+assert '01-netcfg.yaml' in changed
+with open(netplan) as f:
+    assert f.read() == before
+
+# chap-secrets is not a generated file, but a rollback brings its accounts back too
+chap = subscriber_service._chap()
+target = config_service.config_revision()
+assert chap.lookup_line('user5') == '"user5" * "x" * # ubuntu-router\n'
+subscribers = config_service.load_config(mutable=True)
+subscribers['pppoe_subscribers']['added'] = {'password': 'new', 'ip': '', 'plan': ''}
+del subscribers['pppoe_subscribers']['user5']
+config_service.save_config(subscribers)
+assert chap.lookup_line('added') and chap.lookup_line('user5') is None
+config_service.rollback_config(target)
+assert chap.lookup_line('added') is None
+assert chap.lookup_line('user5') == '"user5" * "x" * # ubuntu-router\n'
+with open(chap.path) as f:
+    assert sum(1 for _ in f) == 200
+
+# Artifacts the target revision did not have are removed, bookkeeping files are not
+config_service.save_config_section('network', {'eth1': {'role': 'lan', 'ip': '10.9.0.1', 'netmask': '255.255.255.0'}})
+config_service.save_config_section('extra', {'enabled': True})
+assert os.path.exists(os.path.join(tmp_dir, 'extra.conf'))
+with open(os.path.join(tmp_dir, '.apply-pending.json'), 'w') as f:
+    f.write('{}')
+with open(os.path.join(tmp_dir, '.warnings.json'), 'w') as f:
+    f.write('{"generate_netplan_config": ["stale warning"]}')
+# It waits for a regeneration in progress (another worker holding the lock)
+# before touching any file
+held = threading.Event()
+seen = []
+
+
+def regenerating():
+    with config_service._generation_lock():
+        held.set()
+        time.sleep(0.5)
+        with open(netplan) as f:
+            seen.append(f.read())
+
+
+holder = threading.Thread(target=regenerating)
+holder.start()
+held.wait()
+started = time.monotonic()
+_revision, changed = config_service.rollback_config(target)
+assert time.monotonic() - started >= 0.4
+holder.join()
+assert seen[0] != before
+print('--- Rollback removed ---', changed)
+assert 'extra.conf' in changed and not os.path.exists(os.path.join(tmp_dir, 'extra.conf'))
+assert 'extra' not in config_service.load_config()
+for name in ('.apply-pending.json', '.inputs.json', 'settings.db', '01-netcfg.yaml'):
+    assert os.path.exists(os.path.join(tmp_dir, name)), name
+assert config_service.generator_warnings() == []
+os.unlink(os.path.join(tmp_dir, '.apply-pending.json'))
+
+
+def wait(job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = job_service.get_job(job_id)
+        if job_service.is_finished(job):
+            return job
+        time.sleep(0.05)
+    raise AssertionError('job did not finish')
+
+
+applied = []
+real_apply = apply_service.apply_changes, apply_service.summarize
+apply_service.apply_changes = lambda force=False, log=None: applied.append(config_service.config_revision()) or []
+apply_service.summarize = lambda report: 'ok'
+
+# The first apply has nothing to fall back to, so it cannot be made conditional
+try:
+    job_service.submit_apply(confirm_timeout=5)
+    raise AssertionError('an unprotected apply was accepted')
+except ValueError as e:
+    print(f'Refused: {e}')
+good = config_service.config_revision()
+assert wait(job_service.submit_apply())['state'] == 'succeeded'
+
+# Not confirmed: the last applied revision comes back and is applied again
+config_service.save_config_section('network', {'eth1': {'role': 'lan', 'ip': '10.66.0.1', 'netmask': '255.255.255.0'}})
+job = wait(job_service.submit_apply(confirm_timeout=0.3))
+assert job['state'] == 'rolled_back', job
+assert config_service.load_config()['network']['eth1']['ip'] == '192.168.1.1'
+assert config_service.config_at(job['rollback']['revision']) == config_service.config_at(good)
+assert len(applied) == 3
+
+# Confirmed in time: it stays
+config_service.save_config_section('network', {'eth1': {'role': 'lan', 'ip': '10.77.0.1', 'netmask': '255.255.255.0'}})
+job_id = job_service.submit_apply(confirm_timeout=5)
+deadline = time.time() + 5
+while job_service.get_job(job_id)['state'] != 'awaiting_confirmation' and time.time() < deadline:
+    time.sleep(0.05)
+assert job_service.confirm_apply(job_id) is not None
+job = wait(job_id)
+assert job['state'] == 'succeeded' and job['confirmed']
+assert config_service.load_config()['network']['eth1']['ip'] == '10.77.0.1'
+assert job_service.confirm_apply(job_id) is None
+
+# The process waiting for a confirmation dies: the next process resumes the
+# wait from the recorded deadline and, past it, rolls back
+dead = subprocess.Popen(['true'])
+dead.wait()
+kept = config_service.config_revision()
+config_service.save_config_section('network', {'eth1': {'role': 'lan', 'ip': '10.88.0.1', 'netmask': '255.255.255.0'}})
+orphan = {'id': 'abcdef000001', 'state': 'awaiting_confirmation', 'force': False, 'merged': 0,
+          'created': time.time(), 'started': time.time(), 'finished': None, 'report': [], 'summary': 'ok',
+          'confirm_timeout': 5, 'confirm_deadline': time.time() - 1, 'pid': dead.pid,
+          'revision': config_service.config_revision(), 'rollback_revision': kept}
+with open(os.path.join(job_service.JOBS_DIR, 'abcdef000001.json'), 'w') as f:
+    json.dump(orphan, f)
+assert job_service.get_job('abcdef000001')['orphaned']
+job_service.resume_orphans()
+job = wait('abcdef000001')
+print('--- Orphaned wait ---', job['state'], job['rollback']['revision'])
+assert job['state'] == 'rolled_back' and job['resumed'] == 1
+assert config_service.load_config()['network']['eth1']['ip'] == '10.77.0.1'
+assert job_service._read_applied() == job['rollback']['revision']
+
+# A confirmation that came in before the deadline still counts after the takeover
+orphan.update(id='abcdef000002', confirm_deadline=time.time() + 0.3, confirmed=time.time())
+with open(os.path.join(job_service.JOBS_DIR, 'abcdef000002.json'), 'w') as f:
+    json.dump(orphan, f)
+job_service.resume_orphans()
+assert wait('abcdef000002')['state'] == 'succeeded'
+
+# Died during the rollback, after restoring: only the apply is repeated
+revision = config_service.config_revision()
+count = len(applied)
+orphan = dict(orphan, id='abcdef000003', state='rolling_back', rollback={'revision': revision})
+del orphan['confirmed']
+with open(os.path.join(job_service.JOBS_DIR, 'abcdef000003.json'), 'w') as f:
+    json.dump(orphan, f)
+job_service.resume_orphans()
+job = wait('abcdef000003')
+assert job['state'] == 'rolled_back' and job['rollback']['summary'] == 'ok'
+assert config_service.config_revision() == revision and len(applied) == count + 1
+
+# Other test files may run in this process after this one (pytest)
+apply_service.apply_changes, apply_service.summarize = real_apply
+config_service.GENERATORS[:] = [gen for gen in config_service.GENERATORS if gen['func'] is not generate_extra]
+print('Config history tests passed')
@@ -0,0 +1,94 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from app.services import apply_service, config_service, subscriber_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.CONFIG_FILE = os.path.join(tmp_dir, 'settings.json')
+config_service.GENERATED_DIR = tmp_dir
+# Saves keep chap-secrets in line with the subscribers
+apply_service.INSTALL_ROOT = tmp_dir
+subscriber_service.LOCK_FILE = os.path.join(tmp_dir, 'chap-secrets.lock')
+
+# An existing settings.json is imported on first start
+with open(config_service.CONFIG_FILE, 'w') as f:
+    json.dump({
+        'network': {'eth0': {'role': 'wan', 'ip': ''}},
+        'pppoe_subscribers': {f'user{n}': {'password': 'x', 'ip': '', 'plan': ''} for n in range(5000)},
+        'dhcp_reservations': [{'mac': '00:11:22:33:44:55', 'ip': '192.168.172.20', 'hostname': 'nas'}]
+    }, f)
+config = config_service.load_config()
+assert config_service.config_revision() == 1
+assert len(config['pppoe_subscribers']) == 5000 and config['network']['eth0']['role'] == 'wan'
+db = os.path.join(tmp_dir, 'settings.db')
+assert os.path.exists(db)
+
+# Two pages edited at the same time: both saves survive
+page_a = config_service.load_config(mutable=True)
+page_b = config_service.load_config(mutable=True)
+page_a['network']['eth0']['ip'] = '203.0.113.2'
+page_b['firewall'] = {'enabled': False}
+page_b['pppoe_subscribers']['user7']['plan'] = 'gold'
+config_service.save_config(page_a)
+config_service.save_config(page_b)
+config = config_service.load_config()
+assert config['network']['eth0']['ip'] == '203.0.113.2' and config['firewall'] == {'enabled': False}
+assert config['pppoe_subscribers']['user7']['plan'] == 'gold'
+assert config_service.config_revision() == 3
+
+# A one-item edit writes one row, not the whole collection
+conn = sqlite3.connect(db)
+assert conn.execute('SELECT COUNT(*) FROM items WHERE revision = 3').fetchone()[0] == 1
+started = time.perf_counter()
+edit = config_service.load_config(mutable=True)
+del edit['pppoe_subscribers']['user1']
+edit['dhcp_reservations'].insert(0, {'mac': '00:11:22:33:44:00', 'ip': '192.168.172.10', 'hostname': 'ap'})
+config_service.save_config(edit)
+print(f"--- One-item save of a 5000 item config: {(time.perf_counter() - started) * 1000:.1f} ms ---")
+config = config_service.load_config()
+assert 'user1' not in config['pppoe_subscribers']
+assert [r['hostname'] for r in config['dhcp_reservations']] == ['ap', 'nas']
+
+config_service.save_config_section('loadbalance', {'eth0': {'weight': 2}})
+assert config_service.load_config()['loadbalance'] == {'eth0': {'weight': 2}}
+assert config_service.config_revision() == 5
+
+# Several processes saving different subscribers at once lose nothing
+worker = f'''
+import sys
+from app.services import apply_service, config_service, subscriber_service
+config_service.CONFIG_FILE = {config_service.CONFIG_FILE!r}
+config_service.GENERATED_DIR = {tmp_dir!r}
+apply_service.INSTALL_ROOT = {tmp_dir!r}
+subscriber_service.LOCK_FILE = {subscriber_service.LOCK_FILE!r}
+for n in range(20):
+    config = config_service.load_config(mutable=True)
+    config['pppoe_subscribers'][f'w{{sys.argv[1]}}-{{n}}'] = {{'password': 'x', 'ip': '', 'plan': ''}}
+    config_service.save_config(config)
+'''
+procs = [subprocess.Popen([sys.executable, '-c', worker, str(w)]) for w in range(4)]
+assert all(p.wait() == 0 for p in procs)
+config = config_service.load_config()
+assert sum(1 for name in config['pppoe_subscribers'] if name.startswith('w')) == 80
+assert config_service.config_revision() == 85
+
+# The JSON backend merges the same way, under a file lock
+backend = config_service.CONFIG_BACKEND
+config_service.CONFIG_BACKEND = 'json'
+config_service.CONFIG_FILE = os.path.join(tmp_dir, 'plain.json')
+page_a = config_service.load_config(mutable=True)
+page_b = config_service.load_config(mutable=True)
+page_a['network'] = {'eth1': {'role': 'lan'}}
+page_b['dhcp'] = {'eth1': {'enabled': True}}
+config_service.save_config(page_a)
+config_service.save_config(page_b)
+assert config_service.load_config() == {'network': {'eth1': {'role': 'lan'}}, 'dhcp': {'eth1': {'enabled': True}}}
+assert config_service.config_revision() == 2
+
+# Other test files may run in this process after this one (pytest)
+config_service.CONFIG_BACKEND = backend
+print("All config store tests passed")
@@ -0,0 +1,72 @@
+import os
+import tempfile
+from app.services import config_service, conntrack_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.GENERATED_DIR = tmp_dir
+
+# Fake procfs: 3000 of 4096 entries, two CPUs of stats, a table dump
+netfilter = os.path.join(tmp_dir, 'netfilter')
+os.makedirs(netfilter)
+for name, value in (('nf_conntrack_count', 3000), ('nf_conntrack_max', 4096), ('nf_conntrack_buckets', 1024)):
+    with open(os.path.join(netfilter, name), 'w') as f:
+        f.write(f'{value}\n')
+stat = os.path.join(tmp_dir, 'stat')
+with open(stat, 'w') as f:
+    f.write('entries  clashres found new invalid ignore delete chainlength insert insert_failed drop early_drop\n')
+    f.write('00000bb8  00000001 00000000 00000000 0000000a 00000000 00000000 00000000 00000000 00000002 00000010 00000000\n')
+    f.write('00000bb8  00000000 00000000 00000000 00000005 00000000 00000000 00000000 00000000 00000000 00000001 00000000\n')
+table = os.path.join(tmp_dir, 'table')
+with open(table, 'w') as f:
+    for n in range(1500):
+        f.write(f'ipv4     2 tcp      6 431999 {"ESTABLISHED" if n % 3 else "TIME_WAIT"} src=10.0.0.{n % 250} dst=1.1.1.1 sport={n} dport=443 [ASSURED] mark=0 use=1\n')
+    for n in range(500):
+        f.write(f'ipv4     2 udp      17 29 src=10.0.0.{n % 250} dst=8.8.8.8 sport={n} dport=53 mark=0 use=1\n')
+conntrack_service.PROC_NETFILTER = netfilter
+conntrack_service.PROC_STAT = stat
+conntrack_service.PROC_TABLE = table
+
+status = conntrack_service.read_status({'warn_percent': 70})
+print(status)
+assert status['count'] == 3000 and status['max'] == 4096 and status['buckets'] == 1024
+assert status['usage'] == 73.2 and status['level'] == 'warning'
+assert status['stats'] == {'drop': 17, 'early_drop': 0, 'insert_failed': 2, 'invalid': 15, 'clash_resolve': 1}
+# 2000 sampled lines scaled to the 3000 counted entries
+assert status['breakdown']['protocols'] == {'tcp': 2250, 'udp': 750}
+assert status['breakdown']['tcp_states'] == {'ESTABLISHED': 1500, 'TIME_WAIT': 750}
+assert conntrack_service.alert_level(95, {}) == 'critical'
+
+# Sizing: 2000 subscribers fit in 8 GB; 20000 are capped by 1 GB
+gb = 1024 ** 3
+size = conntrack_service.plan_size({}, 8 * gb, 2000)
+print(size)
+assert size['max'] == 2293760 and size['hashsize'] == 4194304
+size = conntrack_service.plan_size({}, gb, 20000)
+assert size['max'] == size['memory_cap'] == 327680 and size['hashsize'] == 524288
+assert conntrack_service.plan_size({}, gb // 2, 0)['max'] == 131072
+assert conntrack_service.plan_size({'max': 100000}, gb, 0) == {'max': 100000, 'hashsize': 131072, 'demand': 262144, 'memory_cap': 327680}
+
+config = {
+    'conntrack': {'auto_size': True, 'memory_bytes': 8 * gb},
+    'pppoe_subscribers': {f'user{n}': {'password': 'x'} for n in range(2000)}
+}
+
+
+def read(name):
+    with open(os.path.join(tmp_dir, name), 'r') as f:
+        return f.read()
+
+
+changed = config_service.generate_conntrack_config(config)
+print(f"--- Changed: {changed} ---")
+assert 'net.netfilter.nf_conntrack_max = 2293760' in read('conntrack-sysctl.conf')
+assert 'options nf_conntrack hashsize=4194304' in read('conntrack-modprobe.conf')
+# A few more subscribers stay within the same rounded size
+config['pppoe_subscribers']['extra'] = {'password': 'x'}
+assert config_service.generate_conntrack_config(config) == []
+
+config['conntrack']['auto_size'] = False
+config_service.generate_conntrack_config(config)
+assert 'nf_conntrack' not in read('conntrack-modules.conf')
+
+print("All conntrack tests passed")
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import time
+from app.services import lease_service
+
+lease_service.REFRESH_INTERVAL = 0
+tmp_dir = tempfile.mkdtemp()
+path = os.path.join(tmp_dir, 'dhcpd.leases')
+lease_service.LEASES_FILE = path
+
+def lease_block(ip, mac, hostname, state='active', ends_in=3600):
+    ends = time.strftime('%w %Y/%m/%d %H:%M:%S', time.gmtime(time.time() + ends_in))
+    return (f"lease {ip} {{\n  starts 3 2024/01/01 10:00:00;\n  ends {ends};\n"
+            f"  binding state {state};\n  next binding state free;\n"
+            f"  hardware ethernet {mac};\n  client-hostname \"{hostname}\";\n}}\n")
+
+with open(path, 'w') as f:
+    f.write('# The format of this file is documented in the dhcpd.leases(5) manual page.\n')
+    f.write('server-duid "\\000\\001";\n\n')
+    for n in range(2, 202):
+        f.write(lease_block(f'192.168.172.{n}', f'02:00:00:00:00:{n:02x}', f'host{n}'))
+
+index = lease_service.get_index()
+result = index.query(limit=10)
+print(f"--- {result['total']} active leases, first page ---")
+print([lease['ip'] for lease in result['leases']])
+assert result['total'] == 200 and result['leases'][0]['ip'] == '192.168.172.2'
+
+# Appended statements are parsed from the last offset; a half written block waits
+with open(path, 'a') as f:
+    f.write(lease_block('192.168.172.5', '02:00:00:00:00:05', 'host5', state='free', ends_in=-10))
+    f.write('lease 192.168.172.250 {\n  starts 3 2024/01/01 10:00:00;\n')
+assert index.refresh(force=True) == 1
+assert index.lookup('02:00:00:00:00:05')['active'] is False
+assert index.query(ip='192.168.172.250', state='all')['total'] == 0
+assert index.query(hostname='HOST7')['leases'][0]['mac'] == '02:00:00:00:00:07'
+print(index.counts())
+
+# dhcpd rewrites the file (new inode): the index starts over
+tmp_path = path + '.new'
+with open(tmp_path, 'w') as f:
+    f.write(lease_block('10.0.0.9', '02:00:00:00:01:09', 'fresh'))
+os.replace(tmp_path, path)
+index.refresh(force=True)
+print(index.counts())
+assert index.counts() == {'total': 1, 'active': 1}
+assert index.lookup('10.0.0.9')['hostname'] == 'fresh'
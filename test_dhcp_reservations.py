@@ -0,0 +1,72 @@
+import os
+import tempfile
+from app.services import config_service, dhcp_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.GENERATED_DIR = tmp_dir
+
+config = {
+    'network': {
+        'eth0': {'role': 'wan', 'ip': ''},
+        'eth1': {'role': 'lan', 'ip': '10.20.0.1/22'}
+    },
+    'dhcp': {
+        'br0': {'enabled': True, 'start': '10.20.1.0', 'end': '10.20.3.200', 'lease': '3600', 'dns': '10.20.0.1'}
+    }
+}
+
+# Scope comes from the bridge address, not from a /24 guess
+scopes, errors = dhcp_service.build_scopes(config)
+assert not errors, errors
+scope = scopes[0]
+print(f"--- Scope {scope['network']} router {scope['router']} ---")
+assert str(scope['network']) == '10.20.0.0/22' and str(scope['router']) == '10.20.0.1'
+
+# The domain ends up quoted in dhcpd.conf: only host name labels are accepted
+settings = dict(config['dhcp']['br0'])
+for domain in ('lan', 'home.example.org', ' office.lan '):
+    assert dhcp_service.build_scope(config, 'br0', dict(settings, domain=domain))['domain'] == domain.strip()
+for domain in ('lan";\n  option routers 6.6.6.6; #', 'a..b', '-lan', 'lan.', 'x' * 64, 'with space'):
+    try:
+        dhcp_service.build_scope(config, 'br0', dict(settings, domain=domain))
+        raise AssertionError(f'domain {domain!r} should be rejected')
+    except ValueError as e:
+        print(f"Rejected: {e!r}")
+bad = dict(config, dhcp={'br0': dict(settings, domain='evil"')})
+assert dhcp_service.build_scopes(bad) == ([], ['br0: invalid domain name: evil"'])
+
+store = dhcp_service.ReservationStore(scopes)
+for n in range(2, 250):
+    store.add(f'02:00:00:00:00:{n:02x}', f'10.20.0.{n}')
+print(f"--- {len(store)} reservations ---")
+
+for mac, ip, reason in [
+    ('02:00:00:00:00:02', '10.20.0.251', 'duplicate MAC'),
+    ('02:00:00:00:01:00', '10.20.0.5', 'duplicate IP'),
+    ('02:00:00:00:01:00', '10.20.2.5', 'dynamic range'),
+    ('02:00:00:00:01:00', '192.168.1.5', 'outside every scope'),
+    ('02:00:00:00:01:00', '10.20.0.1', 'router address'),
+]:
+    try:
+        store.add(mac, ip)
+        raise AssertionError(f'{reason} should be rejected')
+    except ValueError as e:
+        print(f"Rejected ({reason}): {e}")
+
+assert store.by_ip('10.20.0.7')['mac'] == '02:00:00:00:00:07'
+assert store.by_mac('02-00-00-00-00-07')['ip'] == '10.20.0.7'
+store.remove('02:00:00:00:00:07')
+assert store.by_ip('10.20.0.7') is None
+
+config['dhcp_reservations'] = store.entries()
+config_service.generate_dhcp_config(config)
+with open(os.path.join(tmp_dir, 'dhcpd.conf'), 'r') as f:
+    content = f.read()
+print(content[:600])
+assert 'subnet 10.20.0.0 netmask 255.255.252.0' in content
+assert 'fixed-address 10.20.0.8;' in content and 'fixed-address 10.20.0.7;' not in content
+
+# Unchanged output is not rewritten
+mtime = os.stat(os.path.join(tmp_dir, 'dhcpd.conf')).st_mtime_ns
+assert config_service.generate_dhcp_config(config) == []
+assert os.stat(os.path.join(tmp_dir, 'dhcpd.conf')).st_mtime_ns == mtime
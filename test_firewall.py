@@ -0,0 +1,56 @@
+import os
+import subprocess
+import tempfile
+from app.services import config_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.GENERATED_DIR = tmp_dir
+
+config = {
+    'network': {
+        'eth0': {'role': 'wan', 'ip': ''},
+        'eth1': {'role': 'wan', 'ip': ''},
+        'eth2': {'role': 'lan', 'ip': '192.168.172.1'}
+    },
+    'firewall': {'enabled': True, 'blocked': ['203.0.113.7', '198.51.100.0/24']}
+}
+
+config_service.generate_firewall_config(config)
+with open(os.path.join(tmp_dir, 'firewall.nft'), 'r') as f:
+    rules = f.read()
+print("--- Generated firewall.nft ---")
+print(rules)
+
+# Replaced as a whole in one transaction
+assert rules.splitlines()[1:3] == ['table inet ubr_fw {}', 'delete table inet ubr_fw']
+assert 'oifname "eth0" masquerade' in rules and 'oifname "eth1" masquerade' in rules
+assert 'oifname "eth2" masquerade' not in rules
+assert 'elements = { 203.0.113.7, 198.51.100.0/24 }' in rules
+assert 'define FLOWTABLE_DEVICES = { eth0, eth1, br0, eth2 }' in rules
+assert 'flow add @fastpath' in rules and 'policy drop' in rules
+
+# Without the offload only the tagged lines go away
+config['firewall']['flow_offload'] = False
+assert '# offload' not in config_service._firewall_nft(config)
+
+# Disabled (or no WAN): just the table removal
+config['firewall']['enabled'] = False
+assert 'masquerade' not in config_service._firewall_nft(config)
+
+# The setup script keeps only existing flowtable devices
+script = os.path.join(tmp_dir, 'setup_firewall.sh')
+bin_dir = os.path.join(tmp_dir, 'bin')
+os.makedirs(bin_dir)
+for name, body in (('nft', 'cat > "$(dirname "$0")/loaded.nft"'), ('sysctl', 'true')):
+    with open(os.path.join(bin_dir, name), 'w') as f:
+        f.write(f'#!/bin/sh\n{body}\n')
+    os.chmod(os.path.join(bin_dir, name), 0o755)
+env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'])
+assert subprocess.run(['bash', script], env=env).returncode == 0
+with open(os.path.join(bin_dir, 'loaded.nft')) as f:
+    loaded = f.read()
+print(loaded.splitlines()[3])
+assert 'eth2' not in loaded.splitlines()[3] or os.path.exists('/sys/class/net/eth2')
+assert 'flow add @fastpath' in loaded if os.path.exists('/sys/class/net/eth0') else '# offload' not in loaded
+
+print("All firewall tests passed")
@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+import tempfile
+from app.services import green
+
+# Without gevent's patching blocking() is a plain call
+assert not green.active()
+assert green.blocking(divmod, 7, 2) == (3, 1)
+assert green.blocking(int, '10', base=2) == 2
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+if gevent is None:
+    print('gevent not installed; skipping the cooperative check')
+else:
+    # In a patched process a greenlet waiting for an flock held by another
+    # process must not stop the others (the situation of a gevent worker
+    # while another worker holds the generation lock)
+    lock_path = os.path.join(tempfile.mkdtemp(), 'test.lock')
+    child = r'''
+from gevent import monkey
+monkey.patch_all()
+import fcntl, subprocess, sys, time
+import gevent
+from app.services import green
+
+lock_path = sys.argv[1]
+holder = subprocess.Popen([sys.executable, '-c',
+    'import fcntl, sys, time\n'
+    'f = open(sys.argv[1], "a"); fcntl.flock(f, fcntl.LOCK_EX)\n'
+    'print("locked", flush=True); time.sleep(0.5)', lock_path], stdout=subprocess.PIPE)
+assert holder.stdout.readline().strip() == b'locked'
+assert green.active()
+
+ticks = []
+
+def ticker():
+    while True:
+        ticks.append(time.monotonic())
+        gevent.sleep(0.02)
+
+def waiter():
+    with open(lock_path, 'a') as f:
+        green.blocking(fcntl.flock, f, fcntl.LOCK_EX)
+        return len(ticks)
+
+t = gevent.spawn(ticker)
+w = gevent.spawn(waiter)
+during = w.get(timeout=5)
+t.kill()
+holder.wait()
+print('ticks while waiting for the lock:', during)
+assert during >= 10, during
+'''
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', child, lock_path], env=env, capture_output=True, text=True, timeout=30)
+    print(result.stdout, result.stderr)
+    assert result.returncode == 0
+
+print('green OK')
@@ -0,0 +1,73 @@
+import os
+import socket
+import struct
+from app.services import interface_inventory as inv
+
+
+def attr(kind, payload):
+    length = 4 + len(payload)
+    return struct.pack('=HH', length, kind) + payload + b'\0' * (inv._align(length) - length)
+
+
+def message(kind, body):
+    return struct.pack('=IHHII', 16 + len(body), kind, 0, 0, 0) + body
+
+
+def link(kind, index, name, flags=inv.IFF_UP | inv.IFF_RUNNING, mtu=1500):
+    body = struct.pack('=BxHiII', 0, 1, index, flags, 0)
+    if name:
+        body += attr(inv.IFLA_IFNAME, name.encode() + b'\0')
+    if mtu:
+        body += attr(inv.IFLA_MTU, struct.pack('=I', mtu))
+    return message(kind, body)
+
+
+def addr(kind, family, index, raw, prefixlen, scope=0, broadcast=None):
+    body = struct.pack('=BBBBI', family, prefixlen, 0, scope, index)
+    body += attr(inv.IFA_LOCAL if family == socket.AF_INET else inv.IFA_ADDRESS, raw)
+    if broadcast:
+        body += attr(inv.IFA_BROADCAST, broadcast)
+    return message(kind, body)
+
+
+# An inventory fed by hand: no psutil scan, no listener
+inventory = inv.InterfaceInventory(lambda name: name.startswith('wl'))
+inventory._pid = os.getpid()
+inventory._listening = True
+
+# Several messages in one datagram, as the kernel sends them
+inventory._handle(link(inv.RTM_NEWLINK, 7, 'eth9') + link(inv.RTM_NEWLINK, 8, 'wlan5', flags=0)
+                  + addr(inv.RTM_NEWADDR, socket.AF_INET, 7, socket.inet_aton('10.1.2.3'), 24, broadcast=socket.inet_aton('10.1.2.255'))
+                  + addr(inv.RTM_NEWADDR, socket.AF_INET6, 7, socket.inet_pton(socket.AF_INET6, 'fe80::1'), 64, scope=inv.RT_SCOPE_LINK))
+interfaces = {i['name']: i for i in inventory.snapshot()}
+print('--- After NEWLINK/NEWADDR ---')
+print(interfaces)
+assert interfaces['eth9']['is_up'] and interfaces['eth9']['mtu'] == 1500
+assert not interfaces['wlan5']['is_up'] and interfaces['wlan5']['is_wireless']
+assert interfaces['eth9']['addresses'] == [
+    {'family': 'IPv4', 'address': '10.1.2.3', 'netmask': '255.255.255.0', 'broadcast': '10.1.2.255'},
+    {'family': 'IPv6', 'address': 'fe80::1%eth9'}
+]
+
+seq, events = inventory.events_since(0)
+assert [(e['event'], e['name']) for e in events] == [('added', 'eth9'), ('added', 'wlan5')]
+# Cursors are timestamps (microseconds), so they order against any worker's events
+assert seq == events[-1]['seq'] and abs(seq / 1000000 - events[-1]['time']) < 5
+
+# Address removal, link state change, and a removal without a name attribute (looked up by index)
+inventory._handle(addr(inv.RTM_DELADDR, socket.AF_INET, 7, socket.inet_aton('10.1.2.3'), 24)
+                  + link(inv.RTM_NEWLINK, 8, 'wlan5', mtu=0)
+                  + link(inv.RTM_DELLINK, 7, None))
+seq2, events = inventory.events_since(seq)
+assert [(e['event'], e['name']) for e in events] == [('changed', 'wlan5'), ('removed', 'eth9')]
+assert [i['name'] for i in inventory.snapshot()] == ['wlan5']
+# Nothing new: the cursor stays
+assert inventory.events_since(seq2) == (seq2, [])
+
+# The first load of a fresh worker reports no hotplug for the existing NICs
+fresh = inv.InterfaceInventory(lambda name: False)
+seq, events = fresh.events_since(0)
+print(f'--- Fresh inventory: {len(fresh.snapshot())} interfaces, events {events} ---')
+assert events == [] and seq == 0 and fresh.snapshot()
+
+print('Interface inventory tests passed')
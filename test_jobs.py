@@ -0,0 +1,73 @@
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from app.services import apply_service, config_service, job_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.CONFIG_FILE = os.path.join(tmp_dir, 'settings.json')
+config_service.GENERATED_DIR = tmp_dir
+job_service.JOBS_DIR = os.path.join(tmp_dir, 'jobs')
+apply_service.INSTALL_ROOT = tmp_dir
+# Nothing to install: every apply succeeds at once
+real_subsystems = apply_service.SUBSYSTEMS
+apply_service.SUBSYSTEMS = []
+
+
+def wait(job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = job_service.get_job(job_id)
+        if job_service.is_finished(job):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f'job {job_id} did not finish')
+
+
+# While an apply runs (here: the run lock is held), concurrent submits all
+# merge into the one pending job
+ids = []
+with job_service._file_lock(job_service._RUN_LOCK):
+    threads = [threading.Thread(target=lambda: ids.append(job_service.submit_apply())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(ids)) == 1, ids
+    job = job_service.get_job(ids[0])
+    print('--- Merged job ---')
+    print(job)
+    assert job['state'] == 'queued' and job['merged'] == 7
+job = wait(ids[0])
+assert job['state'] == 'succeeded' and job['summary'] == 'Nothing changed.'
+
+# A job whose process died halfway is taken over by another process
+dead = subprocess.Popen(['true'])
+dead.wait()
+orphan = {'id': 'abcdef012345', 'state': 'running', 'force': False, 'merged': 0, 'created': time.time(),
+          'started': time.time(), 'finished': None, 'report': None, 'summary': None, 'confirm_timeout': None,
+          'pid': dead.pid}
+with open(os.path.join(job_service.JOBS_DIR, 'abcdef012345.json'), 'w') as f:
+    json.dump(orphan, f)
+assert job_service.get_job('abcdef012345')['orphaned']
+job_service.resume_orphans()
+job = wait('abcdef012345')
+entries, _offset = job_service.read_log('abcdef012345')
+print('--- Resumed job ---')
+print(job['state'], job['resumed'], [e['line'] for e in entries])
+assert job['state'] == 'succeeded' and job['resumed'] == 1 and job['pid'] == os.getpid()
+assert 'resuming' in entries[0]['line']
+
+# One that keeps dying is given up
+orphan.update(id='abcdef012346', resumed=job_service.MAX_RESUMES)
+with open(os.path.join(job_service.JOBS_DIR, 'abcdef012346.json'), 'w') as f:
+    json.dump(orphan, f)
+job_service.resume_orphans()
+job = wait('abcdef012346')
+assert job['state'] == 'failed' and 'gave up' in job['error']
+
+# Other test files may run in this process after this one (pytest)
+apply_service.SUBSYSTEMS = real_subsystems
+print('Job tests passed')
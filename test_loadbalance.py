@@ -0,0 +1,42 @@
+import os
+import subprocess
+import tempfile
+from app.services import config_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.GENERATED_DIR = tmp_dir
+
+config = {
+    'network': {
+        'eth0': {'role': 'wan', 'ip': ''},
+        'eth1': {'role': 'wan', 'ip': ''},
+        'eth2': {'role': 'lan', 'ip': '192.168.172.1'}
+    },
+    'loadbalance': {
+        'eth0': {'weight': 3, 'enabled': True, 'slot': 2},
+        'eth1': {'weight': 1, 'enabled': True},
+        'eth2': {'weight': 1, 'enabled': True}
+    }
+}
+
+# Stored slots are kept, new interfaces get the lowest free one
+slots = config_service.assign_lb_slots({k: dict(v) for k, v in config['loadbalance'].items()})
+assert slots['eth0']['slot'] == 2 and slots['eth1']['slot'] == 1
+
+wans = config_service.get_lb_wans(config)
+print("--- Load balanced WANs ---")
+print(wans)
+assert [w['name'] for w in wans] == ['eth1', 'eth0']
+
+config_service.generate_loadbalance_script(config)
+with open(os.path.join(tmp_dir, 'setup_loadbalance.sh'), 'r') as f:
+    script = f.read()
+with open(os.path.join(tmp_dir, 'loadbalance.nft'), 'r') as f:
+    nft = f.read()
+print("--- Generated loadbalance.nft ---")
+print(nft)
+
+assert 'nexthop via $GW_2 dev eth0 weight 3' in script
+assert 'rule add fwmark 0x101 table 101 priority 9001' in script
+assert 'eth2' not in script
+assert subprocess.run(['bash', '-n', os.path.join(tmp_dir, 'setup_loadbalance.sh')]).returncode == 0
@@ -0,0 +1,79 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+# Gunicorn mode: several worker processes record into one multiprocess
+# directory, and whichever worker serves the scrape reports the sum
+project_dir = os.path.dirname(os.path.abspath(__file__))
+tmp_dir = tempfile.mkdtemp()
+multiproc_dir = os.path.join(tmp_dir, 'prometheus')
+os.makedirs(multiproc_dir)
+env = dict(os.environ, PYTHONPATH=project_dir, PROMETHEUS_MULTIPROC_DIR=multiproc_dir)
+
+worker = r'''
+import os, sys
+from app.services import metrics_service
+n = int(sys.argv[1])
+for _ in range(n):
+    metrics_service.observe_request('main.index', 'GET', 200, 0.01)
+    metrics_service.observe_generator('generate_netplan_config', 0.002)
+    metrics_service.observe_config_cache(True)
+metrics_service.observe_config_cache(False)
+metrics_service.observe_apply({'name': 'dhcp', 'status': 'applied', 'duration': 0.5,
+                               'actions': [{'returncode': 0}, {'returncode': 1}]})
+metrics_service.observe_apply({'name': 'qos', 'status': 'unchanged', 'duration': 0, 'actions': []})
+print(os.getpid())
+'''
+
+scrape = r'''
+import sys
+from app.services import metrics_service
+body, content_type = metrics_service.render()
+assert content_type.startswith('text/plain')
+sys.stdout.write(body.decode())
+'''
+
+
+def run(code, *args):
+    result = subprocess.run([sys.executable, '-c', code] + [str(a) for a in args], cwd=tmp_dir, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def sample(body, line_start):
+    for line in body.splitlines():
+        if line.startswith(line_start + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    raise AssertionError(f'{line_start} not in /metrics output')
+
+
+pids = [int(run(worker, n)) for n in (3, 5)]
+assert len(os.listdir(multiproc_dir)) >= 2, os.listdir(multiproc_dir)
+body = run(scrape)
+
+requests = 'ubunturouter_http_request_duration_seconds_count{endpoint="main.index",method="GET",status="200"}'
+assert sample(body, requests) == 8, body
+assert sample(body, 'ubunturouter_generator_duration_seconds_count{generator="generate_netplan_config"}') == 8
+assert sample(body, 'ubunturouter_config_cache_requests_total{result="hit"}') == 8
+assert sample(body, 'ubunturouter_config_cache_requests_total{result="miss"}') == 2
+assert sample(body, 'ubunturouter_apply_total{status="applied",subsystem="dhcp"}') == 2
+assert sample(body, 'ubunturouter_apply_commands_total{exit_code="1",subsystem="dhcp"}') == 2
+assert sample(body, 'ubunturouter_apply_duration_seconds_sum{subsystem="dhcp"}') == 1.0
+# Unchanged subsystems are not counted as applies
+assert 'subsystem="qos"' not in body
+# The scraping process reports the shared interface sampler directly
+assert 'ubunturouter_interface_bits_per_second' in body
+print('aggregated over workers', pids)
+
+# Counters of a worker that exited stay in the totals after child_exit
+for pid in pids:
+    run('import sys\nfrom app.services import metrics_service\nmetrics_service.mark_process_dead(int(sys.argv[1]))', pid)
+assert sample(run(scrape), requests) == 8
+
+# Without the multiprocess directory the process reports only its own samples
+del env['PROMETHEUS_MULTIPROC_DIR']
+body = run(worker.replace('print(os.getpid())', scrape), 4)
+assert sample(body, requests) == 4
+print('ALL OK')
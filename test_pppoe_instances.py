@@ -0,0 +1,47 @@
+import os
+import subprocess
+import tempfile
+from app.services import config_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.GENERATED_DIR = tmp_dir
+
+config = {
+    'pppoe': {
+        'br0': {
+            'enabled': True,
+            'local_ip': '10.64.0.1',
+            'remote_start': '10.64.0.2',
+            'remote_end': '10.64.15.254',
+            'dns': '8.8.8.8',
+            'kernel_mode': True,
+            'instances': 4,
+            'max_sessions': 3000,
+            'cpus': '1-3'
+        }
+    }
+}
+
+# The pool is split into disjoint slices, one per instance
+plan = config_service.plan_pppoe_instances(config['pppoe']['br0'])
+print("--- Instance plan ---")
+for instance in plan:
+    print(instance)
+assert sum(i['sessions'] for i in plan) == 3000
+assert [i['cpu'] for i in plan] == [1, 2, 3, 1]
+assert plan[1]['remote_start'] == '10.64.4.2'
+
+config_service.generate_pppoe_config(config)
+with open(os.path.join(tmp_dir, 'start_pppoe.sh'), 'r') as f:
+    script = f.read()
+print("--- start_pppoe.sh ---")
+print(script)
+assert script.count('pppoe-server -k -I br0') == 4
+assert subprocess.run(['bash', '-n', os.path.join(tmp_dir, 'start_pppoe.sh')]).returncode == 0
+
+# Local IP inside the pool is rejected
+try:
+    config_service.plan_pppoe_instances(dict(config['pppoe']['br0'], local_ip='10.64.1.1'))
+    raise AssertionError("local IP inside the pool should be rejected")
+except ValueError as e:
+    print(f"Rejected: {e}")
@@ -0,0 +1,59 @@
+import os
+import subprocess
+import tempfile
+import time
+from app.services import pppoe_sessions
+
+tmp_dir = tempfile.mkdtemp()
+pppoe_sessions.RUN_DIR = tmp_dir
+pppoe_sessions.EVENTS_FILE = os.path.join(tmp_dir, 'pppoe-events.log')
+pppoe_sessions.LOCK_FILE = os.path.join(tmp_dir, 'pppoe-events.lock')
+pppoe_sessions.REFRESH_INTERVAL = 0
+
+# Stand-in for /proc/net/dev: every ppp link that "exists" with some traffic
+links = {}
+pppoe_sessions._read_counters = lambda: dict(links)
+
+# The generated hooks append one line per login/logout
+hook = os.path.join(tmp_dir, 'ip-up')
+with open(hook, 'w') as f:
+    f.write(pppoe_sessions.hook_script('up'))
+env = dict(os.environ, PPP_IPPARAM=pppoe_sessions.IPPARAM, PPP_IFACE='ppp0', PEERNAME='alice',
+           PPP_REMOTE='10.0.0.2', PPP_LOCAL='10.0.0.1')
+subprocess.run(['sh', hook], env=env, check=True)
+subprocess.run(['sh', hook], env=dict(env, PPP_IPPARAM='wan-client'), check=True)
+links['ppp0'] = (1000, 2000)
+
+store = pppoe_sessions.get_store()
+print("--- After hook ---")
+print(store.query())
+assert store.query(username='alice')['sessions'][0]['ip'] == '10.0.0.2'
+
+# 5k subscribers
+started = time.time()
+with open(pppoe_sessions.EVENTS_FILE, 'a') as f:
+    for n in range(1, 5001):
+        f.write(f"up\t{started:.0f}\tppp{n}\tuser{n}\t10.{n >> 16}.{(n >> 8) & 255}.{n & 255}\t10.255.255.254\n")
+        links[f'ppp{n}'] = (n, n * 2)
+    f.write("down\t0\tppp7\tuser7\t10.0.0.7\t10.255.255.254\t60\t1\t2\n")
+    f.write("up\t0\tppp9999\tpartial")
+
+t = time.perf_counter()
+result = store.query(search='user42', sort='username', limit=5)
+print(f"--- Search over {result['counts']['sessions']} sessions took {time.perf_counter() - t:.4f}s ---")
+print([s['username'] for s in result['sessions']])
+assert result['counts']['sessions'] == 5000 and 'ppp9999' not in links
+
+t = time.perf_counter()
+page = store.query(offset=4900, limit=100, sort='ip')
+print(f"--- Last page took {time.perf_counter() - t:.4f}s ---")
+assert len(page['sessions']) == 100
+
+# Links that vanished without ip-down are dropped
+del links['ppp1']
+assert store.query(username='user1')['total'] == 0
+
+# Compaction rewrites the log with the live sessions only
+assert store.compact()
+store.refresh(force=True)
+assert store.counts()['sessions'] == 4999
@@ -0,0 +1,117 @@
+import os
+import tempfile
+import time
+from app.services import apply_service, config_service, subscriber_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.CONFIG_FILE = os.path.join(tmp_dir, 'settings.json')
+config_service.GENERATED_DIR = os.path.join(tmp_dir, 'generated')
+os.makedirs(config_service.GENERATED_DIR)
+apply_service.INSTALL_ROOT = tmp_dir
+subscriber_service.LOCK_FILE = os.path.join(tmp_dir, 'chap-secrets.lock')
+chap_path = apply_service.installed_path(subscriber_service.CHAP_SECRETS)
+
+# A hand-written account and comment must survive every change
+os.makedirs(os.path.dirname(chap_path))
+with open(chap_path, 'w') as f:
+    f.write('# Secrets for authentication using CHAP\n"admin" * "secret" *')
+
+csv_data = 'username,password,ip,plan\n' + ''.join(
+    f'user{n},pw{n},10.64.{n >> 8}.{n & 255},{"gold" if n % 10 == 0 else "basic"}\n' for n in range(1, 5001)
+)
+t = time.perf_counter()
+result = subscriber_service.import_subscribers(subscriber_service.parse_import(csv_data, 'subs.csv'))
+print(f"--- Imported {result['imported']} in {time.perf_counter() - t:.3f}s ---")
+assert result == {'imported': 5000, 'errors': []}
+
+with open(chap_path) as f:
+    lines = f.readlines()
+print(lines[:4])
+assert lines[1] == '"admin" * "secret" *\n' and len(lines) == 5002
+
+assert subscriber_service.find_by_ip('10.64.0.42')['username'] == 'user42'
+assert subscriber_service.list_subscribers(plan='gold')['total'] == 500
+assert subscriber_service.list_subscribers(search='user499', limit=5)['total'] == 11
+
+# Single-account changes patch one line
+t = time.perf_counter()
+subscriber_service.save_subscriber({'username': 'user2500', 'password': 'a much longer password', 'ip': '', 'plan': 'gold'})
+subscriber_service.save_subscriber({'username': 'newuser', 'password': 'x', 'ip': '10.65.0.1'})
+assert subscriber_service.delete_subscriber('user10')
+print(f"--- Three single-account changes took {time.perf_counter() - t:.3f}s ---")
+
+chap = subscriber_service._chap()
+assert chap.lookup_line('user2501') == '"user2501" * "pw2501" 10.64.9.197 # ubuntu-router\n'
+assert chap.lookup_line('user2500') == '"user2500" * "a much longer password" * # ubuntu-router\n'
+assert chap.lookup_line('newuser').startswith('"newuser" * "x" 10.65.0.1')
+assert chap.lookup_line('user10') is None
+
+# Someone edits the file by hand: the index is rebuilt, not trusted
+with open(chap_path, 'r+') as f:
+    content = f.read()
+    f.seek(0)
+    f.write('"extra" * "pw" *\n' + content)
+subscriber_service.save_subscriber({'username': 'user3', 'password': 'changed', 'ip': '10.64.0.3'})
+with open(chap_path) as f:
+    content = f.read()
+assert '"user3" * "changed" 10.64.0.3 # ubuntu-router\n' in content and '"pw3"' not in content
+assert content.startswith('"extra"') and content.count('\n') == 5003
+
+# Saves that do not go through this module still update chap-secrets: a
+# whole-section save, and a full-config save dropping an account
+config_service.save_config_section('pppoe_subscribers', dict(config_service.load_config(mutable=True)['pppoe_subscribers'],
+                                                               direct={'password': 'pw', 'ip': '', 'plan': ''}))
+assert chap.lookup_line('direct') == '"direct" * "pw" * # ubuntu-router\n'
+config = config_service.load_config(mutable=True)
+del config['pppoe_subscribers']['direct']
+config_service.save_config(dict(config))
+assert chap.lookup_line('direct') is None
+# An entry the form would have refused is not written
+config_service.save_config_section('pppoe_subscribers', dict(config['pppoe_subscribers'], bad={'password': 'a"b'}))
+assert chap.lookup_line('bad') is None
+config_service.save_config_section('pppoe_subscribers', config['pppoe_subscribers'])
+
+# A chap-secrets update cut off after the config was saved is caught up by the next apply
+real_swap = subscriber_service.ChapSecretsFile._swap
+
+
+def failing_swap(self, start, length, replacement):
+    raise OSError('disk full')
+
+
+subscriber_service.ChapSecretsFile._swap = failing_swap
+try:
+    subscriber_service.save_subscriber({'username': 'late', 'password': 'x'})
+    raise AssertionError('the write did not fail')
+except OSError:
+    pass
+finally:
+    subscriber_service.ChapSecretsFile._swap = real_swap
+assert subscriber_service.get_subscriber('late') and chap.lookup_line('late') is None
+real_subsystems = apply_service.SUBSYSTEMS
+apply_service.SUBSYSTEMS = []
+try:
+    apply_service.apply_changes()
+finally:
+    apply_service.SUBSYSTEMS = real_subsystems
+assert chap.lookup_line('late') == '"late" * "x" * # ubuntu-router\n'
+with open(chap_path) as f:
+    content = f.read()
+assert content.startswith('"extra"') and '"admin" * "secret" *\n' in content
+print('Config writes outside this module reconciled')
+
+# Validation
+for bad in ({'username': 'bad user', 'password': 'x'}, {'username': 'u', 'password': 'a"b'},
+            {'username': 'u', 'password': 'x', 'ip': '10.64.0.42'}, {'username': 'u', 'password': 'x', 'ip': '300.1.1.1'}):
+    try:
+        subscriber_service.save_subscriber(bad)
+    except ValueError as e:
+        print(f"Rejected: {e}")
+    else:
+        raise AssertionError(bad)
+
+result = subscriber_service.import_subscribers([{'username': 'a', 'password': 'x', 'ip': '10.64.0.42'}])
+print(result)
+assert result['imported'] == 0 and len(result['errors']) == 1
+
+print("All subscriber tests passed")
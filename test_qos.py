@@ -0,0 +1,92 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from app.services import config_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.GENERATED_DIR = tmp_dir
+
+config = {
+    'network': {
+        'eth0': {'role': 'wan', 'ip': ''},
+        'eth1': {'role': 'lan', 'ip': '192.168.172.1'}
+    },
+    'qos': {'enabled': True, 'interfaces': {'eth0': {'rate_kbit': 100000}, 'br0': {'rate_kbit': 500000}}},
+    'qos_plans': {
+        'basic': {'down_kbit': 10000, 'up_kbit': 2000},
+        'gold': {'down_kbit': 50000, 'up_kbit': 10000}
+    },
+    'pppoe_subscribers': {f'user{n}': {'password': 'x', 'ip': '', 'plan': 'gold' if n % 10 == 0 else 'basic'}
+                          for n in range(1, 3001)},
+    'dhcp_reservations': [{'mac': '00:11:22:33:44:55', 'ip': '192.168.172.20', 'hostname': 'nas', 'plan': 'gold'}]
+}
+config['pppoe_subscribers']['user7']['plan'] = 'missing'
+config['pppoe_subscribers']['user8']['ip'] = '10.0.0.8'
+
+
+def read(name):
+    with open(os.path.join(tmp_dir, name), 'r') as f:
+        return f.read()
+
+
+changed = config_service.generate_qos_config(config)
+print(f"--- Changed: {changed} ---")
+batch = read('qos-classes.tc').splitlines()
+print(batch[:5])
+# Two trees with root, default and 3000 client classes (user7 has no valid plan)
+assert len(batch) == 2 * (4 + 3000)
+assert batch[0] == 'qdisc replace dev br0 root handle 1: htb default 2'
+assert 'class replace dev eth0 parent 1:1 classid 1:10 htb rate 2000kbit ceil 2000kbit quantum 1514' in batch
+
+nft = read('qos.nft')
+assert 'add rule inet ubr_qos forward meta priority set ip daddr map @sessions' in nft
+assert '192.168.172.20 : ' in nft and '10.0.0.8 : ' in nft
+sessions = read('qos-sessions')
+assert 'user10\t' in sessions and 'user7\t' not in sessions
+
+# A plan change keeps every class number; only the plan's own classes differ
+config['qos_plans']['gold']['down_kbit'] = 60000
+config['pppoe_subscribers']['user5000'] = {'password': 'x', 'ip': '', 'plan': 'basic'}
+config_service.generate_qos_config(config)
+new_batch = read('qos-classes.tc').splitlines()
+changed_lines = set(new_batch) - set(batch)
+print(f"--- {len(changed_lines)} lines differ after the plan change ---")
+assert len(changed_lines) == 301 + 2  # gold clients on br0 + the new subscriber on both trees
+assert read('qos-sessions').count('\n') == 3000
+
+# Run the setup script against stand-ins for tc and nft to see what it sends
+bin_dir = os.path.join(tmp_dir, 'bin')
+os.makedirs(bin_dir)
+with open(os.path.join(bin_dir, 'tc'), 'w') as f:
+    f.write('#!/bin/sh\n[ "$1" = "-batch" ] && cp "$2" "$(dirname "$0")/sent.tc"\n'
+            '[ "$1" = "qdisc" ] && echo "qdisc htb 1: root refcnt 2"\nexit 0\n')
+with open(os.path.join(bin_dir, 'nft'), 'w') as f:
+    f.write('#!/bin/sh\nexit 0\n')
+for name in ('tc', 'nft'):
+    os.chmod(os.path.join(bin_dir, name), 0o755)
+
+etc_dir = os.path.join(tmp_dir, 'etc')
+os.makedirs(etc_dir)
+for name in ('setup_qos.sh', 'qos.nft', 'qos-sessions'):
+    shutil.copy(os.path.join(tmp_dir, name), etc_dir)
+with open(os.path.join(etc_dir, 'qos-classes.tc'), 'w') as f:
+    f.write('\n'.join(new_batch) + '\n')
+with open(os.path.join(etc_dir, 'qos-classes.applied'), 'w') as f:
+    f.write('\n'.join(batch) + '\nclass replace dev eth0 parent 1:1 classid 1:ffff htb rate 8kbit\n'
+            'qdisc replace dev eth9 root handle 1: htb default 2\n')
+env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'])
+result = subprocess.run(['bash', os.path.join(etc_dir, 'setup_qos.sh')], env=env, capture_output=True, text=True)
+print(result.stdout, result.stderr)
+assert result.returncode == 0
+with open(os.path.join(bin_dir, 'sent.tc')) as f:
+    sent = f.read().splitlines()
+assert set(sent) == changed_lines | {'class del dev eth0 classid 1:ffff', 'qdisc del dev eth9 root'}
+assert read('etc/qos-classes.applied').splitlines() == new_batch
+
+# Disabling removes the table and leaves nothing to shape
+config['qos']['enabled'] = False
+config_service.generate_qos_config(config)
+assert read('qos-classes.tc') == '' and 'delete table inet ubr_qos' in read('qos.nft')
+
+print("All QoS tests passed")
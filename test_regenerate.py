@@ -0,0 +1,81 @@
+import os
+import tempfile
+from app.services import config_service, qos_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.GENERATED_DIR = tmp_dir
+
+# Record which generators run
+ran = []
+for gen in config_service.GENERATORS:
+    original = gen['func']
+
+    def counted(config, original=original):
+        ran.append(original.__name__)
+        return original(config)
+    counted.__name__ = original.__name__
+    gen['func'] = counted
+
+config = {
+    'network': {
+        'eth0': {'role': 'wan', 'ip': ''},
+        'eth1': {'role': 'lan', 'ip': '192.168.172.1'}
+    },
+    'dhcp': {'eth1': {'enabled': True, 'start': '192.168.172.10', 'end': '192.168.172.100'}}
+}
+config_service.regenerate(config)
+everything = list(ran)
+print('--- First run ---')
+print(everything)
+assert len(everything) == len(config_service.GENERATORS)
+
+# Nothing changed: nothing runs
+del ran[:]
+assert config_service.regenerate(config) == []
+assert ran == [], ran
+
+# Only the generators reading the edited section run
+del ran[:]
+config['dhcp']['eth1']['end'] = '192.168.172.200'
+changed = config_service.regenerate(config)
+print('--- After editing dhcp ---')
+print(ran, changed)
+assert sorted(ran) == sorted(g['func'].__name__ for g in config_service.GENERATORS if 'dhcp' in g['sections'])
+assert 'dhcpd.conf' in changed
+
+# A missing output reruns its generator
+del ran[:]
+os.unlink(os.path.join(tmp_dir, 'firewall.nft'))
+config_service.regenerate(config)
+assert ran == ['generate_firewall_config'], ran
+
+# A change in a service module a generator uses (an upgrade) invalidates it
+qos = next(g['func'] for g in config_service.GENERATORS if g['func'].__name__ == 'generate_qos_config')
+netplan = next(g['func'] for g in config_service.GENERATORS if g['func'].__name__ == 'generate_netplan_config')
+# The counting wrappers live in this file; fingerprint the real generators
+qos, netplan = qos.__defaults__[0], netplan.__defaults__[0]
+before = config_service._code_fingerprint(qos), config_service._code_fingerprint(netplan)
+config_service._code_fingerprints.clear()
+config_service._source_hashes[qos_service.__file__] = 'upgraded'
+after = config_service._code_fingerprint(qos), config_service._code_fingerprint(netplan)
+assert before[0] != after[0] and before[1] == after[1]
+
+# Entries a generator skips are kept as warnings until it runs again
+config_service._code_fingerprints.clear()
+config_service._source_hashes.clear()
+assert config_service.generator_warnings() == []
+config['dhcp']['eth1']['domain'] = 'bad domain'
+config['firewall'] = {'enabled': True, 'blocked': ['10.0.0.5', 'not-a-host']}
+config_service.regenerate(config)
+warnings = config_service.generator_warnings()
+print('--- Warnings ---')
+print(warnings)
+assert warnings == ['DHCP: skipped eth1: invalid domain name: bad domain',
+                    'Firewall: skipped blocked host not-a-host'], warnings
+del ran[:]
+config['dhcp']['eth1']['domain'] = 'lan'
+config_service.regenerate(config)
+assert 'generate_firewall_config' not in ran
+assert config_service.generator_warnings() == ['Firewall: skipped blocked host not-a-host']
+
+print('Regeneration tests passed')
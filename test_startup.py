@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+import tempfile
+from app.services import startup_profile
+
+project_dir = os.path.dirname(os.path.abspath(__file__))
+env = dict(os.environ, PYTHONPATH=project_dir)
+
+
+def child(code, cwd):
+    result = subprocess.run([sys.executable, '-c', code], cwd=cwd, env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout.split()
+
+
+# Importing the services (as the CLI scripts do) creates nothing and loads
+# neither the web stack nor the optional heavy modules
+tmp_dir = tempfile.mkdtemp()
+loaded = child('import sys\n'
+               'import app.services.config_service, app.services.apply_service, app.services.subscriber_service\n'
+               'print(*sorted(m for m in ("flask", "psutil", "prometheus_client", "jinja2", "asyncio") if m in sys.modules))',
+               tmp_dir)
+print('heavy modules loaded by importing the services:', loaded)
+assert loaded == [], loaded
+assert os.listdir(tmp_dir) == []
+
+# create_app() sets up the directories itself
+assert child('from app import create_app\ncreate_app()\nprint("ok")', tmp_dir) == ['ok']
+assert os.path.isdir(os.path.join(tmp_dir, 'config')) and os.path.isdir(os.path.join(tmp_dir, 'generated'))
+
+# The profile covers every phase and attributes imports to them
+result = startup_profile.profile('/', cwd=tmp_dir)
+print('\n'.join(startup_profile.report(result)))
+assert set(result['phases']) == set(startup_profile.PHASES)
+assert result['status'] == 200
+phases = {e['module']: e['phase'] for e in result['imports'] if e['depth'] == 0}
+assert phases['app'] == 'import' and phases['flask'] == 'create_app' and phases['app.routes'] == 'create_app'
+assert startup_profile.by_package(result['imports'])['werkzeug'] > 0
+
+parsed = startup_profile._parse_importtime('-- phase import\n'
+                                           'import time: self [us] | cumulative | imported package\n'
+                                           'import time:       120 |        300 |   json.decoder\n'
+                                           'import time:       180 |        480 | json\n')
+assert parsed == [{'module': 'json.decoder', 'phase': 'import', 'self_ms': 0.12, 'cumulative_ms': 0.3, 'depth': 1},
+                  {'module': 'json', 'phase': 'import', 'self_ms': 0.18, 'cumulative_ms': 0.48, 'depth': 0}]
+
+print('Startup tests passed')
@@ -0,0 +1,193 @@
+import logging
+import mmap
+import os
+from app.services import stats_service
+
+# Drive a sampler by hand on a private buffer: this process counts as the
+# (already started) leader, so ensure_sampler() leaves everything alone
+stats_service._mm = mmap.mmap(-1, stats_service.FILE_SIZE)
+stats_service._pid = os.getpid()
+stats_service._leader = True
+
+
+class FakeTime:
+    now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        pass
+
+    def monotonic(self):
+        return self.now
+
+
+clock = FakeTime()
+stats_service.time = clock
+counters = {}
+stats_service.read_counters = lambda: dict(counters)
+sampler = stats_service._Sampler(stats_service._mm)
+
+
+def row(rx_bytes, tx_bytes):
+    return (rx_bytes, tx_bytes, 10, 20, 0, 0, 0, 0)
+
+
+def tick(seconds=1.0):
+    clock.now += seconds
+    sampler.sample()
+
+
+# Nothing sampled yet
+assert stats_service._snapshot() is None
+assert stats_service.get_all_rates() == {}
+
+# Rates are the counter deltas over the sample interval
+counters['eth0'] = row(1000, 500)
+tick()
+assert stats_service.get_all_rates() == {}  # one sample is not a rate yet
+counters['eth0'] = row(3000, 1500)
+tick(2.0)
+rates = stats_service.get_all_rates()
+assert rates['eth0']['rx_bytes'] == 1000.0, rates
+assert rates['eth0']['tx_bytes'] == 500.0, rates
+assert rates['eth0']['rx_packets'] == 0.0
+assert stats_service.get_all_counters()['eth0']['rx_bytes'] == 3000
+print('rates ok:', rates['eth0']['rx_bytes'], rates['eth0']['tx_bytes'])
+
+# A counter that went backwards (driver reset) gives 0, not a negative rate
+counters['eth0'] = row(100, 1500)
+tick()
+assert stats_service.get_all_rates()['eth0']['rx_bytes'] == 0.0
+
+# Interfaces matching the excluded prefixes are not sampled
+counters['ppp0'] = row(1, 1)
+tick()
+assert 'ppp0' not in stats_service.get_all_counters()
+
+# An interface that appears later must not show a spike against the zeroed
+# rows of the samples taken before it existed
+counters['eth1'] = row(10 ** 12, 10 ** 12)
+tick()
+assert stats_service.get_all_rates()['eth1']['rx_bytes'] == 0.0
+history = stats_service.get_interface_stats('eth1')['history']
+assert all(point['rx_bytes'] == 0.0 for point in history), history
+counters['eth1'] = row(10 ** 12 + 4000, 10 ** 12)
+tick()
+assert stats_service.get_all_rates()['eth1']['rx_bytes'] == 4000.0
+print('new interface ok, no spike over', len(history), 'earlier samples')
+
+# A vanished interface drops out of the current rates
+del counters['eth1']
+tick()
+assert 'eth1' not in stats_service.get_all_rates()
+assert stats_service.get_interface_stats('eth1') is None
+counters['eth1'] = row(10 ** 12 + 8000, 10 ** 12)
+tick()
+assert stats_service.get_all_rates()['eth1']['rx_bytes'] == 0.0  # against the gap, not a spike
+
+# Seqlock: while a write is in progress (odd counter) readers don't take a copy...
+header = list(stats_service._HEADER.unpack_from(stats_service._mm, 0))
+seq = header[5]
+header[5] = seq + 1
+stats_service._HEADER.pack_into(stats_service._mm, 0, *header)
+assert stats_service._snapshot() is None
+
+# ...and retry until it is finished
+waits = []
+
+
+def finish_write(seconds):
+    waits.append(seconds)
+    header[5] = seq + 2
+    stats_service._HEADER.pack_into(stats_service._mm, 0, *header)
+
+
+clock.sleep = finish_write
+snapshot = stats_service._snapshot()
+del clock.sleep
+assert len(waits) == 1
+assert snapshot is not None and snapshot[0][5] == seq + 2
+print('seqlock ok')
+
+# A copy taken while the writer got in between is thrown away
+tick()  # back in step with the sampler's own counter
+real_header = stats_service._HEADER
+reads = []
+
+
+class RacingHeader:
+    size = real_header.size
+
+    def unpack_from(self, buf, offset=0):
+        reads.append(1)
+        result = real_header.unpack_from(buf, offset)
+        if len(reads) == 1:
+            # A full sample completes between the first header read and the re-check
+            clock.now += 1
+            sampler.sample()
+        return result
+
+    def pack_into(self, *args):
+        real_header.pack_into(*args)
+
+
+stats_service._HEADER = RacingHeader()
+snapshot = stats_service._snapshot()
+stats_service._HEADER = real_header
+assert len(reads) >= 3, reads  # first copy rejected, second attempt accepted
+assert snapshot[0][5] == sampler.seq
+print('torn copy rejected ok')
+
+# All slots taken: a new interface (a new WAN, say) gets none...
+for n in range(stats_service.MAX_INTERFACES - len(sampler.slots)):
+    counters[f'veth{n}'] = row(n, n)
+tick()
+counters['wan2'] = row(0, 0)
+tick()
+assert len(sampler.slots) == stats_service.MAX_INTERFACES and 'wan2' not in sampler.slots
+# ...until the churned ones have been gone for a whole history window
+for n in range(stats_service.MAX_INTERFACES):
+    counters.pop(f'veth{n}', None)
+for _ in range(stats_service.HISTORY - 1):
+    tick()
+assert 'wan2' not in sampler.slots
+tick()  # freed here, and wan2 takes one in the same sample
+assert 'wan2' in sampler.slots
+counters['wan2'] = row(5000, 0)
+tick()
+assert stats_service.get_all_rates()['wan2']['rx_bytes'] == 5000.0
+assert not any(name.startswith('veth') for name in stats_service.get_all_counters())
+assert stats_service.get_interface_stats('veth0') is None
+header = stats_service._HEADER.unpack_from(stats_service._mm, 0)
+assert header[3] == stats_service.MAX_INTERFACES  # no slot beyond the buffer
+print('slots reclaimed ok')
+
+# A failing listener is logged once per exception type and does not stop the others
+logged = []
+
+
+class Collect(logging.Handler):
+    def emit(self, record):
+        logged.append(record.getMessage())
+
+
+logging.getLogger(stats_service.__name__).addHandler(Collect())
+calls = []
+
+
+def broken(_sampler, _counters):
+    raise KeyError('boom')
+
+
+stats_service.add_listener(broken)
+stats_service.add_listener(lambda _sampler, c: calls.append(len(c)))
+for _ in range(3):
+    clock.now += 1
+    stats_service._tick(sampler)
+assert len(calls) == 3, calls
+assert len(logged) == 1 and 'broken' in logged[0] and 'KeyError' in logged[0], logged
+print('listener errors ok:', logged[0])
+
+print('ALL OK')
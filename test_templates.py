@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+from app.services import config_service, template_service, yaml_emitter
+
+tmp_dir = tempfile.mkdtemp()
+config_service.GENERATED_DIR = tmp_dir
+
+# Strings a YAML 1.1 reader would turn into something else are quoted
+cases = {
+    'eth0': 'eth0', '192.168.1.1/24': '192.168.1.1/24', 'on': '"on"', 'No': '"No"', '010': '"010"',
+    '1.5': '"1.5"', '0x1f': '"0x1f"', '2026-01-01': '"2026-01-01"', 'my wifi': '"my wifi"',
+    'pass: word': '"pass: word"', '#tag': '"#tag"', '': '""', 'café': '"café"', 'a"b': '"a\\"b"'
+}
+for value, expected in cases.items():
+    assert yaml_emitter.scalar(value) == expected, (value, yaml_emitter.scalar(value))
+assert yaml_emitter.scalar(True) == 'true' and yaml_emitter.scalar(0) == '0' and yaml_emitter.scalar(None) == 'null'
+
+doc = {'network': {'version': 2, 'ethernets': {'eth1': {'dhcp4': False}, 'eth0': {'addresses': ['10.0.0.2/24'], 'routes': [{'to': 'default', 'via': '10.0.0.1'}]}},
+                   'wifis': {}}}
+text = ''.join(yaml_emitter.dump(doc))
+print(text)
+# Keys are sorted, so the same settings in any order give the same bytes
+assert text == ''.join(yaml_emitter.dump({'network': dict(reversed(list(doc['network'].items())))}))
+assert text.index('eth0:') < text.index('eth1:') and '      routes:\n        - to: default\n          via: 10.0.0.1\n' in text
+assert '  wifis: {}\n' in text
+try:
+    import yaml
+except ImportError:
+    yaml = None
+if yaml:
+    assert yaml.safe_load(text) == doc
+    odd = {k: k for k in cases}
+    assert yaml.safe_load(''.join(yaml_emitter.dump(odd))) == odd
+
+# Netplan, hostapd and PPPoE files come from the templates, and rendering is repeatable
+config = {
+    'network': {
+        'eth0': {'role': 'wan', 'ip': ''},
+        'eth1': {'role': 'lan', 'ip': '192.168.172.1'},
+        'wlan0': {'role': 'lan', 'ssid': 'yes', 'psk': 'secret pass', 'channel': '11'}
+    },
+    'pppoe': {'br0': {'enabled': True, 'local_ip': '10.0.0.1', 'remote_start': '10.0.0.2', 'dns': '1.1.1.1', 'instances': 2}}
+}
+config_service.regenerate(config)
+
+
+def read(name):
+    with open(os.path.join(tmp_dir, name), 'r') as f:
+        return f.read()
+
+
+netplan = read('01-netcfg.yaml')
+assert netplan.startswith('# This file is generated by Ubuntu Router UI\nnetwork:\n')
+assert '    wlan0:\n' in netplan and 'renderer: networkd' in netplan
+if yaml:
+    assert yaml.safe_load(netplan)['network']['bridges']['br0']['addresses'] == ['192.168.172.1/24']
+assert 'ssid=yes\nhw_mode=g\nchannel=11\nwpa=2\nwpa_passphrase=secret pass\n' in read('hostapd.conf')
+assert read('pppoe-server-options').endswith('ipparam ubuntu-router\nms-dns 1.1.1.1\n')
+assert read('start_pppoe.sh').count('pppoe-server -k -I br0 -L 10.0.0.1') == 2
+assert config_service.regenerate(config, force=True) == []
+
+# Editing a template reruns its generator even though the settings did not change
+template_dir = tempfile.mkdtemp()
+shutil.copytree(template_service.TEMPLATE_DIR, template_dir, dirs_exist_ok=True)
+real_template_dir = template_service.TEMPLATE_DIR
+template_service.TEMPLATE_DIR = template_dir
+with open(os.path.join(template_dir, 'hostapd.conf.j2'), 'a') as f:
+    f.write('# edited\n')
+assert config_service.regenerate(config) == ['hostapd.conf']
+assert read('hostapd.conf').endswith('# edited\n')
+
+# Other test files may run in this process after this one (pytest)
+template_service.TEMPLATE_DIR = real_template_dir
+print('Template tests passed')
@@ -0,0 +1,133 @@
+import os
+import subprocess
+import tempfile
+import time
+from app.services import pppoe_sessions, tsdb
+
+tmp_dir = tempfile.mkdtemp()
+tsdb.METRICS_DIR = os.path.join(tmp_dir, 'metrics')
+
+# Small archives so a test can walk around the rings: 1s x 10, 5s x 6, 30s x 4
+archives = ((1, 10), (5, 6), (30, 4))
+series = tsdb.Series(os.path.join(tmp_dir, 'test.rrd'), archives)
+assert os.path.getsize(series.path) == series.size
+
+base = 6000.0  # a multiple of every step, so buckets line up with the test
+for i in range(30):
+    series.update(i, base + i)
+
+# 1s archive: one value per bucket, only the last 10 seconds are kept
+result = series.fetch(base + 20, base + 29, step=1)
+assert result['step'] == 1
+assert result['points'] == [[base + n, n, n, n] for n in range(20, 30)], result['points']
+result = series.fetch(base, base + 29, step=1)
+assert len(result['points']) == 10  # never more than one lap of the ring
+assert result['points'][0][0] == base + 20
+
+# 5s archive: min/avg/max over each bucket of 5 samples
+result = series.fetch(base, base + 29, step=5)
+assert result['step'] == 5
+assert result['points'] == [[base + 5 * b, 5 * b, 5 * b + 2.0, 5 * b + 4] for b in range(6)], result['points']
+
+# 30s archive: the whole run in one bucket
+result = series.fetch(base, base + 29, step=30)
+assert result['points'] == [[base, 0, 14.5, 29]], result['points']
+print('rollups ok')
+
+# A bucket without data comes back empty, and the next lap of the ring
+# replaces old data instead of adding to it
+result = series.fetch(base + 30, base + 34, step=5)
+assert result['points'] == [[base + 30, None, None, None]]
+series.update(100, base + 60)  # same 1s slot as base + 50, base + 40...
+assert series.fetch(base + 60, base + 60, step=1)['points'] == [[base + 60, 100, 100, 100]]
+assert series.fetch(base + 50, base + 50, step=1)['points'] == [[base + 50, None, None, None]]
+assert series.fetch(base + 60, base + 60, step=30)['points'] == [[base + 60, 100, 100, 100]]
+print('ring laps ok')
+
+# The archive is picked from how far back the range starts
+now = base + 100
+assert series.pick_archive(now - 5, now)[0] == 1
+assert series.pick_archive(now - 25, now)[0] == 5
+assert series.pick_archive(now - 100, now)[0] == 30
+assert series.pick_archive(now - 10000, now)[0] == 30
+
+# Reopening keeps the data; a file with another layout is reset
+series.close()
+series = tsdb.Series(series.path, archives)
+assert series.fetch(base + 60, base + 60, step=1)['points'] == [[base + 60, 100, 100, 100]]
+series.close()
+series = tsdb.Series(series.path, ((1, 10),))
+assert series.fetch(base + 60, base + 60, step=1)['points'] == [[base + 60, None, None, None]]
+series.close()
+print('reopen ok')
+
+# Module API: names are checked, unknown series give None
+now = float(int(time.time()))
+tsdb.record('wan.test', 1.5, now)
+tsdb.record('wan.test', 2.5, now)
+assert tsdb.list_series() == ['wan.test']
+result = tsdb.fetch_range('wan.test', start=now - 60, end=now)
+assert result['series'] == 'wan.test' and result['step'] == 1
+assert result['points'][-1] == [now, 1.5, 2.0, 2.5], result['points'][-1]
+assert tsdb.fetch_range('missing') is None
+try:
+    tsdb.record('../escape', 1)
+    assert False, 'bad name accepted'
+except ValueError:
+    pass
+
+# The sampler listener records interface rates and the PPPoE session count
+pppoe_sessions.RUN_DIR = tmp_dir
+pppoe_sessions.EVENTS_FILE = os.path.join(tmp_dir, 'pppoe-events.log')
+pppoe_sessions.LOCK_FILE = os.path.join(tmp_dir, 'pppoe-events.lock')
+pppoe_sessions.REFRESH_INTERVAL = 0
+pppoe_sessions._read_counters = lambda: {}
+hook = os.path.join(tmp_dir, 'ip-up')
+with open(hook, 'w') as f:
+    f.write(pppoe_sessions.hook_script('up'))
+for n, user in enumerate(('alice', 'bob')):
+    subprocess.run(['sh', hook], check=True, env=dict(
+        os.environ, PPP_IPPARAM=pppoe_sessions.IPPARAM, PPP_IFACE=f'ppp{n}', PEERNAME=user,
+        PPP_REMOTE=f'10.0.0.{n + 2}', PPP_LOCAL='10.0.0.1'))
+
+# Series of interfaces gone for longer than INTERFACE_EXPIRY are deleted,
+# a recent one is kept
+for name, age in (('oldvlan', tsdb.INTERFACE_EXPIRY + 60), ('eth5', 60)):
+    tsdb.record(f'iface.{name}.rx_bps', 1, now)
+    tsdb.record(f'iface.{name}.tx_bps', 1, now)
+    for suffix in ('rx_bps', 'tx_bps'):
+        os.utime(os.path.join(tsdb.METRICS_DIR, f'iface.{name}.{suffix}.rrd'), (now - age, now - age))
+
+
+class FakeSampler:
+    # Only interfaces with a sampler slot are recorded, however many counters there are
+    slots = {'eth0': 0, 'lo': 1}
+
+
+on_sample = tsdb._interface_recorder()
+counters = {'eth0': (0, 0) + (0,) * 6, 'lo': (0,) * 8, 'ppp0': (0,) * 8, 'veth9': (0,) * 8}
+on_sample(FakeSampler(), counters)
+counters = {'eth0': (1000, 500) + (0,) * 6, 'lo': (5,) * 8, 'ppp0': (9,) * 8, 'veth9': (9,) * 8}
+on_sample(FakeSampler(), counters)
+names = tsdb.list_series()
+print(names)
+assert 'iface.eth0.rx_bps' in names and 'iface.eth0.tx_bps' in names
+assert not any(name.startswith(('iface.lo.', 'iface.ppp', 'iface.veth9.')) for name in names)
+assert not any(name.startswith('iface.oldvlan.') for name in names)
+assert 'iface.eth5.rx_bps' in names and 'iface.eth5.tx_bps' in names
+assert tsdb.fetch_range('iface.oldvlan.rx_bps') is None
+assert 'system.cpu_percent' in names and 'system.mem_percent' in names
+points = [p for p in tsdb.fetch_range('pppoe.sessions', period='hour')['points'] if p[1] is not None]
+assert points and points[-1][3] == 2, points
+print('recorder ok')
+
+# A reader holding a series that was deleted and created anew picks up the new file
+reader = tsdb.Series(tsdb._open('wan.test').path)  # another worker's mapping
+tsdb.remove('wan.test')
+assert tsdb.fetch_range('wan.test') is None and not os.path.exists(reader.path)
+tsdb._series[reader.path] = reader
+tsdb.Series(reader.path).update(7, now)
+assert tsdb.fetch_range('wan.test', start=now - 10, end=now)['points'][-1] == [now, 7, 7, 7]
+print('expiry ok')
+
+print('ALL OK')
@@ -0,0 +1,69 @@
+import os
+import subprocess
+import tempfile
+from app.services import config_service, tuning_service
+
+tmp_dir = tempfile.mkdtemp()
+config_service.GENERATED_DIR = tmp_dir
+
+# Fake sysfs: eth0 with 4 queue pairs on MSI-X (plus a link vector), eth1 single
+# queue on a legacy line, br0 virtual
+sys_net = os.path.join(tmp_dir, 'sys')
+for name, rx, tx in (('eth0', 4, 4), ('eth1', 1, 1), ('br0', 1, 1)):
+    for kind, count in (('rx', rx), ('tx', tx)):
+        for q in range(count):
+            os.makedirs(os.path.join(sys_net, name, 'queues', f'{kind}-{q}'))
+    if name != 'br0':
+        os.makedirs(os.path.join(sys_net, name, 'device'))
+for irq in (40, 41, 42, 43, 44):
+    os.makedirs(os.path.join(sys_net, 'eth0', 'device', 'msi_irqs', str(irq)))
+
+interrupts = os.path.join(tmp_dir, 'interrupts')
+with open(interrupts, 'w') as f:
+    f.write('           CPU0       CPU1       CPU2       CPU3\n')
+    f.write('  0:         10          0          0          0   IO-APIC   2-edge      timer\n')
+    f.write(' 19:       5000          0          0          0   IO-APIC  19-fasteoi   eth1\n')
+    f.write(' 40:          3          0          0          0   PCI-MSI 524288-edge      eth0\n')
+    for n in range(4):
+        f.write(f' {41 + n}:       9000          0          0          0   PCI-MSI 52428{9 + n}-edge      eth0-TxRx-{n}\n')
+    f.write('NMI:          0          0          0          0   Non-maskable interrupts\n')
+tuning_service.SYS_NET = sys_net
+tuning_service.PROC_INTERRUPTS = interrupts
+tuning_service.PROC_IRQ = os.path.join(tmp_dir, 'irq')
+
+ifaces = [{'name': 'eth0', 'speed': 10000, 'mtu': 1500}, {'name': 'eth1', 'speed': 1000, 'mtu': 1500},
+          {'name': 'br0', 'speed': 0, 'mtu': 1500}]
+hardware = tuning_service.read_hardware(ifaces)
+hardware['cpus'] = 4
+print(hardware)
+assert set(hardware['nics']) == {'eth0', 'eth1'}
+assert hardware['nics']['eth0']['irqs'] == 5 and hardware['nics']['eth1']['irqs'] == 1
+
+current = tuning_service.read_current(hardware)
+print("--- Current ---", current['per_cpu'])
+assert current['per_cpu'] == [41003, 0, 0, 0]
+
+layout = config_service.plan_tuning({}, hardware)
+print("--- Proposed ---", layout)
+# eth1 continues where eth0 stopped instead of starting on CPU0 again
+assert layout['eth0']['irq_cpus'] == [0, 1, 2, 3, 0] and layout['eth1']['irq_cpus'] == [1]
+assert layout['eth0']['rps'] == [] and layout['eth0']['xps'] == ['1', '2', '4', '8']
+assert layout['eth1']['rps'] == ['f'] and layout['eth1']['rfs_flow_cnt'] == 32768
+
+assert config_service.plan_tuning({'cpus': '1-3'}, hardware)['eth1']['rps'] == ['e']
+assert tuning_service.cpu_mask([0, 1, 33]) == '00000002,00000003'
+
+config = {'tuning': {'enabled': True, 'hardware': hardware,
+                     'interfaces': {'eth0': {'rx_ring': 'max', 'tx_ring': '1024', 'offloads': {'lro': 'off', 'gro': 'on'}}}}}
+config_service.generate_tuning_script(config)
+script = os.path.join(tmp_dir, 'setup_tuning.sh')
+with open(script) as f:
+    content = f.read()
+print(content[-700:])
+assert 'ethtool -G eth0 rx $(ring_max eth0 RX) tx 1024' in content
+assert 'ethtool -K eth0 gro on lro off' in content
+assert 'set_irqs eth0 0 1 2 3 0' in content
+assert 'put f /sys/class/net/eth1/queues/rx-0/rps_cpus' in content
+assert subprocess.run(['bash', '-n', script]).returncode == 0
+
+print("All tuning tests passed")
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+from app.services import config_service, tsdb, wan_health
+
+wan_health.STATE_FILE = os.path.join(tempfile.mkdtemp(), 'wan_health.json')
+
+# Hysteresis: a single lost round does not take a WAN down
+state = wan_health.WanState('eth0')
+assert not state.update([None, 0.02])
+assert state.up
+
+# Sustained loss does, and it only comes back after UP_ROUNDS clean rounds
+rounds = 0
+while state.up:
+    state.update([None, None])
+    rounds += 1
+print(f"--- eth0 down after {rounds} lost rounds (loss {state.loss:.2f}) ---")
+recovered = 0
+while not state.up:
+    state.update([0.02, 0.03])
+    recovered += 1
+print(f"--- eth0 up again after {recovered} good rounds (loss {state.loss:.2f}) ---")
+assert recovered >= wan_health.UP_ROUNDS
+
+# Probes against local stand-ins: lo plays the WAN, a listening socket the target
+server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+server.bind(('127.0.0.1', 0))
+server.listen()
+port = server.getsockname()[1]
+
+wans = [{'name': 'lo', 'mark': None, 'table': 101, 'weight': 1}]
+plan = {'lo': [('127.0.0.1', 'tcp', port), ('127.0.0.1', 'icmp', 0), ('10.255.255.1', 'tcp', port)]}
+results = asyncio.run(wan_health.probe_round(wans, plan, timeout=0.5))
+print("--- Probe round over lo ---")
+print(results)
+assert results['lo'][0] is not None and results['lo'][2] is None
+
+
+# Raw ICMP sockets see every reply: one from another target, or for another
+# probe's id, must not count for this probe
+class FakeRawSocket(socket.socket):
+    # One end of a datagram socketpair; sendto answers with canned raw replies
+    def __init__(self, replies):
+        self.peer, mine = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        super().__init__(fileno=mine.detach())
+        self.replies = replies
+
+    def setsockopt(self, *args):
+        pass
+
+    def sendto(self, packet, address):
+        _kind, _code, _sum, ident, seq = struct.unpack_from('!BBHHH', packet)
+        for source, id_offset in self.replies:
+            header = bytes([0x45]) + bytes(11) + socket.inet_aton(source) + socket.inet_aton('192.0.2.9')
+            self.peer.send(header + struct.pack('!BBHHH', 0, 0, 0, (ident + id_offset) & 0xffff, seq) + packet[8:])
+        return len(packet)
+
+
+def raw_probe(target, replies):
+    real_socket = wan_health._icmp_socket
+    wan_health._icmp_socket = lambda: (FakeRawSocket(replies), True)
+    try:
+        return asyncio.run(wan_health.probe_icmp('eth9', target, timeout=0.2))
+    finally:
+        wan_health._icmp_socket = real_socket
+
+
+assert raw_probe('198.51.100.2', [('198.51.100.2', 0)]) is not None
+assert raw_probe('198.51.100.2', [('198.51.100.1', 0)]) is None
+assert raw_probe('198.51.100.2', [('198.51.100.2', 1)]) is None
+assert raw_probe('198.51.100.2', [('198.51.100.1', 0), ('198.51.100.2', 1), ('198.51.100.2', 0)]) is not None
+print("--- raw replies matched on source and id ---")
+
+# Route updates against a fake ip on PATH that keeps its routes in a JSON file:
+# a table per WAN with its gateway, and the main table's default routes
+tmp_dir = tempfile.mkdtemp()
+tsdb.METRICS_DIR = os.path.join(tmp_dir, 'metrics')
+fake_ip = os.path.join(tmp_dir, 'ip')
+with open(fake_ip, 'w') as f:
+    f.write(f'#!{sys.executable}\n' + r'''
+import fcntl, json, sys
+path = sys.argv[0] + '.json'
+# The daemon runs several ip at once
+lock = open(path + '.lock', 'a')
+fcntl.flock(lock, fcntl.LOCK_EX)
+with open(path) as f:
+    routes = json.load(f)
+args = sys.argv[1:]
+routes['calls'].append(' '.join(args))
+if args[:3] == ['-4', 'route', 'show'] and args[4] != 'main':
+    gateway = routes['tables'].get(args[4])
+    if gateway:
+        print(f'default via {gateway[0]} dev {gateway[1]}')
+elif args[:3] == ['-4', 'route', 'show']:
+    print('\n'.join(routes['main']))
+elif args[:2] == ['route', 'replace'] and routes['fail']:
+    routes['fail'] -= 1
+    with open(path, 'w') as f:
+        json.dump(routes, f)
+    sys.stderr.write('RTNETLINK answers: Network is unreachable\n')
+    sys.exit(2)
+elif args[:2] == ['route', 'replace']:
+    hops = [args[i:i + 7] for i in range(args.index('nexthop'), len(args), 7)]
+    mine = ['default'] + ['\t' + ' '.join(hop) for hop in hops]
+    routes['main'] = mine + [r for r in routes['main'] if 'metric' in r]
+else:
+    sys.exit(1)
+with open(path, 'w') as f:
+    json.dump(routes, f)
+''')
+os.chmod(fake_ip, os.stat(fake_ip).st_mode | stat.S_IEXEC)
+real_path = os.environ['PATH']
+os.environ['PATH'] = tmp_dir + os.pathsep + os.environ['PATH']
+
+
+def set_routes(**changes):
+    routes = {'calls': [], 'fail': 0, 'tables': {}, 'main': []}
+    if os.path.exists(fake_ip + '.json'):
+        with open(fake_ip + '.json') as f:
+            routes = json.load(f)
+    routes.update(changes)
+    with open(fake_ip + '.json', 'w') as f:
+        json.dump(routes, f)
+    return routes
+
+
+def get_routes():
+    with open(fake_ip + '.json') as f:
+        return json.load(f)
+
+
+def calls_since(count):
+    return [c for c in get_routes()['calls'][count:] if c.startswith('route replace')]
+
+
+wans = [{'name': 'eth1', 'table': 101, 'mark': 0x101, 'weight': 3},
+        {'name': 'eth2', 'table': 102, 'mark': 0x102, 'weight': 1}]
+states = {w['name']: wan_health.WanState(w['name']) for w in wans}
+# eth2 also has its own DHCP default with a metric: not the route we manage
+set_routes(tables={'101': ['192.0.2.1', 'eth1'], '102': ['198.51.100.1', 'eth2']},
+           main=['default via 198.51.100.1 dev eth2 proto dhcp metric 100'])
+
+assert asyncio.run(wan_health._current_nexthop_devices()) == []
+assert asyncio.run(wan_health.update_nexthops(wans, states)) == ['eth1', 'eth2']
+assert calls_since(0) == ['route replace default scope global nexthop via 192.0.2.1 dev eth1 weight 3 '
+                          'nexthop via 198.51.100.1 dev eth2 weight 1']
+assert asyncio.run(wan_health._current_nexthop_devices()) == ['eth1', 'eth2']
+assert 'default via 198.51.100.1 dev eth2 proto dhcp metric 100' in get_routes()['main']
+
+# Nothing to do when the route already matches, even with the DHCP default on eth1 only
+calls = len(get_routes()['calls'])
+set_routes(main=get_routes()['main'] + ['default via 192.0.2.1 dev eth1 proto dhcp metric 200'])
+assert asyncio.run(wan_health.update_nexthops(wans, states)) == ['eth1', 'eth2']
+assert calls_since(calls) == []
+
+# A WAN without a gateway yet is left out; none at all leaves the route alone
+set_routes(tables={'101': ['192.0.2.1', 'eth1']})
+assert asyncio.run(wan_health.update_nexthops(wans, states)) == ['eth1']
+set_routes(tables={})
+assert asyncio.run(wan_health.update_nexthops(wans, states)) is None
+assert asyncio.run(wan_health._current_nexthop_devices()) == ['eth1']
+set_routes(tables={'101': ['192.0.2.1', 'eth1'], '102': ['198.51.100.1', 'eth2']})
+print('--- update_nexthops ok ---')
+
+# The daemon loop: eth2 stops answering, drops out of the route and comes back
+config = {'network': {'eth1': {'role': 'wan'}, 'eth2': {'role': 'wan'}},
+          'loadbalance': {'eth1': {'enabled': True, 'weight': 3, 'slot': 1},
+                          'eth2': {'enabled': True, 'weight': 1, 'slot': 2}}}
+real_load_config = config_service.load_config
+config_service.load_config = lambda: config
+assert [w['table'] for w in config_service.get_lb_wans(config)] == [101, 102]
+
+
+class Done(Exception):
+    pass
+
+
+def run_rounds(rounds):
+    """
+    Runs the daemon over scripted probe rounds ({iface: rtt or None} each).
+    Returns the active interfaces reported after every round.
+    """
+    active = []
+
+    async def probe_round(wans, plan, timeout=wan_health.TIMEOUT, seq=1):
+        if seq > 1:  # the state file is written after every round
+            active.append(wan_health.read_state()['active'])
+        if not rounds:
+            raise Done()
+        answers = rounds.pop(0)
+        return {w['name']: [answers[w['name']]] * 2 for w in wans}
+
+    wan_health.probe_round = probe_round
+    try:
+        asyncio.run(wan_health.run(interval=0))
+    except Done:
+        pass
+    active.append(wan_health.read_state()['active'])
+    return active
+
+
+up = {'eth1': 0.01, 'eth2': 0.02}
+eth2_down = {'eth1': 0.01, 'eth2': None}
+set_routes(main=['default via 198.51.100.1 dev eth2 proto dhcp metric 100'], calls=[])
+active = run_rounds([up] + [eth2_down] * 5 + [up] * 10)
+print('--- active per round ---')
+print(active)
+print('--- route replacements ---')
+print('\n'.join(calls_since(0)))
+assert active[0] == ['eth1', 'eth2']
+assert active.index(['eth1']) == 3  # down after LOSS_DOWN is crossed
+assert active[-1] == ['eth1', 'eth2']
+# One replace to install the route, one for the failover, one for the recovery
+replaced = calls_since(0)
+assert len(replaced) == 3, replaced
+assert 'eth2' not in replaced[1] and 'eth2' in replaced[2]
+assert asyncio.run(wan_health._current_nexthop_devices()) == ['eth1', 'eth2']
+
+# A replace that fails keeps the installed route and the reported active set,
+# and is tried again every round until it goes through (here: the third try)
+set_routes(fail=2, calls=[])
+active = run_rounds([up] + [eth2_down] * 5)
+print('--- with ip failing twice ---')
+print(active)
+print('\n'.join(calls_since(0)))
+assert wan_health.read_state()['wans']['eth2']['state'] == 'down'
+assert active[3:6] == [['eth1', 'eth2'], ['eth1', 'eth2'], ['eth1']], active
+assert len(calls_since(0)) == 3, calls_since(0)
+assert asyncio.run(wan_health._current_nexthop_devices()) == ['eth1']
+print('--- route updates ok ---')
+
+# Other test files may run in this process after this one (pytest)
+config_service.load_config = real_load_config
+os.environ['PATH'] = real_path